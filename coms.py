@@ -1,5 +1,136 @@
 from datetime import datetime, timedelta
 from jdcal import jd2gcal
+import os
+import shelve
+from xritfile import XRITFile
+
+
+class Header:
+    """
+    Decoded xRIT header record.
+    Fields are read like a dict. Text and time fields are decoded from the raw header bytes on first access.
+    """
+
+    __slots__ = ('valid', 'header_type', 'header_len', 'header_offset', 'raw', 'fields')
+
+    def __init__(self, htype=None, length=0, offset=0, raw=b''):
+        self.valid = False          # Header found and decoded
+        self.header_type = htype    # Header type
+        self.header_len = length    # Header length including type and length fields
+        self.header_offset = offset # Header offset in file
+        self.raw = raw              # Raw header bytes
+        self.fields = {}            # Decoded fields
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            return getattr(self, key)
+
+        if key not in self.fields:
+            lazy = lazyFields.get(self.header_type)
+            if lazy == None or key not in lazy:
+                raise KeyError(key)
+
+            # Decode field on first access
+            self.fields[key] = lazy[key](self.raw)
+
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__:
+            setattr(self, key, value)
+        else:
+            self.fields[key] = value
+
+    def __contains__(self, key):
+        return key in self.__slots__ or key in self.fields or key in lazyFields.get(self.header_type, {})
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+# Lazy field decoders
+def decode_text(raw):
+    return bytes(raw[3:]).decode()
+
+def decode_projection(raw):
+    if "GEOS" in bytes(raw[3:35]).decode():
+        return "Normalized Geostationary Projection (GEOS)"
+
+def decode_longitude(raw):
+    projectionString = bytes(raw[3:35]).decode()
+    return projectionString[projectionString.index("(") + 1:projectionString.index(")")]
+
+def decode_compensation(raw):
+    return decode_text(raw).replace('\n', '\n\t')
+
+def decode_mjd_date(raw):
+    return jd2gcal(2400000.5, float(decode_text(raw)))
+
+def decode_p_field(raw):
+    # Bit 0 - Extension flag, Bits 1-3 - Time code ID, Bits 4-7 - Detail bits
+    return bin(raw[3])[2:].zfill(8)
+
+def decode_p_field_ext_flag(raw):
+    pField = decode_p_field(raw)
+    if pField[0] == "0":
+        return "0 (No extension)"
+    else:
+        return pField[0] + " (Extended field)"
+
+def decode_p_field_time_code(raw):
+    pField = decode_p_field(raw)
+    if pField[1:4] == "100":
+        return "100 (1958 January 1 epoch - Level 1 Time Code)"
+    elif pField[1:4] == "010":
+        return "010 (Agency-defined epoch - Level 2 Time Code)"
+
+def decode_t_field(raw):
+    # Bits 0-16 - Days since epoch, Bits 16-48 - Milliseconds of day
+    return bin(int.from_bytes(raw[4:10], byteorder='big'))[2:].zfill(48)
+
+def decode_t_field_datetime(raw):
+    epoch = datetime(1958, 1, 1)
+    days = int.from_bytes(raw[4:6], byteorder='big')
+    millis = int.from_bytes(raw[6:10], byteorder='big')
+    return epoch + timedelta(days=days, milliseconds=millis)
+
+# Lazily decoded fields by header type
+lazyFields = {}
+lazyFields[2] = {
+    'projection': decode_projection,
+    'longitude': decode_longitude
+}
+lazyFields[3] = {
+    'data_definition_block': decode_text
+}
+lazyFields[4] = {
+    'text_data': decode_text
+}
+lazyFields[5] = {
+    'p_field': decode_p_field,
+    'p_field_ext_flag': decode_p_field_ext_flag,
+    'p_field_time_code': decode_p_field_time_code,
+    'p_field_detail_bits': lambda raw: decode_p_field(raw)[4:8],
+    't_field': decode_t_field,
+    't_field_day_count': lambda raw: int.from_bytes(raw[4:6], byteorder='big'),
+    't_field_current_date': lambda raw: decode_t_field_datetime(raw).strftime('%d/%m/%Y'),
+    't_field_millis': lambda raw: int.from_bytes(raw[6:10], byteorder='big'),
+    't_field_current_time': lambda raw: decode_t_field_datetime(raw).strftime('%H:%M:%S')
+}
+lazyFields[130] = {
+    'data': decode_compensation
+}
+lazyFields[131] = {
+    'mjd': decode_text,
+    'date': decode_mjd_date
+}
+lazyFields[132] = {
+    'quality': decode_text
+}
+
 
 class COMS:
     """
@@ -44,6 +175,22 @@ class COMS:
     imageTypes[2] = "Limited Southern Hemisphere (LSH)"
     imageTypes[3] = "Asia and Pacific in Northern Hemisphere (APNH)"
 
+    # Image types by column and line count
+    imageDimensions = {}
+    imageDimensions[(2200, 220)] = 0    # LRIT FD
+    imageDimensions[(1547, 308)] = 1    # LRIT ENH
+    imageDimensions[(1547, 309)] = 1    # LRIT ENH
+    imageDimensions[(1547, 318)] = 2    # LRIT LSH
+    imageDimensions[(810, 611)] = 3     # LRIT APNH
+    imageDimensions[(11000, 1100)] = 0  # HRIT FD VIS
+    imageDimensions[(2750, 275)] = 0    # HRIT FD IR
+    imageDimensions[(7736, 1544)] = 1   # HRIT ENH VIS
+    imageDimensions[(1934, 386)] = 1    # HRIT ENH IR
+    imageDimensions[(7736, 1592)] = 2   # HRIT LSH VIS
+    imageDimensions[(1934, 398)] = 2    # HRIT LSH IR
+    imageDimensions[(4056, 3060)] = 3   # HRIT APNH VIS
+    imageDimensions[(1014, 765)] = 3    # HRIT APNH IR
+
     # LRIT image compression types
     compressionTypes = {}
     compressionTypes[0] = "None"
@@ -61,29 +208,57 @@ class COMS:
     colours['BOLD'] = '\033[1m'
     colours['UNDERLINE'] = '\033[4m'
 
-    primaryHeader = {}
-    imageStructureHeader = {}
-    imageNavigationHeader = {}
-    imageDataFunctionHeader = {}
-    annotationTextHeader = {}
-    timestampHeader = {}
-    ancillaryTextHeader = {}
-    keyHeader = {}
-    imageSegmentationInformationHeader = {}
-    imageCompensationInformationHeader = {}
-    imageObservationTimeHeader = {}
-    imageQualityInformationHeader = {}
-
     # Byte counter for tracking progress through file
     byteOffset = 0
 
 
-    def __init__(self, path):
+    def __init__(self, path, headerOnly=False, index=None):
+        """
+        Loads xRIT file
+        :param path: xRIT file path
+        :param headerOnly: Only map header field of file (data field is not accessible)
+        :param index: HeaderIndex used to skip reading files with known headers
+        """
+
         self.path = path  # LRIT file path
+        self.index = index  # Header index
+        self.headers = None  # Decoded headers in file order
+        self.file = None  # Memory-mapped xRIT file
+        self.xritString = memoryview(b'')
+
+        # Empty record for each header type
+        for htype in self.headerTable:
+            setattr(self, self.headerTable[htype][0], Header(htype))
+
+        # Restore decoded headers from index without opening file
+        if self.index != None:
+            headers = self.index.get(self.path)
+            if headers != None:
+                self.setHeaders(headers)
+                return
+
+        # Map xRIT file (only pages that are read are loaded from disk)
+        self.file = XRITFile(self.path)
+        if headerOnly:
+            self.xritString = self.file.header
+        else:
+            self.xritString = self.file.view
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps xRIT file. Decoded headers remain available.
+        """
 
-        # Load xRIT file
-        xritFile = open(self.path, mode="rb")
-        self.xritString = xritFile.read()
+        self.xritString = memoryview(b'')
+        if self.file != None:
+            self.file.close()
+            self.file = None
 
 
     # Tool methods
@@ -92,7 +267,7 @@ class COMS:
         Reads n bytes at x offset
         :param offset: Start position offset 
         :param length: Number of bytes to return
-        :return: Bytes  
+        :return: Bytes (zero-copy view into file)
         """
         return self.xritString[self.byteOffset+offset:self.byteOffset+offset+length]
 
@@ -114,115 +289,112 @@ class COMS:
 
 
     # Header parsing methods
-    def parsePrimaryHeader(self, printInfo=False):
+    def parseHeaders(self, printInfo=False):
         """
-        Parses xRIT Primary header (type 0, required)
+        Parses all xRIT headers in file order.
+        Headers are restored from the header index when available, and stored in it after parsing.
         :param printInfo: Print info after parsing
         """
 
-        if self.readbytes(0, 3) == b'\x00\x00\x10':
-            self.primaryHeader['valid'] = True
-            self.primaryHeader['header_type'] = 0
-            self.primaryHeader['header_len'] = 16
-            self.primaryHeader['header_offset'] = self.byteOffset
-            self.primaryHeader['file_type'] = int.from_bytes(self.readbytes(3), byteorder='big')
-            self.primaryHeader['total_header_len'] = int.from_bytes(self.readbytes(4, 4), byteorder='big')
-            self.primaryHeader['data_field_len'] = int.from_bytes(self.readbytes(8, 8), byteorder='big')
+        self.walkHeaders()
 
-            self.byteOffset += self.primaryHeader['header_len']
-            if printInfo:
-                self.printPrimaryHeader()
-        else:
-            self.primaryHeader['valid'] = False
+        if printInfo:
+            for header in self.headers:
+                printer = self.headerTable.get(header.header_type, (None, None, None))[2]
+                if printer != None and header.valid:
+                    printer(self)
 
-    def parseImageStructureHeader(self, printInfo=False):
+    def parseHeader(self, htype, printInfo=False):
         """
-        Parses xRIT Image Structure header (type 1)
+        Parses all xRIT headers and prints a single header
+        :param htype: Header type
         :param printInfo: Print info after parsing
         """
 
-        if self.readbytes(0, 3) == b'\x01\x00\x09':
-            self.imageStructureHeader['valid'] = True
-            self.imageStructureHeader['header_type'] = 1
-            self.imageStructureHeader['header_len'] = 9
-            self.imageStructureHeader['header_offset'] = self.byteOffset
+        self.walkHeaders()
 
-            self.imageStructureHeader['bits_per_pixel'] = self.readbytes(3)  # LRIT = 8 bits, HRIT = 16 bits
+        attr, decoder, printer = self.headerTable[htype]
+        if printInfo and printer != None and getattr(self, attr).valid:
+            printer(self)
 
-            # Detect LRIT/HRIT using bpp
-            if int.from_bytes(self.imageStructureHeader['bits_per_pixel'], byteorder='big') == 8:
-                self.imageStructureHeader['is_lrit'] = 1
-            else:
-                self.imageStructureHeader['is_lrit'] = 0
-
-            self.imageStructureHeader['num_cols'] = int.from_bytes(self.readbytes(4, 2), byteorder='big')
-            self.imageStructureHeader['num_lines'] = int.from_bytes(self.readbytes(6, 2), byteorder='big')
-
-            # Image type based on column and line count
-            if self.imageStructureHeader['num_cols'] == 2200 and self.imageStructureHeader['num_lines'] == 220:  # LRIT FD
-                self.imageStructureHeader['image_type'] = 0
-            elif self.imageStructureHeader['num_cols'] == 1547 and (self.imageStructureHeader['num_lines'] == 308 or self.imageStructureHeader['num_lines'] == 309):  # LRIT ENH
-                self.imageStructureHeader['image_type'] = 1
-            elif self.imageStructureHeader['num_cols'] == 1547 and self.imageStructureHeader['num_lines'] == 318:  # LRIT LSH
-                self.imageStructureHeader['image_type'] = 2
-            elif self.imageStructureHeader['num_cols'] == 810 and self.imageStructureHeader['num_lines'] == 611:  # LRIT APNH
-                self.imageStructureHeader['image_type'] = 3
-            elif self.imageStructureHeader['num_cols'] == 11000 and self.imageStructureHeader['num_lines'] == 1100:  # HRIT FD VIS
-                self.imageStructureHeader['image_type'] = 0
-            elif self.imageStructureHeader['num_cols'] == 2750 and self.imageStructureHeader['num_lines'] == 275:  # HRIT FD IR
-                self.imageStructureHeader['image_type'] = 0
-            elif self.imageStructureHeader['num_cols'] == 7736 and self.imageStructureHeader['num_lines'] == 1544:  # HRIT ENH VIS
-                self.imageStructureHeader['image_type'] = 1
-            elif self.imageStructureHeader['num_cols'] == 1934 and self.imageStructureHeader['num_lines'] == 386:  # HRIT ENH IR
-                self.imageStructureHeader['image_type'] = 1
-            elif self.imageStructureHeader['num_cols'] == 7736 and self.imageStructureHeader['num_lines'] == 1592:  # HRIT LSH VIS
-                self.imageStructureHeader['image_type'] = 2
-            elif self.imageStructureHeader['num_cols'] == 1934 and self.imageStructureHeader['num_lines'] == 398:  # HRIT LSH IR
-                self.imageStructureHeader['image_type'] = 2
-            elif self.imageStructureHeader['num_cols'] == 4056 and self.imageStructureHeader['num_lines'] == 3060:  # HRIT APNH VIS
-                self.imageStructureHeader['image_type'] = 3
-            elif self.imageStructureHeader['num_cols'] == 1014 and self.imageStructureHeader['num_lines'] == 765:  # HRIT APNH IR
-                self.imageStructureHeader['image_type'] = 3
-
-            self.imageStructureHeader['image_compression'] = int.from_bytes(self.readbytes(8), byteorder='big')
-
-            self.byteOffset += self.imageStructureHeader['header_len']
-            if printInfo:
-                self.printImageStructureHeader()
-        else:
-            self.imageStructureHeader['valid'] = False
+    def walkHeaders(self):
+        """
+        Walks header field once, dispatching each type/length record to its decoder
+        """
 
-    def parseImageNavigationHeader(self, printInfo=False):
+        if self.headers != None:
+            return
+
+        headers = []
+        data = self.xritString
+
+        # Primary header is required
+        if data[:3] == b'\x00\x00\x10':
+            totalHeaderLen = min(int.from_bytes(data[4:8], byteorder='big'), len(data))
+            offset = 0
+
+            while offset + 3 <= totalHeaderLen:
+                htype = data[offset]
+                length = int.from_bytes(data[offset + 1:offset + 3], byteorder='big')
+                if length < 3 or offset + length > totalHeaderLen:
+                    break
+
+                header = Header(htype, length, offset, bytes(data[offset:offset + length]))
+                entry = self.headerTable.get(htype)
+                try:
+                    if entry != None:
+                        entry[1](self, header)
+                    header.valid = True
+                except (IndexError, ValueError):
+                    header.valid = False
+
+                headers.append(header)
+                offset += length
+
+        self.setHeaders(headers)
+
+        if self.index != None and self.primaryHeader.valid:
+            self.index.put(self.path, headers)
+
+    def setHeaders(self, headers):
         """
-        Parses xRIT Image Navigation header (type 2)
+        Makes decoded headers available as attributes
+        :param headers: List of decoded headers in file order
+        """
+
+        self.headers = headers
+        for header in headers:
+            entry = self.headerTable.get(header.header_type)
+            if entry != None:
+                setattr(self, entry[0], header)
+
+        # Move to start of data field
+        if self.primaryHeader.valid:
+            self.byteOffset = self.primaryHeader['total_header_len']
+
+    def parsePrimaryHeader(self, printInfo=False):
+        """
+        Parses xRIT Primary header (type 0, required)
         :param printInfo: Print info after parsing
         """
 
-        if self.readbytes(0, 3) == b'\x02\x00\x33':
-            self.imageNavigationHeader['valid'] = True
-            self.imageNavigationHeader['header_type'] = 2
-            self.imageNavigationHeader['header_len'] = 51
-            self.imageNavigationHeader['header_offset'] = self.byteOffset
+        self.parseHeader(0, printInfo)
 
-            # Projection and longitude
-            projectionString = self.readbytes(3, 32).decode()
-            if projectionString.__contains__("GEOS"):
-                self.imageNavigationHeader['projection'] = "Normalized Geostationary Projection (GEOS)"
-            self.imageNavigationHeader['longitude'] = projectionString[projectionString.index("(") + 1:projectionString.index(")")]
+    def parseImageStructureHeader(self, printInfo=False):
+        """
+        Parses xRIT Image Structure header (type 1)
+        :param printInfo: Print info after parsing
+        """
 
-            # Scaling factors
-            self.imageNavigationHeader['col_scaling'] = int.from_bytes(self.readbytes(35, 4), byteorder='big')
-            self.imageNavigationHeader['line_scaling'] = int.from_bytes(self.readbytes(39, 4), byteorder='big')
+        self.parseHeader(1, printInfo)
 
-            # Offsets
-            self.imageNavigationHeader['col_offset'] = int.from_bytes(self.readbytes(43, 4), byteorder='big')
-            self.imageNavigationHeader['line_offset'] = int.from_bytes(self.readbytes(47, 4), byteorder='big')
+    def parseImageNavigationHeader(self, printInfo=False):
+        """
+        Parses xRIT Image Navigation header (type 2)
+        :param printInfo: Print info after parsing
+        """
 
-            self.byteOffset += self.imageNavigationHeader['header_len']
-            if printInfo:
-                self.printImageNavigationHeader()
-        else:
-            self.imageNavigationHeader['valid'] = False
+        self.parseHeader(2, printInfo)
 
     def parseImageDataFunctionHeader(self, printInfo=False):
         """
@@ -230,22 +402,7 @@ class COMS:
         :param printInfo: Print info after parsing
         """
 
-        if self.readbytes(0) == b'\x03':
-            self.imageDataFunctionHeader['valid'] = True
-            self.imageDataFunctionHeader['header_type'] = 3
-            self.imageDataFunctionHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.imageDataFunctionHeader['header_offset'] = self.byteOffset
-
-            self.imageDataFunctionHeader['data_definition_block'] = self.readbytes(3, self.imageDataFunctionHeader['header_len'] - 3).decode()
-            self.imageDataFunctionHeader['data_definition_block_filename'] = self.path[:-5] + "_IDF-DDB.txt"
-
-            #ddbFile = open(self.imageDataFunctionHeader['data_definition_block_filename'], 'w')
-            #ddbFile.write(self.imageDataFunctionHeader['data_definition_block'])
-            #ddbFile.close()
-
-            self.byteOffset += self.imageDataFunctionHeader['header_len']
-            if printInfo:
-                self.printImageDataFunctionHeader()
+        self.parseHeader(3, printInfo)
 
     def parseAnnotationTextHeader(self, printInfo=False):
         """
@@ -253,19 +410,7 @@ class COMS:
         :param printInfo: Print info after parsing
         """
 
-        if self.readbytes(0) == b'\x04':
-            self.annotationTextHeader['valid'] = True
-            self.annotationTextHeader['header_type'] = 4
-            self.annotationTextHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.annotationTextHeader['header_offset'] = self.byteOffset
-
-            self.annotationTextHeader['text_data'] = self.readbytes(3, self.annotationTextHeader['header_len'] - 3).decode()
-
-            self.byteOffset += self.annotationTextHeader['header_len']
-            if printInfo:
-                self.printAnnotationTextHeader()
-        else:
-            self.imageNavigationHeader['valid'] = False
+        self.parseHeader(4, printInfo)
 
     def parseTimestampHeader(self, printInfo=False):
         """
@@ -273,55 +418,7 @@ class COMS:
         :param printInfo: Print info after parsing 
         """
 
-        if self.readbytes(0, 3) == b'\x05\x00\x0A':
-            self.timestampHeader['valid'] = True
-            self.timestampHeader['header_type'] = 5
-            self.timestampHeader['header_len'] = 10
-            self.timestampHeader['header_offset'] = self.byteOffset
-
-            # CDS P Field
-            pFieldInt = int.from_bytes(self.readbytes(3), byteorder='big')
-            self.timestampHeader['p_field'] = bin(pFieldInt)[2:].zfill(8)
-
-            # Bit 0 - Extension flag, Bits 1-3 - Time code ID, Bits 4-7 - Detail bits
-            pField = [self.timestampHeader['p_field'][0], self.timestampHeader['p_field'][1:4], self.timestampHeader['p_field'][4:8]]
-
-            # Extension flag
-            if pField[0] == "0":
-                self.timestampHeader['p_field_ext_flag'] = "0 (No extension)"
-            else:
-                self.timestampHeader['p_field_ext_flag'] = pField[0] + " (Extended field)"
-
-            # Time code ID
-            if pField[1] == "100":
-                self.timestampHeader['p_field_time_code'] = "100 (1958 January 1 epoch - Level 1 Time Code)"
-            elif pField[1] == "010":
-                self.timestampHeader['p_field_time_code'] = "010 (Agency-defined epoch - Level 2 Time Code)"
-
-            # Detail bits
-            self.timestampHeader['p_field_detail_bits'] = pField[2]
-
-
-            # CDS T Field
-            tFieldInt = int.from_bytes(self.readbytes(4, 6), byteorder='big')
-            self.timestampHeader['t_field'] = bin(tFieldInt)[2:].zfill(48)
-
-            # Bits 0-16 - Days since epoch, Bits 16-48 - Milliseconds of day
-            tField = [int(self.timestampHeader['t_field'][0:16], 2), int(self.timestampHeader['t_field'][16:48], 2)]
-
-            epoch = datetime.strptime("01/01/1958", '%d/%m/%Y')
-            currentDate = epoch + timedelta(days=tField[0])
-            self.timestampHeader['t_field_day_count'] = tField[0]
-            self.timestampHeader['t_field_current_date'] = currentDate.strftime('%d/%m/%Y')
-            self.timestampHeader['t_field_millis'] = tField[1]
-            currentDate += timedelta(milliseconds=self.timestampHeader['t_field_millis'])
-            self.timestampHeader['t_field_current_time'] = currentDate.strftime('%H:%M:%S')
-
-            self.byteOffset += self.timestampHeader['header_len']
-            if printInfo:
-                self.printTimestampHeader()
-        else:
-            self.timestampHeader['valid'] = False
+        self.parseHeader(5, printInfo)
 
     def parseAncillaryTextHeader(self, printInfo=False):
         """
@@ -330,17 +427,7 @@ class COMS:
         :param printInfo: Print info after parsing 
         """
 
-        if self.readbytes == b'\x06':
-            self.ancillaryTextHeader['valid'] = True
-            self.ancillaryTextHeader['header_type'] = 6
-            self.ancillaryTextHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.ancillaryTextHeader['header_offset'] = self.byteOffset
-
-            self.byteOffset += self.ancillaryTextHeader['header_len']
-            # if printInfo:  # Not implemented
-                # self.printAncillaryTextHeader()
-        else:
-            self.ancillaryTextHeader['valid'] = False
+        self.parseHeader(6, printInfo)
 
     def parseKeyHeader(self, printInfo=False):
         """
@@ -348,58 +435,24 @@ class COMS:
         Provides number of encryption key used.
         :param printInfo: Print info after parsing.
         """
-        if self.readbytes(0, 3) == b'\x07\x00\x07':
-            self.keyHeader['valid'] = True
-            self.keyHeader['header_type'] = 7
-            self.keyHeader['header_len'] = 7
-            self.keyHeader['header_offset'] = self.byteOffset
-
-            self.keyHeader['key'] = int.from_bytes(self.readbytes(3, 4), byteorder='big')
 
-            self.byteOffset += self.keyHeader['header_len']
-            if printInfo:
-                self.printKeyHeader()
-        else:
-            self.keyHeader['valid'] = False
+        self.parseHeader(7, printInfo)
 
     def parseImageSegmentationInformationHeader(self, printInfo=False):
         """
         Parses xRIT Image Segmentation Information header (type 128)
         :param printInfo: Print info after parsing.
         """
-        if self.readbytes(0, 3) == b'\x80\x00\x07':
-            self.imageSegmentationInformationHeader['valid'] = True
-            self.imageSegmentationInformationHeader['header_type'] = 128
-            self.imageSegmentationInformationHeader['header_len'] = 7
-            self.imageSegmentationInformationHeader['header_offset'] = self.byteOffset
-
-            self.imageSegmentationInformationHeader['segment_num'] = int.from_bytes(self.readbytes(3), byteorder='big')
-            self.imageSegmentationInformationHeader['segment_total'] = int.from_bytes(self.readbytes(4), byteorder='big')
-            self.imageSegmentationInformationHeader['line_num_of_segment'] = int.from_bytes(self.readbytes(5, 2), byteorder='big')
 
-            self.byteOffset += self.imageSegmentationInformationHeader['header_len']
-            if printInfo:
-                self.printImageSegmentationInformationHeader()
-        else:
-            self.imageSegmentationInformationHeader['valid'] = False
+        self.parseHeader(128, printInfo)
 
     def parseImageCompensationInformationHeader(self, printInfo=False):
         """
         Parses HRIT Image Compensation Information header (type 130)
         :param printInfo: Print info after parsing.
         """
-        if self.readbytes(0) == b'\x82':
-            self.imageCompensationInformationHeader['valid'] = True
-            self.imageCompensationInformationHeader['header_type'] = 130
-            self.imageCompensationInformationHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.imageCompensationInformationHeader['header_offset'] = self.byteOffset
-            self.imageCompensationInformationHeader['data'] = self.readbytes(3, self.imageCompensationInformationHeader['header_len']-3).decode().replace('\n', '\n\t')
 
-            self.byteOffset += self.imageCompensationInformationHeader['header_len']
-            if printInfo:
-                self.printImageCompensationInformationHeader()
-        else:
-            self.imageCompensationInformationHeader['valid'] = False
+        self.parseHeader(130, printInfo)
 
     def parseImageObservationTimeHeader(self, printInfo=False):
         """
@@ -407,19 +460,7 @@ class COMS:
         :param printInfo: Print info after parsing.
         """
 
-        if self.readbytes(0) == b'\x83':
-            self.imageObservationTimeHeader['valid'] = True
-            self.imageObservationTimeHeader['header_type'] = 131
-            self.imageObservationTimeHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.imageObservationTimeHeader['header_offset'] = self.byteOffset
-            self.imageObservationTimeHeader['mjd'] = self.readbytes(3, self.imageObservationTimeHeader['header_len']-3).decode()
-            self.imageObservationTimeHeader['date'] = jd2gcal(2400000.5, float(self.imageObservationTimeHeader['mjd']))
-
-            self.byteOffset += self.imageObservationTimeHeader['header_len']
-            if printInfo:
-                self.printImageObservationTimeHeader()
-        else:
-            self.imageObservationTimeHeader['valid'] = False
+        self.parseHeader(131, printInfo)
 
     def parseImageQualityInformationHeader(self, printInfo=False):
         """
@@ -427,18 +468,62 @@ class COMS:
         :param printInfo: Print info after parsing.
         """
 
-        if self.readbytes(0) == b'\x84':
-            self.imageQualityInformationHeader['valid'] = True
-            self.imageQualityInformationHeader['header_type'] = 132
-            self.imageQualityInformationHeader['header_len'] = int.from_bytes(self.readbytes(1, 2), byteorder='big')
-            self.imageQualityInformationHeader['header_offset'] = self.byteOffset
-            self.imageQualityInformationHeader['quality'] = self.readbytes(3, self.imageQualityInformationHeader['header_len']-3).decode()
+        self.parseHeader(132, printInfo)
+
+
+    # Header decoding methods (text and time fields are decoded lazily, see lazyFields)
+    def decodePrimaryHeader(self, header):
+        raw = header.raw
+        header['file_type'] = raw[3]
+        header['total_header_len'] = int.from_bytes(raw[4:8], byteorder='big')
+        header['data_field_len'] = int.from_bytes(raw[8:16], byteorder='big')
 
-            self.byteOffset += self.imageQualityInformationHeader['header_len']
-            if printInfo:
-                self.printImageQualityInformationHeader()
+    def decodeImageStructureHeader(self, header):
+        raw = header.raw
+        header['bits_per_pixel'] = raw[3:4]  # LRIT = 8 bits, HRIT = 16 bits
+
+        # Detect LRIT/HRIT using bpp
+        if raw[3] == 8:
+            header['is_lrit'] = 1
         else:
-            self.imageQualityInformationHeader['valid'] = False
+            header['is_lrit'] = 0
+
+        header['num_cols'] = int.from_bytes(raw[4:6], byteorder='big')
+        header['num_lines'] = int.from_bytes(raw[6:8], byteorder='big')
+
+        # Image type based on column and line count
+        imageType = self.imageDimensions.get((header['num_cols'], header['num_lines']))
+        if imageType != None:
+            header['image_type'] = imageType
+
+        header['image_compression'] = raw[8]
+
+    def decodeImageNavigationHeader(self, header):
+        raw = header.raw
+
+        # Scaling factors
+        header['col_scaling'] = int.from_bytes(raw[35:39], byteorder='big')
+        header['line_scaling'] = int.from_bytes(raw[39:43], byteorder='big')
+
+        # Offsets
+        header['col_offset'] = int.from_bytes(raw[43:47], byteorder='big')
+        header['line_offset'] = int.from_bytes(raw[47:51], byteorder='big')
+
+    def decodeImageDataFunctionHeader(self, header):
+        header['data_definition_block_filename'] = self.path[:-5] + "_IDF-DDB.txt"
+
+    def decodeKeyHeader(self, header):
+        header['key'] = int.from_bytes(header.raw[3:7], byteorder='big')
+
+    def decodeImageSegmentationInformationHeader(self, header):
+        raw = header.raw
+        header['segment_num'] = raw[3]
+        header['segment_total'] = raw[4]
+        header['line_num_of_segment'] = int.from_bytes(raw[5:7], byteorder='big')
+
+    def decodeLazyHeader(self, header):
+        # All fields decoded on access
+        pass
 
 
     # Header output methods
@@ -693,4 +778,73 @@ class COMS:
             print("ERROR: {0} invalid\n".format(self.headerTypes[132]))
             self.setConsoleColour()
             print("Exiting...")
-            exit(1)
\ No newline at end of file
+            exit(1)
+
+    # Header dispatch table (type: attribute, decoder, print method)
+    headerTable = {}
+    headerTable[0] = ('primaryHeader', decodePrimaryHeader, printPrimaryHeader)
+    headerTable[1] = ('imageStructureHeader', decodeImageStructureHeader, printImageStructureHeader)
+    headerTable[2] = ('imageNavigationHeader', decodeImageNavigationHeader, printImageNavigationHeader)
+    headerTable[3] = ('imageDataFunctionHeader', decodeImageDataFunctionHeader, printImageDataFunctionHeader)
+    headerTable[4] = ('annotationTextHeader', decodeLazyHeader, printAnnotationTextHeader)
+    headerTable[5] = ('timestampHeader', decodeLazyHeader, printTimestampHeader)
+    headerTable[6] = ('ancillaryTextHeader', decodeLazyHeader, None)  # Printing not implemented
+    headerTable[7] = ('keyHeader', decodeKeyHeader, printKeyHeader)
+    headerTable[128] = ('imageSegmentationInformationHeader', decodeImageSegmentationInformationHeader, printImageSegmentationInformationHeader)
+    headerTable[130] = ('imageCompensationInformationHeader', decodeLazyHeader, printImageCompensationInformationHeader)
+    headerTable[131] = ('imageObservationTimeHeader', decodeLazyHeader, printImageObservationTimeHeader)
+    headerTable[132] = ('imageQualityInformationHeader', decodeLazyHeader, printImageQualityInformationHeader)
+
+
+class HeaderIndex:
+    """
+    Persistent on-disk index of parsed xRIT headers.
+    Entries are keyed by file path and are only used while the file size and modification time match.
+    """
+
+    version = 2  # Entry format version
+
+    def __init__(self, path):
+        """
+        Opens header index (created if it does not exist)
+        :param path: Index file path
+        """
+
+        self.path = path
+        self.db = shelve.open(path)
+
+    def get(self, fpath):
+        """
+        Returns list of decoded headers of file, or None if file is not indexed or has changed
+        """
+
+        key = os.path.abspath(fpath)
+        if key not in self.db:
+            return None
+
+        # Ignore entries written in an older format
+        entry = self.db[key]
+        if len(entry) != 4 or entry[0] != self.version:
+            return None
+
+        version, size, mtime, headers = entry
+        stat = os.stat(fpath)
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            return None
+
+        return headers
+
+    def put(self, fpath, headers):
+        """
+        Stores list of decoded headers of file
+        """
+
+        stat = os.stat(fpath)
+        self.db[os.path.abspath(fpath)] = (self.version, stat.st_size, stat.st_mtime_ns, headers)
+
+    def close(self):
+        """
+        Writes index to disk and closes it
+        """
+
+        self.db.close()
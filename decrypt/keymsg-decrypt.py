@@ -7,108 +7,234 @@ Decrypts KMA Encryption Key Message files for COMS-1 xRIT decryption.
 
 import argparse
 import binascii
-import pyDes
+from Crypto.Cipher import DES
+import os
+import sys
+from time import time
+
+# Shared key file format is in repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from keystore import write_keys
 
 argparser = argparse.ArgumentParser(description="Decrypts KMA Encryption Key Message files for COMS-1 xRIT decryption.")
-argparser.add_argument("PATH", action="store", help="Encrypted Key Message file")
-argparser.add_argument("MAC", action="store", help="Ground Station MAC address")
+argparser.add_argument("PATH", action="store", help="Encrypted Key Message file (or folder of files to decrypt in batch)")
+argparser.add_argument("MAC", action="store", nargs="+", help="Ground Station MAC address (several MACs decrypt each file once per MAC)")
 args = argparser.parse_args()
 
 # Define field lengths
 headerLen = 8
 dataLen = 540
 crcLen = 2
+keyCount = 30       # Keys per Key Message
+keyLen = 18         # Bytes per index/key pair
+
+ciphers = {}        # DES cipher objects by MAC
+
+
+def init():
+    # If input is a directory
+    if os.path.isdir(args.PATH):
+        decrypt_folder(args.PATH, args.MAC)
+    else:
+        decrypt_file(args.PATH, args.MAC)
+
+
+def decrypt_file(path, macs):
+    """
+    Decrypts single Key Message file and prints each step.
+    With several MACs the file is decrypted with each one and output files are named after the MAC.
+    """
+
+    print("Loading \"{0}\"...".format(path))
+    print("MAC: {0}\n".format(", ".join(macs)))
+
+    # Open encrypted Key Message file in binary mode
+    kmFile = open(path, mode="rb")
+    kmBytes = kmFile.read()
+    kmFile.close()
+
+    # Split file into fields
+    kmHeader = kmBytes[:headerLen]
+    kmData = kmBytes[headerLen: headerLen + dataLen]
+    kmCRC = kmBytes[-crcLen:]
+
+    # Parse Application Time header
+    kmHeaderHex = kmHeader.hex()
+    appYear = kmHeaderHex[0:4]
+    appMonth = kmHeaderHex[4:6]
+    appDay = kmHeaderHex[6:8]
+    appHour = kmHeaderHex[8:10]
+    appMin = kmHeaderHex[10:12]
+    appSec = str(round(int(kmHeaderHex[12:16])/1000))
+    print("Application Time header: 0x{0} ({1}/{2}/{3} {4}:{5}:{6})\n".format(kmHeader.hex().upper(), appDay, appMonth, appYear, appHour, appMin, appSec.zfill(2)))
+
+    # Compare CRC from file and calculated CRC
+    print("CRC16 Checksum: 0x{0}".format(kmCRC.hex().upper()))
+    crc = get_crc(kmBytes)
+    print("Calculated CRC: 0x{0}".format(hex(crc)[2:].upper()))
+    if check_crc(kmBytes):
+        print("CRC Ok!\n")
+    else:
+        print("CRC Error\n")
+        exit(0)
+
+    # Print encrypted keys
+    indexes, encKeys = split_keys(kmData)
+    print("[Index]: Encrypted Key")
+    for i in range(keyCount):
+        print("[{0}   ]: {1}".format(indexes[i][-1:].hex().upper(), encKeys[i * 16 : (i + 1) * 16].hex().upper()))
+
+    for mac in macs:
+        # Decrypt keys
+        decKeys = decrypt_keys(get_cipher(mac), encKeys)
+        if len(macs) == 1:
+            print("\n[Index]: Decrypted Key")
+        else:
+            print("\n[Index]: Decrypted Key (MAC: {0})".format(mac))
+        for i in range(keyCount):
+            print("[{0}   ]: {1}".format(indexes[i][-1:].hex().upper(), decKeys[i].hex().upper()))
 
-print("Loading \"{0}\"...".format(args.PATH))
-print("MAC: {0}\n".format(args.MAC))
-
-# Open encrypted Key Message file in binary mode
-kmFile = open(args.PATH, mode="rb")
-kmBytes = kmFile.read()
-
-# Split file into fields
-kmHeader = kmBytes[:headerLen]
-kmData = kmBytes[headerLen: headerLen + dataLen]
-kmCRC = kmBytes[-crcLen:]
-
-# Parse Application Time header
-kmHeaderHex = kmHeader.hex()
-appYear = kmHeaderHex[0:4]
-appMonth = kmHeaderHex[4:6]
-appDay = kmHeaderHex[6:8]
-appHour = kmHeaderHex[8:10]
-appMin = kmHeaderHex[10:12]
-appSec = str(round(int(kmHeaderHex[12:16])/1000))
-print("Application Time header: 0x{0} ({1}/{2}/{3} {4}:{5}:{6})\n".format(kmHeader.hex().upper(), appDay, appMonth, appYear, appHour, appMin, appSec.zfill(2)))
-
-# Generate CRC-16/CCITT-FALSE lookup table
-print("CRC16 Checksum: 0x{0}".format(kmCRC.hex().upper()))
-crcTable = []
-poly = 0x1021
-initial = 0xFFFF
-for i in range(256):
-    crc = 0
-    c = i << 8
-
-    for j in range(8):
-        if (crc ^ c) & 0x8000:
-            crc = (crc << 1) ^ poly
+        # Write decrypted Key Message file to disk
+        if len(macs) == 1:
+            decKmFileName = "" + path + ".dec"
         else:
-            crc = crc << 1
+            decKmFileName = "{}_{}.dec".format(path, normalise_mac(mac))
+        print("\nOutput file: {0}".format(decKmFileName))
+        write_keys(decKmFileName, list(zip(indexes, decKeys)))
 
-        c = c << 1
-        crc = crc & 0xFFFF
 
-    crcTable.append(crc)
+def decrypt_folder(folder, macs):
+    """
+    Decrypts every Key Message file in folder.
+    Files with a MAC in their name are decrypted with that MAC, other files are decrypted with every MAC.
+    """
 
-# Print CRC table in hex
-#print('[{}]'.format(', '.join(hex(x) for x in crcTable)))
+    macs = [normalise_mac(m) for m in macs]
 
-# Calculate CRC-16/CCITT-FALSE from encrypted Key Message file
-crcData = kmHeader + kmData
-crc = initial
+    # Find Key Message files
+    files = []
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.endswith(".dec") and not entry.name.endswith(".tmp"):
+            files.append(entry.path)
+    files.sort()
 
-for i in range(len(crcData)):
-    lutPos = ((crc >> 8) ^ crcData[i]) & 0xFFFF
-    crc = ((crc << 8) ^ crcTable[lutPos]) & 0xFFFF
+    if len(files) == 0:
+        print("No Key Message files found")
+        exit(1)
 
-# Compare CRC from file and calculated CRC
-print("Calculated CRC: 0x{0}".format(hex(crc)[2:].upper()))
-if int(crc) == int.from_bytes(kmCRC, byteorder='big'):
-    print("CRC Ok!\n")
-else:
-    print("CRC Error\n")
-    exit(0)
+    print("Decrypting {} Key Message files with {} MACs...".format(len(files), len(macs)))
+    print("-----------------------------------------")
+
+    count = 0
+    errors = 0
+    startTime = time()
+    for path in files:
+        kmFile = open(path, mode="rb")
+        kmBytes = kmFile.read()
+        kmFile.close()
+
+        if len(kmBytes) != headerLen + dataLen + crcLen or not check_crc(kmBytes):
+            print("CRC ERROR: {}".format(path))
+            errors += 1
+            continue
+
+        indexes, encKeys = split_keys(kmBytes[headerLen : headerLen + dataLen])
+
+        # MAC named in file name (EncryptionKeyMessage_AABBCCDDEEFF.bin)
+        name = os.path.basename(path).upper()
+        named = [m for m in macs if m in name]
+
+        for mac in named or macs:
+            decKeys = decrypt_keys(get_cipher(mac), encKeys)
+
+            # Name output after MAC when it is not in the input file name
+            if len(named) > 0 or len(macs) == 1:
+                outPath = path + ".dec"
+            else:
+                outPath = "{}_{}.dec".format(path, mac)
+
+            write_keys(outPath, list(zip(indexes, decKeys)))
+            count += 1
+            print("Decrypted {} ({})".format(outPath, mac))
+
+    elapsed = max(time() - startTime, 1e-6)
+    print("-----------------------------------------")
+    print("\nWrote {} key files ({} keys) from {} Key Messages in {:.3f}s ({} CRC errors)".format(count, count * keyCount, len(files), elapsed, errors))
+    print("  {:.1f} key files/s, {:.0f} keys/s".format(count / elapsed, (count * keyCount) / elapsed))
+
+
+def normalise_mac(mac):
+    """
+    Removes separators from MAC address
+    """
+
+    return mac.replace(":", "").replace("-", "").upper()
+
+
+def get_cipher(mac):
+    """
+    Returns cached DES cipher object for MAC address
+    """
+
+    mac = normalise_mac(mac)
+    cipher = ciphers.get(mac)
+    if cipher == None:
+        # MAC String to binary + two byte padding
+        macBin = binascii.unhexlify(mac) + b'\x00\x00'
+        cipher = DES.new(macBin, DES.MODE_ECB)
+        ciphers[mac] = cipher
 
-# Add encrypted keys to list
-indexes = []
-encKeys = []
-print("[Index]: Encrypted Key")
-
-for i in range(30):     # 30 keys total
-    offset = i*18       # 18 bytes per index/key pair
-    indexes.append(kmData[offset: offset+2])        # Bytes 0-1: Key index
-    encKeys.append(kmData[offset+2:offset+18])      # Bytes 2-17: Encrypted key
-    print("[{0}   ]: {1}".format(indexes[i][-1:].hex().upper(), encKeys[i].hex().upper()))
-
-# Decrypt keys and add to list
-macBin = binascii.unhexlify(args.MAC) + b'\x00\x00'     # MAC String to binary + two byte padding
-decKeys = []
-print("\n[Index]: Decrypted Key")
-
-for i in range(30):
-    decKey = pyDes.des(macBin).decrypt(encKeys[i])
-    decKeys.append(decKey[:8])
-    print("[{0}   ]: {1}".format(indexes[i][-1:].hex().upper(), decKeys[i].hex().upper()))
-
-# Write decrypted Key Message file to disk
-decKmFileName = "" + args.PATH + ".dec"
-print("\nOutput file: {0}".format(decKmFileName))
-decKmFile = open(decKmFileName, mode="wb")
-
-decKmFile.write(b'\x00\x1E')  # Number of keys (30/0x1E, 2 bytes)
-for i in range(30):
-    decKmFile.write(indexes[i])
-    decKmFile.write(decKeys[i])
-
-decKmFile.close()
+    return cipher
+
+
+def get_crc(kmBytes):
+    """
+    Calculates CRC-16/CCITT-FALSE of Key Message header and data fields
+    """
+
+    # binascii.crc_hqx is CRC-16/CCITT-FALSE when seeded with 0xFFFF
+    return binascii.crc_hqx(kmBytes[:headerLen + dataLen], 0xFFFF)
+
+
+def check_crc(kmBytes):
+    """
+    Compares calculated CRC with CRC at end of Key Message
+    """
+
+    return get_crc(kmBytes) == int.from_bytes(kmBytes[-crcLen:], byteorder='big')
+
+
+def split_keys(kmData):
+    """
+    Splits Key Message data field into key indexes and encrypted keys
+    :return: List of 2 byte indexes, encrypted keys joined into one buffer (16 bytes each)
+    """
+
+    indexes = []
+    encKeys = []
+    for i in range(keyCount):
+        offset = i * keyLen
+        indexes.append(kmData[offset: offset + 2])            # Bytes 0-1: Key index
+        encKeys.append(kmData[offset + 2: offset + keyLen])   # Bytes 2-17: Encrypted key
+
+    return indexes, b''.join(encKeys)
+
+
+def decrypt_keys(cipher, encKeys):
+    """
+    Decrypts all keys in one call
+    :param encKeys: Encrypted keys joined into one buffer (16 bytes each)
+    :return: List of 8 byte decrypted keys
+    """
+
+    decBytes = cipher.decrypt(encKeys)
+
+    # Key is first 8 bytes of each decrypted 16 byte block
+    return [decBytes[i : i + 8] for i in range(0, len(decBytes), 16)]
+
+
+try:
+    init()
+except KeyboardInterrupt:
+    print("Exiting...")
+    exit(0)
@@ -6,19 +6,29 @@ Decrypts xRIT file into a plain-text xRIT file using single layer DES
 """
 
 import argparse
-import glob
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import hashlib
+import json
 import os
-from Crypto.Cipher import DES
+import sys
+from time import time
+
+# Shared xRIT file access and key store modules are in repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from keystore import KeyStore
+from xritfile import XRITFile
 
 argparser = argparse.ArgumentParser(description="Decrypts xRIT file into a plain-text xRIT file using single layer DES")
 argparser.add_argument("KEYS", action="store", help="Decrypted key file")
 argparser.add_argument("XRIT", action="store", help="xRIT file (or folder) to decrypt")
+argparser.add_argument("-j", action="store", type=int, help="Number of files to decrypt in parallel", default=os.cpu_count())
+argparser.add_argument("--verify", action="store_true", help="Check SHA-256 of existing output files before skipping them", default=False)
 args = argparser.parse_args()
 
-xritFile = None
-xritBytes = None
 files = []
-keys = {}
+keys = None     # Decryption key store
+verbose = True  # Print progress of each file
+manifestName = ".xrit-decrypt.manifest"     # Folder mode manifest file name
 
 def init():
     # Load key file
@@ -26,95 +36,213 @@ def init():
 
     # If input is a directory
     if os.path.isdir(args.XRIT):
-        # Loop through all .lrit/.hrit files in directory
-        print("Finding xRIT segments...\n")
-
-        # Loop through files with .lrit extension in input folder
-        for f in glob.glob(args.XRIT + "/*.lrit"):
-            files.append(f)
-        
-        # Loop through files with .hrit extension in input folder
-        for f in glob.glob(args.XRIT + "/*.hrit"):
-            files.append(f)
-            print(" - {}".format(f))
-
-        if files.__len__() <= 0:
-            print("No LRIT/HRIT files found")
-            exit(1)
-        
-        # Print file list
-        print("Found {} files: ".format(len(files)))
-        for f in files:
-            print("  {}".format(f))
-        
-        print("\nDecrypting files...")
-        print("-----------------------------------------")
-        for f in files:
-            if os.path.isfile(f + ".dec"):
-                print("Skipping {}\nFile already decrypted\n".format(f))
-            else:
-                load_xrit(f)
-            
-            print("-----------------------------------------")
-
+        failed = decrypt_folder(args.XRIT)
         print("\nFinished decryption\nExiting...")
-        exit(0)
+        exit(1 if failed > 0 else 0)
 
     else:
         # Load and decrypt single file
         load_xrit(args.XRIT)
 
 
-def load_keys(kpath):
+def decrypt_folder(folder):
     """
-    Load and parse key file
+    Decrypts all xRIT files in folder across a worker pool.
+    Completed files are recorded in a manifest so interrupted runs can be resumed.
+    :return: Number of files that could not be decrypted
     """
+
+    global verbose
+
+    print("Finding xRIT segments...\n")
+
+    # Scan directory once for sources and existing outputs
+    stats = {}
+    outputs = {}
+    for entry in os.scandir(folder):
+        if entry.name.endswith(".lrit") or entry.name.endswith(".hrit"):
+            stat = entry.stat()
+            files.append(entry.path)
+            stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        elif entry.name.endswith(".dec"):
+            outputs[entry.name] = entry.stat().st_size
+    files.sort()
+
+    if files.__len__() <= 0:
+        print("No LRIT/HRIT files found")
+        exit(1)
     
-    print("Loading decryption keys...")
+    # Print file list
+    print("Found {} files: ".format(len(files)))
+    for f in files:
+        print("  {}".format(f))
+
+    # Skip files that are in the manifest and unchanged, and whose output file matches the manifest
+    manifestPath = os.path.join(folder, manifestName)
+    manifest = load_manifest(manifestPath)
+    pending = []
+    for f in files:
+        name = os.path.basename(f)
+        entry = manifest.get(name)
+        if entry != None and (entry['size'], entry['mtime']) == stats[f]:
+            # Unencrypted files have no output
+            if not entry.get('encrypted', True):
+                continue
+
+            if outputs.get(name + ".dec") == entry.get('outsize'):
+                if not args.verify or get_sha256(f + ".dec") == entry['sha256']:
+                    continue
+        pending.append(f)
+
+    print("\nDecrypting {} files with {} workers ({} already decrypted)...".format(len(pending), args.j, len(files) - len(pending)))
+    print("-----------------------------------------")
+
+    # Decrypt files across worker pool (DES and hashing release the GIL)
+    verbose = False
+    count = 0
+    total = 0
+    skipped = 0
+    failed = 0
+    startTime = time()
+    manifestFile = open(manifestPath, 'a')
+    with ThreadPoolExecutor(max_workers=max(args.j, 1)) as pool:
+        jobs = {}
+        for f in pending:
+            jobs[pool.submit(load_xrit, f)] = f
+
+        for job in as_completed(jobs):
+            f = jobs[job]
+            try:
+                result = job.result()
+            except Exception as e:
+                print("FAILED TO DECRYPT {}: {}".format(f, e))
+                failed += 1
+                continue
+
+            # Record completed file
+            entry = {}
+            entry['file'] = os.path.basename(f)
+            entry['size'], entry['mtime'] = stats[f]
+            if result == None:
+                entry['encrypted'] = False
+            else:
+                length, outsize, digest = result
+                entry['outsize'] = outsize
+                entry['sha256'] = digest
+            manifest[entry['file']] = entry
+            manifestFile.write(json.dumps(entry) + "\n")
+            manifestFile.flush()
+
+            if result == None:
+                skipped += 1
+                print("Skipped {} (not encrypted)".format(f))
+            else:
+                count += 1
+                total += length
+                print("Decrypted {}".format(f))
+    manifestFile.close()
+    elapsed = max(time() - startTime, 1e-6)
+    print("-----------------------------------------")
 
-    p = os.path.abspath(kpath)
-    f = open(p, 'rb')
-    fbytes = f.read()
+    # Compact manifest to one entry per file
+    with open(manifestPath + ".tmp", 'w') as f:
+        for name in sorted(manifest):
+            f.write(json.dumps(manifest[name]) + "\n")
+    os.replace(manifestPath + ".tmp", manifestPath)
 
-    # Parse key count
-    count = int.from_bytes(fbytes[:2], byteorder='big')
+    print("\nDecrypted {} files ({:.2f} MB) in {:.2f}s".format(count, total / 1e6, elapsed))
+    print("  {:.2f} files/s, {:.2f} MB/s".format(count / elapsed, total / 1e6 / elapsed))
+    if skipped > 0 or failed > 0:
+        print("  {} not encrypted, {} failed".format(skipped, failed))
 
-    # Parse keys
-    for i in range(count):
-        offset = (i * 10) + 2
-        index = fbytes[offset : offset + 2]
-        key = fbytes[offset + 2 : offset + 10]
+    return failed
 
-        '''
-        i = hex(int.from_bytes(index, byteorder='big')).upper()[2:]
-        k = hex(int.from_bytes(key, byteorder='big')).upper()[2:]
-        print("{}: {}".format(i, k))
-        '''
 
-        # Add key to dictionary
-        keys[index] = key
+def get_sha256(path):
+    """
+    Returns SHA-256 of file
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def load_manifest(mpath):
+    """
+    Loads manifest of decrypted files (last entry for each file is used)
+    """
+
+    manifest = {}
+    if not os.path.isfile(mpath):
+        return manifest
+
+    with open(mpath) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partially written entry from an interrupted run
+                continue
+            manifest[entry['file']] = entry
+
+    return manifest
+
+
+def load_keys(kpath):
+    """
+    Load and parse key file
+    """
+
+    global keys
+
+    print("Loading decryption keys...")
+    try:
+        keys = KeyStore(os.path.abspath(kpath))
+    except FileNotFoundError:
+        print("KEY FILE NOT FOUND: {}\nExiting...".format(os.path.abspath(kpath)))
+        exit(1)
+    except (OSError, ValueError) as e:
+        print("ERROR LOADING KEY FILE: {}\nExiting...".format(e))
+        exit(1)
 
 
 def load_xrit(fpath):
     """
     Loads xRIT file from disk
+    :return: Number of bytes decrypted, output file size, SHA-256 of output file (None if file is not encrypted)
     """
 
-    print("\nLoading xRIT file \"{}\"...".format(fpath))
+    log("\nLoading xRIT file \"{}\"...".format(fpath))
+
+    # Map file and decrypt directly from the mapping
+    with XRITFile(fpath) as xritFile:
+        headerField, dataField = parse_primary_header(xritFile.view)
+        index = parse_key_header(headerField)
+        if index != 0:
+            digest = decrypt(headerField, dataField, fpath, index)
+            length = len(dataField)
+            outsize = len(headerField) + length
+
+        del headerField
+        del dataField
 
-    xritFile = open(fpath, 'rb')
-    xritBytes = xritFile.read()
-    xritFile.close()
+    if index == 0:
+        log("File is not encrypted")
+        return None
 
-    parse_primary_header(xritBytes, fpath)
+    return length, outsize, digest
 
 
-def parse_primary_header(data, fpath):
+def parse_primary_header(data):
     """
     Parses xRIT primary header to get field lengths
     """
 
-    print("Parsing xRIT primary header...")
+    log("Parsing xRIT primary header...")
 
     primaryHeader = data[:16]
 
@@ -125,59 +253,84 @@ def parse_primary_header(data, fpath):
     TOTAL_HEADER_LEN = get_bits_int(primaryHeader, 32, 32, 128)        # Total xRIT Header Length
     DATA_LEN = get_bits_int(primaryHeader, 64, 64, 128)                # Data Field Length
 
-    print("  Header Length: {} bits ({} bytes)".format(TOTAL_HEADER_LEN, TOTAL_HEADER_LEN/8))
-    print("  Data Length: {} bits ({} bytes)".format(DATA_LEN, DATA_LEN/8))
+    log("  Header Length: {} bits ({} bytes)".format(TOTAL_HEADER_LEN, TOTAL_HEADER_LEN/8))
+    log("  Data Length: {} bits ({} bytes)".format(DATA_LEN, DATA_LEN/8))
 
     headerField = data[:TOTAL_HEADER_LEN]
     dataField = data[TOTAL_HEADER_LEN: TOTAL_HEADER_LEN + DATA_LEN]
 
-    # Append null bytes to data field to fill last 8 byte DES block
-    dFMod8 = len(dataField) % 8
-    if dFMod8 != 0:
-        for i in range(dFMod8):
-            dataField += b'x00'
-        print("\nAdded {} null bytes to fill last DES block\n".format(dFMod8))
+    return headerField, dataField
 
-    parse_key_header(headerField, dataField, fpath)
 
-
-def parse_key_header(headerField, dataField, fpath):
+def parse_key_header(headerField):
     """
     Parses xRIT key header to get key index
+    :return: Integer key index (0 if file is not encrypted)
     """
 
-    print("Parsing xRIT key header...")
-
-    # Loop through headers until Key header (type 7)
-    offset = 0
-    nextHeader = int.from_bytes(headerField[offset : offset + 1], byteorder='big')
+    log("Parsing xRIT key header...")
 
-    while nextHeader != 7:
-        offset += int.from_bytes(headerField[offset + 1 : offset + 3], byteorder='big')
-        nextHeader = int.from_bytes(headerField[offset : offset + 1], byteorder='big')
-        
-    # Parse Key header (type 7)
-    keyHLen = int.from_bytes(headerField[offset + 1 : offset + 3], byteorder='big')
-    index = headerField[offset + 5 : offset + keyHLen]
-    indexStr = hex(int.from_bytes(index, byteorder='big')).upper()[2:]
-    key = keys[index]
+    # Key header offset is reused for files with the same header layout
+    index = keys.find_index(headerField, len(headerField), headerField[3])
+    if index == None:
+        log("  No Key header")
+        return 0
 
-    print("  Key Index: {}".format(indexStr))
+    log("  Key Index: {}".format(hex(index).upper()[2:]))
 
-    decrypt(headerField, dataField, fpath, key)
+    return index
 
 
-def decrypt(headers, data, fpath, key):
-    print("Decrypting...")
+def decrypt(headers, data, fpath, index):
+    """
+    Decrypts data field and writes plain-text xRIT file
+    :return: SHA-256 of output file
+    """
 
-    decoder = DES.new(key,DES.MODE_ECB)
-    decData = decoder.decrypt(data)
+    log("Decrypting...")
+
+    # Precomputed cipher object for key index
+    entry = keys.get(index)
+    if entry == None:
+        raise KeyError("UNKNOWN KEY INDEX {}".format(hex(index).upper()[2:]))
+    key, cipher = entry
+    headerLen = len(headers)
+    length = len(data)
+    blocks = length - (length % 8)
+
+    # Output buffer for plain-text file
+    out = bytearray(headerLen + length)
+    view = memoryview(out)
+    view[:headerLen] = headers
+
+    # Decrypt whole blocks straight from mapped file into output buffer
+    cipher.decrypt(data[:blocks], output=view[headerLen : headerLen + blocks])
+
+    # Fill last 8 byte DES block with null bytes
+    if blocks != length:
+        pad = 8 - (length - blocks)
+        last = cipher.decrypt(bytes(data[blocks:]) + bytes(pad))
+        view[headerLen + blocks:] = last[:length - blocks]
+        log("\nAdded {} null bytes to fill last DES block\n".format(pad))
+    view.release()
     
-    decFile = open(fpath + ".dec", 'wb')
-    decFile.write(headers)
-    decFile.write(decData)
+    # Write to temporary file and rename so interrupted runs never leave a truncated output
+    decFile = open(fpath + ".dec.tmp", 'wb')
+    decFile.write(out)
     decFile.close()
-    print("Output file: {}".format(fpath + ".dec"))
+    os.replace(fpath + ".dec.tmp", fpath + ".dec")
+    log("Output file: {}".format(fpath + ".dec"))
+
+    return hashlib.sha256(out).hexdigest()
+
+
+def log(msg):
+    """
+    Prints progress message when decrypting a single file
+    """
+
+    if verbose:
+        print(msg)
 
 
 def get_bits(data, start, length, count):
@@ -5,11 +5,69 @@ https://github.com/sam210723/COMS-1
 Parsing and assembly functions for all CCSDS protocol layers
 """
 
-from Crypto.Cipher import DES
-from tools import get_bits, get_bits_int
+from keystore import decrypt, find_key_header
+from logs import log
+import tables
+from tables import Seq
+from tools import Buffer, Layout
 import os
 
 
+# Precompiled header layouts (bit offset, bit length)
+VCDU_HEADER = Layout(6, [
+    (0, 2),         # Virtual Channel Version
+    (2, 8),         # Spacecraft ID
+    (10, 6),        # Virtual Channel ID
+    (16, 24),       # VCDU Counter
+    (40, 1),        # Replay Flag
+    (41, 7)         # Spare (always b0000000)
+])
+
+M_PDU_HEADER = Layout(2, [
+    (5, 11)         # First Pointer Header
+])
+
+CP_PDU_HEADER = Layout(6, [
+    (0, 3),         # Version (always b000)
+    (3, 1),         # Type (always b0)
+    (4, 1),         # Secondary Header Flag
+    (5, 11),        # Application Process ID
+    (16, 2),        # Sequence Flag
+    (18, 14),       # Packet Sequence Counter
+    (32, 16)        # Packet Length
+])
+
+TP_FILE_HEADER = Layout(10, [
+    (0, 16),        # File Counter
+    (16, 64)        # File Length (bits)
+])
+
+PRIMARY_HEADER = Layout(16, [
+    (0, 8),         # Header Type (always 0x00)
+    (8, 16),        # Header Length (always 0x10)
+    (24, 8),        # File Type
+    (32, 32),       # Total xRIT Header Length
+    (64, 64)        # Data Field Length
+])
+
+IMAGE_STRUCTURE_HEADER = Layout(9, [
+    (0, 8),         # Header Type (always 0x01)
+    (8, 16),        # Header Length (always 0x09)
+    (24, 8),        # Bits per Pixel
+    (32, 16),       # Number of Columns
+    (48, 16),       # Number of Lines
+    (64, 8)         # Compression Flag
+])
+
+IMAGE_SEGMENT_HEADER = Layout(7, [
+    (0, 8),         # Header Type (always 0x80)
+    (8, 16),        # Header Length (always 0x07)
+    (24, 8),        # Segment Sequence Number
+    (32, 8),        # Total Number of Segments
+    (40, 16)        # Line Number of Image Segment
+])
+
+
 class VCDU:
     """
     Parses CCSDS Virtual Channel Data Unit (VCDU)
@@ -24,66 +82,36 @@ class VCDU:
         Parse VCDU header fields
         """
 
-        header = self.data[:6]
-
         # Header fields
-        self.VER = get_bits_int(header, 0, 2, 48)           # Virtual Channel Version
-        self.SCID = get_bits_int(header, 2, 8, 48)          # Spacecraft ID
-        self.VCID = get_bits_int(header, 10, 6, 48)         # Virtual Channel ID
-        self.COUNTER = get_bits_int(header, 16, 24, 48)     # VCDU Counter
-        self.REPLAY = get_bits_int(header, 40, 1, 48)       # Replay Flag
-        self.SPARE = get_bits_int(header, 41, 7, 48)        # Spare (always b0000000)
+        self.VER, self.SCID, self.VCID, self.COUNTER, self.REPLAY, self.SPARE = VCDU_HEADER.unpack(self.data)
 
         # Spacecraft and virtual channel names
-        self.SC = self.get_SC(self.SCID)
-        self.VC = self.get_VC(self.VCID)
+        self.SC = tables.spacecraft[self.SCID]
+        self.VC = tables.channels[self.VCID]
 
         # M_PDU contained in VCDU
-        self.MPDU = self.data[6:]
+        self.MPDU = memoryview(self.data)[6:]
     
     def get_SC(self, scid):
         """
         Get name of spacecraft by ID
         """
 
-        scname = {}
-        scname[195] = "COMS-1"
-
-        try:
-            return scname[scid]
-        except KeyError:
-            return None
+        return tables.spacecraft[scid]
     
     def get_VC(self, vcid):
         """
         Get name of Virtual Channel by ID
         """
-        vcname = {}
-        vcname[0] = "VIS"
-        vcname[1] = "SWIR"
-        vcname[2] = "WV"
-        vcname[3] = "IR1"
-        vcname[4] = "IR2"
-        vcname[5] = "ANT"
-        vcname[6] = "ENC"
-        vcname[7] = "CMDPS"
-        vcname[8] = "NWP"
-        vcname[9] = "GOCI"
-        vcname[10] = "BINARY"
-        vcname[11] = "TYPHOON"
-        vcname[63] = "FILL"
-
-        try:
-            return vcname[vcid]
-        except KeyError:
-            return None
+
+        return tables.channels[vcid]
 
     def print_info(self):
         """
-        Prints information about the current VCDU to the console
+        Logs information about the current VCDU
         """
 
-        print("\n[VCID] {} {}: {}".format(self.SC, self.VCID, self.VC))
+        log.info("\n[VCID] %s %s: %s", self.SC, self.VCID, self.VC)
 
 
 class M_PDU:
@@ -100,11 +128,8 @@ class M_PDU:
         Parse M_PDU header fields
         """
 
-        header = self.data[:2]
-
         # Header fields
-        #self.SPARE = get_bits(header, 0, 5, 16)            # Spare Field (always b00000)
-        self.POINTER = get_bits_int(header, 5, 11, 16)      # First Pointer Header
+        self.POINTER, = M_PDU_HEADER.unpack(self.data)
 
         # Detect if M_PDU contains CP_PDU header
         if self.POINTER != 2047:  # 0x07FF
@@ -112,17 +137,17 @@ class M_PDU:
         else:
             self.HEADER = False
         
-        self.PACKET = self.data[2:]
+        self.PACKET = self.data[2:]         # Zero-copy when data is a memoryview
     
     def print_info(self):
         """
-        Prints information about the current M_PDU to the console
+        Logs information about the current M_PDU
         """
 
         if self.HEADER:
-            print("    [M_PDU] HEADER: 0x{}".format(hex(self.POINTER)[2:].upper()))
+            log.debug("    [M_PDU] HEADER: 0x%X", self.POINTER)
         else:
-            print("    [M_PDU]")
+            log.debug("    [M_PDU]")
 
 
 class CP_PDU:
@@ -130,9 +155,17 @@ class CP_PDU:
     Parses and assembles CCSDS Path Protocol Data Unit (CP_PDU)
     """
 
-    def __init__(self, data):
+    def __init__(self, data, crc):
+        """
+        :param data: CP_PDU bytes from start of header
+        :param crc: CRC16 engine
+        """
+
         self.data = data
         self.PAYLOAD = None
+        self.engine = crc           # CRC engine
+        self.crc = crc.initial      # Running CRC of payload
+        self.crcpos = 0             # Number of payload bytes added to running CRC
         self.parse()
     
     def parse(self):
@@ -140,32 +173,48 @@ class CP_PDU:
         Parse CP_PDU header fields
         """
 
-        header = self.data[:6]
-
         # Header fields
-        self.VER = get_bits(header, 0, 3, 48)                   # Version (always b000)
-        self.TYPE = get_bits(header, 3, 1, 48)                  # Type (always b0)
-        self.SHF = get_bits(header, 4, 1, 48)                   # Secondary Header Flag
-        self.APID = get_bits_int(header, 5, 11, 48)             # Application Process ID
-        self.SEQ = get_bits_int(header, 16, 2, 48)              # Sequence Flag
-        self.COUNTER = get_bits_int(header, 18, 14, 48)         # Packet Sequence Counter
-        self.LENGTH = get_bits_int(header, 32, 16, 48) + 1      # Packet Length
-
-        # Parse sequence flag
-        seqn = ["CONTINUE", "FIRST", "LAST", "SINGLE"]
-        self.SEQ = seqn[self.SEQ]
-
-        # Add post-header data to payload
-        self.PAYLOAD = self.data[6:]
-    
+        self.VER, self.TYPE, self.SHF, self.APID, self.SEQ, self.COUNTER, self.LENGTH = CP_PDU_HEADER.unpack(self.data)
+        self.LENGTH += 1
+
+        # Add post-header data to payload buffer
+        self.PAYLOAD = Buffer(self.LENGTH, self.data[6:])
+
+        # Keep a copy of the header only so the source VCDU is not held while the CP_PDU spans later VCDUs
+        self.data = bytes(self.data[:6])
+
     def append(self, data):
         """
-        Append data to CP_PDU payload
+        Append data to CP_PDU payload and update running CRC
+        """
+
+        self.PAYLOAD.write(data)
+
+        # Last two bytes of payload are the transmitted CRC
+        end = len(self.PAYLOAD) - 2
+        if end > self.crcpos:
+            self.crc = self.engine.update(self.PAYLOAD.getview(self.crcpos, end), self.crc)
+            self.crcpos = end
+    
+    def truncate(self, length):
+        """
+        Remove trailing data (M_PDU padding) from CP_PDU payload
+        """
+
+        self.PAYLOAD.truncate(length)
+
+        # Running CRC excludes the last two bytes (transmitted CRC)
+        self.crcpos = max(0, len(self.PAYLOAD) - 2)
+        self.crc = self.engine.update(self.PAYLOAD.getview(0, self.crcpos), self.engine.initial)
+
+    def get_data(self):
+        """
+        Returns zero-copy view of CP_PDU payload without trailing CRC
         """
 
-        self.PAYLOAD += data
+        return self.PAYLOAD.getview(0, -2)
 
-    def finish(self, data, crclut):
+    def finish(self, data):
         """
         Finish CP_PDU by checking length and CRC 
         """
@@ -181,7 +230,7 @@ class CP_PDU:
             lenok = True
         
         # Check payload CRC against expected CRC
-        if not self.CRC(crclut):
+        if not self.CRC():
             crcok = False
         else:
             crcok = True
@@ -199,38 +248,30 @@ class CP_PDU:
             Length: 1
         """
 
-        if self.COUNTER == 0 and self.APID == 0 and self.LENGTH == 1 and self.SEQ == "CONTINUE":
+        if self.COUNTER == 0 and self.APID == 0 and self.LENGTH == 1 and self.SEQ == Seq.CONTINUE:
             return True
         else:
             return False
     
-    def CRC(self, lut):
+    def CRC(self):
         """
-        Calculate CRC-16/CCITT-FALSE 
+        Check CRC-16/CCITT-FALSE of finished payload
         """
 
-        initial = 0xFFFF
-        crc = initial
-        data = self.PAYLOAD[:-2]
-        txCRC = self.PAYLOAD[-2:]
-
-        # Calculate CRC
-        for i in range(len(data)):
-            lutPos = ((crc >> 8) ^ data[i]) & 0xFFFF
-            crc = ((crc << 8) ^ lut[lutPos]) & 0xFFFF
+        txCRC = self.PAYLOAD.getview(-2)
 
         # Compare CRC from CP_PDU and calculated CRC
-        if int(crc) == int.from_bytes(txCRC, byteorder='big'):
+        if self.crc == int.from_bytes(txCRC, byteorder='big'):
             return True
         else:
             return False
 
     def print_info(self):
         """
-        Prints information about the current CP_PDU to the console
+        Logs information about the current CP_PDU
         """
 
-        print("  [CP_PDU] APID: {}   SEQ: {}   #{}   LEN: {}".format(self.APID, self.SEQ, self.COUNTER, self.LENGTH))
+        log.debug("  [CP_PDU] APID: %s   SEQ: %s   #%s   LEN: %s", self.APID, tables.seqNames[self.SEQ], self.COUNTER, self.LENGTH)
 
 
 class TP_File:
@@ -248,21 +289,26 @@ class TP_File:
         Parse TP_File header fields
         """
 
-        header = self.data[:10]
-
         # Header fields
-        self.COUNTER = get_bits_int(header, 0, 16, 80)                # File Counter
-        self.LENGTH = int(get_bits_int(header, 16, 64, 80)/8)         # File Length
+        self.COUNTER, self.LENGTH = TP_FILE_HEADER.unpack(self.data)
+        self.LENGTH //= 8
 
-        # Add post-header data to payload
-        self.PAYLOAD = self.data[10:]
+        # Add post-header data to payload buffer
+        self.PAYLOAD = Buffer(self.LENGTH, self.data[10:])
     
     def append(self, data):
         """
         Append data to TP_File payload
         """
 
-        self.PAYLOAD += data
+        self.PAYLOAD.write(data)
+    
+    def get_data(self):
+        """
+        Passes ownership of finished TP_File payload to caller without copying
+        """
+
+        return self.PAYLOAD.detach()
 
     def finish(self, data):
         """
@@ -283,7 +329,7 @@ class TP_File:
     
     def print_info(self):
         """
-        Prints information about the current TP_File to the console
+        Logs information about the current TP_File
         """
 
         # Get image band based on file counter
@@ -308,7 +354,7 @@ class TP_File:
         
         countType = " ({}, SEGMENT: {})".format(band, num)
 
-        print("  [TP_File] COUNTER: {}{}   LENGTH: {}".format(self.COUNTER, countType, self.LENGTH))
+        log.debug("  [TP_File] COUNTER: %s%s   LENGTH: %s", self.COUNTER, countType, self.LENGTH)
 
 
 class S_PDU:
@@ -316,16 +362,17 @@ class S_PDU:
     Decrypts CCSDS Session Protocol Data Unit (S_PDU)
     """
 
-    def __init__(self, data, k):
+    def __init__(self, data, keystore):
         self.data = data
-        self.keys = k
+        self.keystore = keystore
+        self.index = None
         self.key = None
-        self.headerField = None
-        self.dataField = None
+        self.cipher = None
+        self.headerLen = None
         self.PLAINTEXT = None
 
         # Check keys have been loaded
-        if self.keys != {}:
+        if self.keystore != None and len(self.keystore) > 0:
             self.parse()
 
             # Check encryption is applied to file
@@ -341,58 +388,35 @@ class S_PDU:
         Parses xRIT primary and key headers
         """
         
-        primaryHeader = self.data[:16]
-
         # Header fields
-        HEADER_TYPE = get_bits_int(primaryHeader, 0, 8, 128)               # File Counter (always 0x00)
-        HEADER_LEN = get_bits_int(primaryHeader, 8, 16, 128)               # Header Length (always 0x10)
-        FILE_TYPE = get_bits_int(primaryHeader, 24, 8, 128)                # File Type
-        TOTAL_HEADER_LEN = get_bits_int(primaryHeader, 32, 32, 128)        # Total xRIT Header Length
-        DATA_LEN = get_bits_int(primaryHeader, 64, 64, 128)                # Data Field Length
-
-        #print("  Header Length: {} bits ({} bytes)".format(TOTAL_HEADER_LEN, TOTAL_HEADER_LEN/8))
-        #print("  Data Length: {} bits ({} bytes)".format(DATA_LEN, DATA_LEN/8))
-
-        self.headerField = self.data[:TOTAL_HEADER_LEN]
-        self.dataField = self.data[TOTAL_HEADER_LEN: TOTAL_HEADER_LEN + DATA_LEN]
-        
-        # Loop through headers until Key header (type 7)
-        offset = 0
-        nextHeader = int.from_bytes(self.headerField[offset : offset + 1], byteorder='big')
-
-        while nextHeader != 7:
-            offset += int.from_bytes(self.headerField[offset + 1 : offset + 3], byteorder='big')
-            nextHeader = int.from_bytes(self.headerField[offset : offset + 1], byteorder='big')
+        HEADER_TYPE, HEADER_LEN, FILE_TYPE, TOTAL_HEADER_LEN, DATA_LEN = PRIMARY_HEADER.unpack(self.data)
+        self.headerLen = TOTAL_HEADER_LEN
 
-        # Parse Key header (type 7)
-        keyHLen = int.from_bytes(self.headerField[offset + 1 : offset + 3], byteorder='big')
-        index = self.headerField[offset + 5 : offset + keyHLen]
+        # Key header (type 7), files without one are not encrypted
+        self.index = self.keystore.find_index(self.data, TOTAL_HEADER_LEN, FILE_TYPE)
+        if self.index == None:
+            self.index = 0
 
         # Catch wrong key index
-        try:
-            self.key = self.keys[index]
-        except KeyError:
-            if index != b'\x00\x00': print("  UNKNOWN ENCRYPTION KEY INDEX")
+        entry = self.keystore.get(self.index)
+        if entry != None:
+            self.key, self.cipher = entry
+        else:
             self.key = 0
-        
-        # Check block length if encryption is applied
-        if self.key != 0:
-            # Append null bytes to data field to fill last 8 byte DES block
-            dFMod8 = len(self.dataField) % 8
-            if dFMod8 != 0:
-                for i in range(dFMod8):
-                    self.dataField += b'x00'
-                #print("  Added {} null bytes to fill last DES block".format(dFMod8))
+            if self.index != 0:
+                log.warning("  UNKNOWN ENCRYPTION KEY INDEX")
 
     def decrypt(self):
         """
-        Decrypts S_PDU data field into a plain text xRIT file
+        Decrypts S_PDU data field in place into a plain text xRIT file
         """
 
-        decoder = DES.new(self.key, DES.MODE_ECB)
-        decData = decoder.decrypt(self.dataField)
+        # Reassembled files are already mutable, other data is copied once
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
 
-        self.PLAINTEXT = self.headerField + decData
+        decrypt(self.cipher, self.data, self.headerLen)
+        self.PLAINTEXT = self.data
 
 
 class xRIT:
@@ -409,31 +433,11 @@ class xRIT:
         Parse xRIT headers
         """
 
-        primaryHeader = self.data[:16]
-
         # Header fields
-        self.HEADER_TYPE = get_bits_int(primaryHeader, 0, 8, 128)               # File Counter (always 0x00)
-        self.HEADER_LEN = get_bits_int(primaryHeader, 8, 16, 128)               # Header Length (always 0x10)
-        self.FILE_TYPE = get_bits_int(primaryHeader, 24, 8, 128)                # File Type
-        self.TOTAL_HEADER_LEN = get_bits_int(primaryHeader, 32, 32, 128)        # Total xRIT Header Length
-        self.DATA_LEN = get_bits_int(primaryHeader, 64, 64, 128)                # Data Field Length
-
-        if self.FILE_TYPE == 0:
-            self.FILE_TYPE = "Image Data"
-        elif self.FILE_TYPE == 1:
-            self.FILE_TYPE = "GTS Message"
-        elif self.FILE_TYPE == 2:
-            self.FILE_TYPE = "Alphanumeric Text"
-        elif self.FILE_TYPE == 3:
-            self.FILE_TYPE = "Encryption Key Message"
-        elif self.FILE_TYPE == 128:
-            self.FILE_TYPE = "CMDPS Analysis Data"
-        elif self.FILE_TYPE == 129:
-            self.FILE_TYPE = "NWP Data"
-        elif self.FILE_TYPE == 130:
-            self.FILE_TYPE = "GOCI Data"
-        elif self.FILE_TYPE == 131:
-            self.FILE_TYPE = "Typhoon Info"
+        self.HEADER_TYPE, self.HEADER_LEN, self.FILE_TYPE, self.TOTAL_HEADER_LEN, self.DATA_LEN = PRIMARY_HEADER.unpack(self.data)
+
+        # File type name (None for unknown types)
+        self.FILE_TYPE_NAME = tables.fileTypeNames.get(self.FILE_TYPE)
 
         # Loop through headers until Annotation Text header (type 4)
         offset = self.HEADER_LEN
@@ -445,7 +449,7 @@ class xRIT:
         
         # Parse Annotation Text header (type 4)
         athLen = self.get_header_len(offset)
-        self.FILE_NAME = self.data[offset + 3 : offset + athLen].decode('utf-8')
+        self.FILE_NAME = bytes(self.data[offset + 3 : offset + athLen]).decode('utf-8')
     
     def get_next_header(self, offset):
         """
@@ -459,9 +463,38 @@ class xRIT:
         """
         return int.from_bytes(self.data[offset + 1 : offset + 3], byteorder='big')
     
+    def find_header(self, htype):
+        """
+        Returns offset of first header of given type (None if file has no such header)
+        """
+
+        offset = 0
+        while offset + 3 <= self.TOTAL_HEADER_LEN:
+            if self.get_next_header(offset) == htype:
+                return offset
+
+            length = self.get_header_len(offset)
+            if length == 0:
+                return None
+            offset += length
+
+        return None
+
+    def get_key_index(self):
+        """
+        Returns encryption key index from Key header (0 if file is not encrypted).
+        Reads the same field as KeyStore.find_index() so both agree on whether a file is encrypted.
+        """
+
+        offset = find_key_header(self.data, self.TOTAL_HEADER_LEN)
+        if offset == None:
+            return 0
+
+        return int.from_bytes(self.data[offset + 5 : offset + self.get_header_len(offset)], byteorder='big')
+
     def get_save_path(self, root):
         """
-        Parses xRIT file name
+        Parses xRIT file name into output path (<root>/<date>/<observation mode>/<file name>)
         """
 
         # Split file name into components
@@ -485,27 +518,39 @@ class xRIT:
             segNum = fnameSplit[5][:2]
             fExt = self.FILE_NAME.split(".")[1]
 
-        # Check output directories exist
-        if not os.path.exists("{}/{}".format(root, txDate)): os.mkdir(root + "/" + txDate)
-        if not os.path.exists("{}/{}/{}".format(root, txDate, obMode)): os.mkdir(root + "/" + txDate + "/" + obMode)
-
         path = "/{}/{}/".format(txDate, obMode)
         return root + path + self.FILE_NAME
 
-    def save(self, root):
+    def save(self, root, writer=None, callback=None):
         """
         Saves xRIT file to disk
+        :param root: Output path root
+        :param writer: Background file writer (None writes on the calling thread)
+        :param callback: Function to call once file has been saved
         """
 
-        # Save file to disk
         outPath = self.get_save_path(root)
+
+        # Hand file to background writer
+        if writer != None:
+            writer.write(outPath, self.data, callback)
+            return
+
+        # Check output directories exist
+        outDir = os.path.dirname(outPath)
+        if not os.path.exists(outDir): os.makedirs(outDir)
+
+        # Save file to disk
         outFile = open(outPath, mode="wb")
         outFile.write(self.data)
         outFile.close()
 
+        if callback != None:
+            callback()
+
     def print_info(self):
         """
-        Prints information about the current xRIT file to the console
+        Logs information about the current xRIT file
         """
 
-        print("  [NEW FILE] {}".format(self.FILE_NAME))
+        log.info("  [NEW FILE] %s", self.FILE_NAME)
@@ -4,36 +4,90 @@ https://github.com/sam210723/COMS-1
 """
 
 import ccsds as CCSDS
-from collections import deque
-from time import sleep
-from threading import Thread
-from tools import CCITT_LUT
+from functools import partial
+import logs
+from logs import log
+from metrics import Metrics
+import tables
+from tables import FileType, Seq, VCID
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+from tools import BoundedQueue, CRC16
 
 class Demuxer:
     """
     Coordinates demultiplexing of CCSDS virtual channels into xRIT files.
     """
 
-    def __init__(self, downlink, v, d, output, k):
+    def __init__(self, downlink, v, d, output, k, qlen=8192, workers=0, writer=None, metrics=None, assembler=None):
         """
         Initialises demuxer class
+        :param downlink: Downlink type (LRIT/HRIT)
+        :param v: Verbose output flag
+        :param d: VCDU dump file path
+        :param output: xRIT file output path root
+        :param k: Decryption key store
+        :param qlen: Receive queue high-water mark in VCDUs
+        :param workers: Number of channel worker threads (0 handles all channels on the core thread)
+        :param writer: Background file writer (None saves files on the demuxer threads)
+        :param metrics: Metrics store (None creates one that is not exposed)
+        :param assembler: Live image assembler (None disables image assembly)
         """
         
         # Configure instance globals
-        self.rxq = deque()              # Data receive queue
+        self.rxq = BoundedQueue(qlen)   # Data receive queue
         self.coreReady = False          # Core thread ready state
         self.coreStop = False           # Core thread stop flag
         self.verbose = v                # Verbose output flag
         self.dumpPath = d               # VCDU dump file path
         self.outputPath = output        # xRIT file output path root
-        self.keys = k                   # Decryption keys
+        self.keystore = k               # Decryption key store
         self.channelHandlers = {}       # List of channel handlers
         self.vcduCounter = -1           # VCDU continuity counter
+        self.downlink = downlink        # Downlink type (LRIT/HRIT)
+        self.crc = CRC16()              # CP_PDU CRC engine
+        self.workers = workers          # Number of channel worker threads
+        self.workerQueues = []          # Channel worker VCDU queues
+        self.finishq = None             # Completed file queue
+        self.writer = writer            # Background file writer
+        self.lastVCID = None            # Last VCID seen
+        self.dumpFile = None            # VCDU dump file
+        self.metrics = metrics          # Metrics store
+        self.assembler = assembler      # Live image assembler
+
+        # Register gauges
+        if self.metrics == None:
+            self.metrics = Metrics()
+        self.metrics.gauge('receive_queue_depth', lambda: len(self.rxq))
+        self.metrics.gauge('receive_queue_dropped', lambda: self.rxq.dropped)
+        if self.writer != None:
+            self.metrics.gauge('writer_queue_bytes', lambda: self.writer.queuedBytes)
+
+        # Open VCDU dump file
+        if self.dumpPath != None:
+            self.dumpFile = open(self.dumpPath, 'wb+')
+
+        # Queue-to-file latency (from last VCDU of a file entering the queue to file being saved)
+        self.latencyLock = Lock()
+        self.latencyCount = 0
+        self.latencyTotal = 0
+        self.latencyMax = 0
+
+        # Start channel worker and file finishing threads
+        if self.workers > 0:
+            self.finishq = BoundedQueue(self.workers * 2)
 
-        if downlink == "LRIT":
-            self.coreWait = 54          # Core loop delay in ms for LRIT (108.8ms per packet @ 64 kbps)
-        elif downlink == "HRIT":
-            self.coreWait = 1           # Core loop delay in ms for HRIT (2.2ms per packet @ 3 Mbps)
+            for i in range(self.workers):
+                q = BoundedQueue(qlen)
+                self.workerQueues.append(q)
+
+                worker_thread = Thread(target=self.channel_worker, args=(q,))
+                worker_thread.name = "CHANNEL WORKER {}".format(i)
+                worker_thread.start()
+
+                finish_thread = Thread(target=self.file_finisher)
+                finish_thread.name = "FILE FINISHER {}".format(i)
+                finish_thread.start()
 
         # Start core demuxer thread
         demux_thread = Thread()
@@ -49,69 +103,146 @@ class Demuxer:
         # Indicate core thread has initialised
         self.coreReady = True
 
-        # Thread globals
-        lastVCID = None             # Last VCID seen
-        crclut = CCITT_LUT()        # CP_PDU CRC LUT
-
-        # Open VCDU dump file
-        dumpFile = None
-        if self.dumpPath != None:
-            dumpFile = open(self.dumpPath, 'wb+')
-
         # Thread loop
         while not self.coreStop:
-            # Pull next packet from queue
-            packet = self.pull()
-            
-            # If queue is not empty
-            if packet != None:
-                # Parse VCDU
-                vcdu = CCSDS.VCDU(packet)
-
-                # Dump raw VCDU to file
-                if dumpFile != None and vcdu.VCID != 63:
-                    dumpFile.write(packet)
-
-                # Check spacecraft is supported
-                if vcdu.SC != "COMS-1":
-                    if self.verbose: print("SPACECRAFT \"{}\" NOT SUPPORTED".format(vcdu.SCID))
-                    continue
-
-                # Check VCDU continuity counter
-                self.continuity(vcdu)
-
-                # Check for VCID change
-                if lastVCID != vcdu.VCID:
-                    if self.verbose: print()
-                    vcdu.print_info()
-                    lastVCID = vcdu.VCID
-
-                # Discard fill packets
-                if vcdu.VCID == 63:
-                    continue
-                
-                # Check channel handler for current VCID exists
-                try:
-                    self.channelHandlers[vcdu.VCID]
-                except KeyError:
-                    # Create new channel handler instance
-                    self.channelHandlers[vcdu.VCID] = Channel(vcdu.VCID, self.verbose, crclut, self.outputPath, self.keys)
-                    if self.verbose: print("  CREATED NEW CHANNEL HANDLER\n")
-
-                # Pass VCDU to appropriate channel handler
-                self.channelHandlers[vcdu.VCID].data_in(vcdu)
-                
-            else:
-                # No packet available, sleep thread
-                sleep(self.coreWait / 1000)
+            # Wait for next packet from queue
+            item = self.rxq.pull()
+
+            # Queue closed
+            if item == None:
+                break
+
+            rxtime, packet = item
+
+            try:
+                self.process(packet, rxtime)
+            except Exception as e:
+                log.error("  ERROR HANDLING VCDU\n  %s", e)
+            finally:
+                # Mark packet as processed
+                self.rxq.done()
         
         # Gracefully exit core thread
-        if self.coreStop:
-            if dumpFile != None:
-                dumpFile.close()
-            
+        if self.dumpFile != None:
+            self.dumpFile.close()
+
+    def process(self, packet, rxtime=None):
+        """
+        Parses VCDU and passes it to its channel handler.
+        Called by the core thread for queued VCDUs, or directly when replaying a file (do not mix both).
+        :param packet: 892 byte Virtual Channel Data Unit (VCDU)
+        :param rxtime: Time VCDU was received (None uses current time)
+        """
+
+        if rxtime == None:
+            rxtime = monotonic()
+
+        # Parse VCDU
+        vcdu = CCSDS.VCDU(packet)
+        self.metrics.inc('vcdus_total', (("vcid", vcdu.VCID),))
+        if logs.tracer != None: logs.tracer.write('VCDU', (vcdu.SCID, vcdu.VCID, vcdu.COUNTER, vcdu.REPLAY))
+
+        # Dump raw VCDU to file
+        if self.dumpFile != None and vcdu.VCID != VCID.FILL:
+            self.dumpFile.write(packet)
+
+        # Check spacecraft is supported
+        if tables.spacecraft[vcdu.SCID] == None:
+            if self.verbose: log.debug("SPACECRAFT \"%s\" NOT SUPPORTED", vcdu.SCID)
             return
 
+        # Check VCDU continuity counter
+        self.continuity(vcdu)
+
+        # Check for VCID change
+        if self.lastVCID != vcdu.VCID:
+            if self.verbose: log.debug("")
+            vcdu.print_info()
+            self.lastVCID = vcdu.VCID
+
+        # Discard fill packets
+        if vcdu.VCID == VCID.FILL:
+            return
+
+        if self.workers > 0:
+            # Shard channels across workers by VCID (keeps per-channel ordering)
+            self.workerQueues[vcdu.VCID % self.workers].push((rxtime, vcdu))
+        else:
+            self.channel_in(vcdu, rxtime)
+
+    def channel_in(self, vcdu, rxtime):
+        """
+        Passes VCDU to the channel handler for its VCID
+        """
+
+        # Check channel handler for current VCID exists
+        try:
+            self.channelHandlers[vcdu.VCID]
+        except KeyError:
+            # Create new channel handler instance
+            self.channelHandlers[vcdu.VCID] = Channel(vcdu.VCID, self.verbose, self.crc, self.outputPath, self.keystore, self.finishq, self.file_saved, self.writer, self.metrics, self.assembler)
+            if self.verbose: log.debug("  CREATED NEW CHANNEL HANDLER\n")
+
+        # Pass VCDU to appropriate channel handler
+        self.channelHandlers[vcdu.VCID].data_in(vcdu, rxtime)
+
+    def channel_worker(self, q):
+        """
+        Handles VCDUs for a subset of virtual channels on a worker thread
+        :param q: Worker VCDU queue
+        """
+
+        while not self.coreStop:
+            item = q.pull()
+
+            # Queue closed
+            if item == None:
+                break
+
+            # Errors must not stop the worker, other VCIDs share this thread
+            rxtime, vcdu = item
+            try:
+                self.channel_in(vcdu, rxtime)
+            except Exception as e:
+                log.error("  ERROR HANDLING VCDU (VCID: %s)\n  %s", vcdu.VCID, e)
+            finally:
+                q.done()
+
+    def file_finisher(self):
+        """
+        Decrypts and saves completed files on a finishing thread
+        """
+
+        while not self.coreStop:
+            item = self.finishq.pull()
+
+            # Queue closed
+            if item == None:
+                break
+
+            channel, data, rxtime = item
+            try:
+                channel.finish_file(data, rxtime)
+            except Exception as e:
+                log.error("  ERROR FINISHING FILE (VCID: %s)\n  %s", channel.VCID, e)
+            finally:
+                self.finishq.done()
+
+    def file_saved(self, rxtime):
+        """
+        Records queue-to-file latency of a saved file
+        :param rxtime: Time last VCDU of the file entered the receive queue
+        """
+
+        latency = monotonic() - rxtime
+
+        with self.latencyLock:
+            self.latencyCount += 1
+            self.latencyTotal += latency
+            self.latencyMax = max(self.latencyMax, latency)
+
+        self.metrics.observe('file_latency_seconds', latency)
+
     def continuity(self, vcdu):
         """
         Checks VCDU packet continuity by comparing packet counters
@@ -126,49 +257,127 @@ class Demuxer:
             
             diff = vcdu.COUNTER - self.vcduCounter - 1
             if diff != 0:
+                self.metrics.inc('vcdus_lost_total', value=diff)
                 if self.verbose:
-                    print("  DROPPED {} PACKETS    (CURRENT: {}   LAST: {}   VCID: {})".format(diff, vcdu.COUNTER, self.vcduCounter, vcdu.VCID))
+                    log.warning("  DROPPED %s PACKETS    (CURRENT: %s   LAST: %s   VCID: %s)", diff, vcdu.COUNTER, self.vcduCounter, vcdu.VCID)
                 else:
-                    print("  DROPPED {} PACKETS".format(diff))
+                    log.warning("  DROPPED %s PACKETS", diff)
         
         self.vcduCounter = vcdu.COUNTER
 
-    def push(self, packet):
+    def push(self, packet, timeout=None):
         """
-        Takes in VCDUs for the demuxer to process
+        Takes in VCDUs for the demuxer to process.
+        Blocks while the receive queue is full.
         :param packet: 892 byte Virtual Channel Data Unit (VCDU)
+        :param timeout: Seconds to wait for queue space before dropping packet (None waits indefinitely)
+        :return: True if packet was queued, False if it was dropped
         """
 
-        self.rxq.append(packet)
+        return self.rxq.push((monotonic(), packet), timeout)
 
-    def pull(self):
+    def push_many(self, packets, timeout=None):
         """
-        Pull data from receive queue
+        Takes in a batch of VCDUs for the demuxer to process.
+        Blocks while the receive queue is full.
+        :param packets: List of 892 byte Virtual Channel Data Units (VCDUs)
+        :param timeout: Seconds to wait for queue space before dropping remaining packets (None waits indefinitely)
+        :return: Number of packets queued
         """
 
-        try:
-            # Return top item
-            return self.rxq.popleft()
-        except IndexError:
-            # Queue empty
-            return None
+        rxtime = monotonic()
+        return self.rxq.push_many([(rxtime, p) for p in packets], timeout)
 
     def complete(self):
         """
-        Checks if receive queue is empty
+        Checks if all received packets have been processed
         """
 
-        if len(self.rxq) == 0:
-            return True
-        else:
+        queues = [self.rxq] + self.workerQueues
+        if self.finishq != None:
+            queues.append(self.finishq)
+
+        for q in queues:
+            if len(q) != 0 or q.pending != 0:
+                return False
+
+        if self.assembler != None and (len(self.assembler.queue) != 0 or self.assembler.queue.pending != 0):
             return False
 
+        if self.writer != None and (len(self.writer.queue) != 0 or len(self.writer.batch) != 0):
+            return False
+
+        return True
+
+    def wait(self):
+        """
+        Blocks until all received packets have been processed
+        """
+
+        # Each stage is idle only once the stage before it has handed on all of its items
+        self.rxq.wait()
+        for q in self.workerQueues:
+            q.wait()
+        if self.finishq != None:
+            self.finishq.wait()
+        if self.assembler != None:
+            self.assembler.wait()
+        if self.writer != None:
+            self.writer.wait()
+
+    def stats(self):
+        """
+        Returns receive queue and latency statistics
+        """
+
+        stats = {}
+        stats['queue_len'] = len(self.rxq)
+        stats['queue_max'] = self.rxq.maxlen
+        stats['queue_peak'] = self.rxq.peak
+        stats['dropped'] = self.rxq.dropped
+        stats['files'] = self.latencyCount
+
+        if self.latencyCount > 0:
+            stats['latency_mean'] = self.latencyTotal / self.latencyCount
+        else:
+            stats['latency_mean'] = 0
+        stats['latency_max'] = self.latencyMax
+
+        return stats
+
+    def print_stats(self):
+        """
+        Logs receive queue and latency statistics
+        """
+
+        stats = self.stats()
+        log.info("QUEUE:            {} / {} VCDUs (PEAK: {}, DROPPED: {})".format(stats['queue_len'], stats['queue_max'], stats['queue_peak'], stats['dropped']))
+        log.info("FILE LATENCY:     {:.1f} ms mean, {:.1f} ms max ({} files)".format(stats['latency_mean'] * 1000, stats['latency_max'] * 1000, stats['files']))
+
+        if self.writer != None:
+            ws = self.writer.stats()
+            mb = 1024 * 1024
+            log.info("WRITER:           {} files queued, {:.1f} MB (PEAK: {} files, {:.1f} MB)".format(ws['queue_files'], ws['queue_bytes'] / mb, ws['peak_files'], ws['peak_bytes'] / mb))
+            log.info("WRITE LATENCY:    {:.1f} ms mean, {:.1f} ms max ({} files, {:.1f} MB)".format(ws['latency_mean'] * 1000, ws['latency_max'] * 1000, ws['files'], ws['bytes'] / mb))
+
     def stop(self):
         """
-        Stops the demuxer loop by setting thread stop flag
+        Stops the demuxer loop by setting thread stop flag and closing receive queue
         """
 
         self.coreStop = True
+        self.rxq.close()
+
+        for q in self.workerQueues:
+            q.close()
+        if self.finishq != None:
+            self.finishq.close()
+        if self.assembler != None:
+            # Saves incomplete images through the writer before it is closed
+            self.assembler.close()
+        if self.writer != None:
+            self.writer.close()
+        self.metrics.stop()
 
 
 class Channel:
@@ -176,33 +385,50 @@ class Channel:
     Virtual channel data handler
     """
 
-    def __init__(self, vcid, v, crclut, output, k):
+    def __init__(self, vcid, v, crc, output, keystore, finishq=None, finished=None, writer=None, metrics=None, assembler=None):
         """
         Initialises virtual channel data handler
         :param vcid: Virtual Channel ID
         :param v: Verbose output flag
-        :param crclut: CP_PDU CRC LUT
+        :param crc: CP_PDU CRC engine
         :param output: xRIT file output path root
-        :param k: Decryption keys
+        :param keystore: Decryption key store
+        :param finishq: Completed file queue (None finishes files on the calling thread)
+        :param finished: Callback for saved files, called with the receive time of the file's last VCDU
+        :param writer: Background file writer (None saves files on the calling thread)
+        :param metrics: Metrics store (None creates one that is not exposed)
+        :param assembler: Live image assembler (None disables image assembly)
         """
 
         self.VCID = vcid            # VCID for this handler
         self.verbose = v            # Verbose output flag
-        self.crclut = crclut        # CP_PDU CRC LUT
+        self.crc = crc              # CP_PDU CRC engine
         self.outputPath = output    # xRIT file output path root
-        self.keys = k               # Decryption keys
+        self.keystore = keystore    # Decryption key store
         self.cCPPDU = None          # Current CP_PDU object
         self.cTPFile = None         # Current TP_File object
+        self.finishq = finishq      # Completed file queue
+        self.finished = finished    # Saved file callback
+        self.writer = writer        # Background file writer
+        self.metrics = metrics      # Metrics store
+        self.assembler = assembler  # Live image assembler
+        self.labels = (("vcid", vcid),)
 
+        if self.metrics == None:
+            self.metrics = Metrics()
 
-    def data_in(self, vcdu):
+    def data_in(self, vcdu, rxtime=None):
         """
         Takes in VCDUs for the channel handler to process
         :param packet: Parsed VCDU object
+        :param rxtime: Time VCDU entered the receive queue
         """
 
+        start = perf_counter()
+
         # Parse M_PDU
         mpdu = CCSDS.M_PDU(vcdu.MPDU)
+        if logs.tracer != None: logs.tracer.write('M_PDU', (self.VCID, mpdu.POINTER))
 
         # If M_PDU contains CP_PDU header
         if mpdu.HEADER:
@@ -212,53 +438,56 @@ class Channel:
                 preptr = mpdu.PACKET[:mpdu.POINTER]
 
                 try:
-                    lenok, crcok = self.cCPPDU.finish(preptr, self.crclut)
-                    if self.verbose: self.check_CPPDU(lenok, crcok)
+                    lenok, crcok = self.cCPPDU.finish(preptr)
+                    self.check_CPPDU(lenok, crcok)
 
                     # Handle finished CP_PDU
-                    self.handle_CPPDU(self.cCPPDU)
+                    self.handle_CPPDU(self.cCPPDU, rxtime)
                 except AttributeError:
-                    if self.verbose: print("  NO CP_PDU TO FINISH (DROPPED PACKETS?)")
+                    if self.verbose: log.debug("  NO CP_PDU TO FINISH (DROPPED PACKETS?)")
 
                 #TODO: Check CP_PDU continuity
 
                 # Create new CP_PDU
                 postptr = mpdu.PACKET[mpdu.POINTER:]
-                self.cCPPDU = CCSDS.CP_PDU(postptr)
+                self.cCPPDU = CCSDS.CP_PDU(postptr, self.crc)
 
                 # Handle CP_PDUs less than one M_PDU in length
                 if 1 < self.cCPPDU.LENGTH < 886 and len(self.cCPPDU.PAYLOAD) > self.cCPPDU.LENGTH:
                     # Remove trailing null bytes (M_PDU padding)
-                    self.cCPPDU.PAYLOAD = self.cCPPDU.PAYLOAD[:self.cCPPDU.LENGTH]
+                    self.cCPPDU.truncate(self.cCPPDU.LENGTH)
                     
                     try:
-                        lenok, crcok = self.cCPPDU.finish(b'', self.crclut)
-                        if self.verbose: self.check_CPPDU(lenok, crcok)
+                        lenok, crcok = self.cCPPDU.finish(b'')
+                        self.check_CPPDU(lenok, crcok)
 
                         # Handle finished CP_PDU
-                        self.handle_CPPDU(self.cCPPDU)
+                        self.handle_CPPDU(self.cCPPDU, rxtime)
                     except AttributeError:
-                        if self.verbose: print("  NO CP_PDU TO FINISH (DROPPED PACKETS?)")
+                        if self.verbose: log.debug("  NO CP_PDU TO FINISH (DROPPED PACKETS?)")
 
             else:
                 # First CP_PDU in TP_File
                 # Create new CP_PDU
-                self.cCPPDU = CCSDS.CP_PDU(mpdu.PACKET)
+                self.cCPPDU = CCSDS.CP_PDU(mpdu.PACKET, self.crc)
 
             # Handle special EOF CP_PDU
             if self.cCPPDU.is_EOF():
                 self.cCPPDU = None
-                if self.verbose: print("  [CP_PDU] EOF MARKER")
+                if self.verbose: log.debug("  [CP_PDU] EOF MARKER")
             else:
                 if self.verbose:
                     self.cCPPDU.print_info()
-                    print("    HEADER:     0x{}".format(hex(mpdu.POINTER)[2:].upper()))
+                    log.debug("    HEADER:     0x%X", mpdu.POINTER)
         else:
             # Append packet to current CP_PDU
             try:
                 self.cCPPDU.append(mpdu.PACKET)
             except AttributeError:
-                if self.verbose: print("  NO CP_PDU TO APPEND M_PDU TO (DROPPED PACKETS?)")
+                if self.verbose: log.debug("  NO CP_PDU TO APPEND M_PDU TO (DROPPED PACKETS?)")
+
+        # Time includes CP_PDUs and files finished by this VCDU
+        self.metrics.observe('stage_seconds', perf_counter() - start, (("stage", "data_in"),))
 
     
     def check_CPPDU(self, lenok, crcok):
@@ -266,56 +495,109 @@ class Channel:
         Checks length and CRC of finished CP_PDU
         """
 
+        if logs.tracer != None:
+            c = self.cCPPDU
+            logs.tracer.write('CP_PDU', (self.VCID, c.APID, c.SEQ, c.COUNTER, c.LENGTH, lenok, crcok))
+
+        # Count errors
+        if not lenok:
+            self.metrics.inc('cppdu_length_errors_total', self.labels)
+        if not crcok:
+            self.metrics.inc('cppdu_crc_errors_total', self.labels)
+
+        if not self.verbose:
+            return
+
         # Show length error
         if lenok:
-            print("    LENGTH:     OK")
+            log.debug("    LENGTH:     OK")
         else:
             ex = self.cCPPDU.LENGTH
             ac = len(self.cCPPDU.PAYLOAD)
             diff = ac - ex
-            print("    LENGTH:     ERROR (EXPECTED: {}, ACTUAL: {}, DIFF: {})".format(ex, ac, diff))
+            log.debug("    LENGTH:     ERROR (EXPECTED: %s, ACTUAL: %s, DIFF: %s)", ex, ac, diff)
 
         # Show CRC error
         if crcok:
-            print("    CRC:        OK")
+            log.debug("    CRC:        OK")
         else:
-            print("    CRC:        ERROR")
-        print()
+            log.debug("    CRC:        ERROR")
+        log.debug("")
 
 
-    def handle_CPPDU(self, cppdu):
+    def handle_CPPDU(self, cppdu, rxtime=None):
         """
         Processes complete CP_PDUs to build a TP_File
         """
 
-        if cppdu.SEQ == "FIRST":
+        start = perf_counter()
+
+        # CP_PDU payload without CRC
+        data = cppdu.get_data()
+
+        if cppdu.SEQ == Seq.FIRST:
             # Create new TP_File
-            self.cTPFile = CCSDS.TP_File(cppdu.PAYLOAD[:-2])
+            self.cTPFile = CCSDS.TP_File(data)
 
-        elif cppdu.SEQ == "CONTINUE":
+        elif cppdu.SEQ == Seq.CONTINUE:
             # Add data to TP_File
-            self.cTPFile.append(cppdu.PAYLOAD[:-2])
+            self.cTPFile.append(data)
 
-        elif cppdu.SEQ == "LAST":
+        elif cppdu.SEQ == Seq.LAST:
             # Close current TP_File
-            lenok = self.cTPFile.finish(cppdu.PAYLOAD[:-2])
+            lenok = self.cTPFile.finish(data)
+            if logs.tracer != None: logs.tracer.write('TP_File', (self.VCID, self.cTPFile.COUNTER, self.cTPFile.LENGTH, lenok))
 
             if self.verbose: self.cTPFile.print_info()
             if lenok:
-                if self.verbose: print("    LENGTH:     OK\n")
-                
-                # Handle S_PDU (decryption)
-                spdu = CCSDS.S_PDU(self.cTPFile.PAYLOAD, self.keys)
+                if self.verbose: log.debug("    LENGTH:     OK\n")
 
-                # Create new xRIT file
-                xrit = CCSDS.xRIT(spdu.PLAINTEXT)
-                xrit.save(self.outputPath)
-                xrit.print_info()
+                # Decrypt and save file
+                data = self.cTPFile.get_data()
+                if self.finishq != None:
+                    self.finishq.push((self, data, rxtime))
+                else:
+                    self.finish_file(data, rxtime)
 
             elif not lenok:
                 ex = self.cTPFile.LENGTH
                 ac = len(self.cTPFile.PAYLOAD)
                 diff = ac - ex
 
-                if self.verbose: print("    LENGTH:     ERROR (EXPECTED: {}, ACTUAL: {}, DIFF: {})".format(ex, ac, diff))
-                print("  SKIPPING FILE (DROPPED PACKETS?)")
+                if self.verbose: log.debug("    LENGTH:     ERROR (EXPECTED: %s, ACTUAL: %s, DIFF: %s)", ex, ac, diff)
+                log.warning("  SKIPPING FILE (DROPPED PACKETS?)")
+                self.metrics.inc('tpfile_length_errors_total', self.labels)
+
+        self.metrics.observe('stage_seconds', perf_counter() - start, (("stage", "handle_CPPDU"),))
+
+    def finish_file(self, data, rxtime=None):
+        """
+        Decrypts completed TP_File payload and saves it as an xRIT file
+        :param data: TP_File payload
+        :param rxtime: Time last VCDU of the file entered the receive queue
+        """
+
+        start = perf_counter()
+
+        # Handle S_PDU (decryption)
+        spdu = CCSDS.S_PDU(data, self.keystore)
+
+        # Create new xRIT file
+        xrit = CCSDS.xRIT(spdu.PLAINTEXT)
+        if logs.tracer != None: logs.tracer.write('xRIT', (self.VCID, xrit.FILE_TYPE, xrit.FILE_NAME))
+
+        # Record latency once file is on disk
+        callback = None
+        if self.finished != None and rxtime != None:
+            callback = partial(self.finished, rxtime)
+
+        xrit.save(self.outputPath, self.writer, callback)
+        xrit.print_info()
+
+        # Assemble image segments that are not encrypted (or have been decrypted)
+        if self.assembler != None and xrit.FILE_TYPE == FileType.IMAGE:
+            if spdu.key not in (None, 0) or xrit.get_key_index() == 0:
+                self.assembler.push(xrit, rxtime)
+
+        self.metrics.inc('files_total', self.labels)
+        self.metrics.observe('stage_seconds', perf_counter() - start, (("stage", "finish_file"),))
@@ -0,0 +1,353 @@
+"""
+images.py
+https://github.com/sam210723/COMS-1
+
+Live image assembly from demultiplexed IMG xRIT files
+"""
+
+import ccsds as CCSDS
+import io
+from logs import log
+import numpy as np
+import os
+from PIL import Image
+from tools import BoundedQueue
+from threading import Thread
+from time import monotonic, perf_counter
+
+
+# PIL format names and save options by output file extension
+formats = {}
+formats['png'] = ("PNG", {'compress_level': 1})
+formats['jpg'] = ("JPEG", {'quality': 95})
+formats['bmp'] = ("BMP", {})
+
+# Preview image options
+previewFormat = ("JPEG", {'quality': 80})
+
+# Largest canvas allocated for an image (HRIT full disk is 11000 x 11000)
+maxPixels = 16384 * 16384
+
+
+class Canvas:
+    """
+    Single band image being assembled from segments
+    """
+
+    def __init__(self, name, path, cols, lines, total):
+        """
+        :param name: Image name (segment file name without segment number)
+        :param path: Output path without extension
+        :param cols: Image width in pixels
+        :param lines: Lines per segment
+        :param total: Total number of segments
+        """
+
+        if cols * lines * total > maxPixels:
+            raise ValueError("IMAGE TOO LARGE ({} x {} LINES x {} SEGMENTS)".format(cols, lines, total))
+
+        self.name = name                                            # Image name
+        self.path = path                                            # Output path without extension
+        self.total = total                                          # Total number of segments
+        self.pixels = np.zeros((lines * total, cols), np.uint8)     # 8-bit image lines
+        self.height = 0                                             # Lines up to end of lowest segment
+        self.segments = set()                                       # Segment numbers received
+        self.updated = monotonic()                                  # Time last segment was placed
+
+    def place(self, seg, row, pixels):
+        """
+        Copies decoded segment lines into canvas
+        :param seg: Segment sequence number
+        :param row: First line of segment (0-based)
+        :param pixels: 8-bit segment lines
+        """
+
+        # Grow canvas if segments are taller than the first segment received
+        rows = pixels.shape[0]
+        if row + rows > self.pixels.shape[0]:
+            if (row + rows) * self.pixels.shape[1] > maxPixels:
+                raise ValueError("SEGMENT {} OUTSIDE IMAGE (LINE {})".format(seg, row + 1))
+
+            grown = np.zeros((row + rows, self.pixels.shape[1]), np.uint8)
+            grown[:self.pixels.shape[0]] = self.pixels
+            self.pixels = grown
+
+        cols = min(pixels.shape[1], self.pixels.shape[1])
+        self.pixels[row : row + rows, :cols] = pixels[:, :cols]
+
+        self.height = max(self.height, row + rows)
+        self.segments.add(seg)
+        self.updated = monotonic()
+
+    def complete(self):
+        """
+        Checks if every segment has been received
+        """
+
+        return len(self.segments) >= self.total
+
+    def image(self):
+        """
+        Returns canvas as PIL image (shares canvas memory)
+        """
+
+        height = self.height if self.complete() else self.pixels.shape[0]
+        return Image.fromarray(self.pixels[:height])
+
+
+class Assembler:
+    """
+    Decodes IMG xRIT segments as they are demultiplexed and assembles them into images on a background thread.
+
+    A preview of each image is saved after every segment and the final image is saved once all segments have
+    arrived, so imagery is available while the pass is still being received.
+    """
+
+    def __init__(self, root, fmt="png", preview=True, timeout=900, writer=None, metrics=None, qlen=64, qtimeout=1):
+        """
+        Initialises assembler and starts assembler thread
+        :param root: Output path root (images are saved next to their segments)
+        :param fmt: Final image format (key of formats)
+        :param preview: Save preview image after each segment
+        :param timeout: Seconds without a new segment before an incomplete image is saved
+        :param writer: Background file writer (None saves images on the assembler thread)
+        :param metrics: Metrics store (None disables image metrics)
+        :param qlen: Maximum number of segments waiting to be decoded
+        :param qtimeout: Seconds to wait for queue space before skipping a segment
+        """
+
+        self.root = root                # Output path root
+        self.fmt = fmt                  # Final image format
+        self.preview = preview          # Preview image flag
+        self.timeout = timeout          # Incomplete image timeout
+        self.writer = writer            # Background file writer
+        self.metrics = metrics          # Metrics store
+        self.queue = BoundedQueue(qlen) # Segments waiting to be decoded
+        self.qtimeout = qtimeout        # Queue timeout
+        self.canvases = {}              # Images being assembled by name
+
+        # Start assembler thread
+        self.thread = Thread()
+        self.thread.name = "IMAGE ASSEMBLER"
+        self.thread.run = self.assembler_core
+        self.thread.start()
+
+    def push(self, xrit, rxtime=None):
+        """
+        Queues IMG xRIT file for assembly
+        :param xrit: Parsed plain text xRIT file
+        :param rxtime: Time last VCDU of the file entered the receive queue
+        :return: True if segment was queued, False if it was skipped
+        """
+
+        if self.queue.push((xrit, rxtime), self.qtimeout):
+            return True
+
+        log.warning("  IMAGE ASSEMBLER BUSY, SKIPPING SEGMENT")
+        return False
+
+    def assembler_core(self):
+        """
+        Decodes queued segments into their images
+        """
+
+        while True:
+            item = self.queue.pull()
+
+            # Queue closed
+            if item == None:
+                break
+
+            # Corrupt segments must not stop the assembler thread
+            xrit, rxtime = item
+            try:
+                self.handle(xrit, rxtime)
+            except Exception as e:
+                log.error("  ERROR ASSEMBLING IMAGE FROM \"%s\"\n  %s", xrit.FILE_NAME, e)
+                self.count('image_errors_total')
+            finally:
+                self.queue.done()
+
+        # Save images that are still incomplete
+        for name in list(self.canvases):
+            try:
+                self.finish(self.canvases.pop(name))
+            except Exception as e:
+                log.error("  ERROR SAVING IMAGE \"%s\"\n  %s", name, e)
+                self.count('image_errors_total')
+
+    def handle(self, xrit, rxtime):
+        """
+        Decodes segment and places it on its image canvas
+        """
+
+        start = perf_counter()
+
+        info = get_segment_info(xrit)
+        if info == None:
+            log.debug("  [IMAGE] NO SEGMENT INFORMATION IN \"%s\"", xrit.FILE_NAME)
+            return
+        name, bpp, cols, lines, seg, total, row = info
+
+        # Decode before creating a canvas so undecodable segments do not leave empty images
+        data = memoryview(xrit.data)[xrit.TOTAL_HEADER_LEN : xrit.TOTAL_HEADER_LEN + ((xrit.DATA_LEN + 7) // 8)]
+        pixels = decode_segment(data, bpp, cols, lines)
+
+        canvas = self.canvases.get(name)
+        if canvas == None:
+            path = os.path.join(os.path.dirname(xrit.get_save_path(self.root)), name)
+            canvas = Canvas(name, path, cols, lines, total)
+            self.canvases[name] = canvas
+        canvas.place(seg, row, pixels)
+
+        log.info("  [IMAGE] %s (%s/%s SEGMENTS)", name, len(canvas.segments), canvas.total)
+        self.count('image_segments_total')
+
+        if canvas.complete():
+            del self.canvases[name]
+            self.finish(canvas, rxtime)
+        elif self.preview:
+            self.save(canvas.path + "_preview.jpg", canvas.image(), previewFormat, rxtime)
+
+        # Save images abandoned part way through
+        now = monotonic()
+        for old in [c for c in self.canvases.values() if now - c.updated > self.timeout]:
+            del self.canvases[old.name]
+            self.finish(old)
+
+        if self.metrics != None:
+            self.metrics.observe('stage_seconds', perf_counter() - start, (("stage", "assemble_image"),))
+
+    def finish(self, canvas, rxtime=None):
+        """
+        Saves final image and removes its preview
+        """
+
+        state = "complete" if canvas.complete() else "incomplete"
+        preview = canvas.path + "_preview.jpg"
+
+        def remove_preview():
+            try:
+                os.remove(preview)
+            except OSError:
+                pass
+
+        path = canvas.path + "." + self.fmt
+        self.save(path, canvas.image(), formats[self.fmt], rxtime, remove_preview if self.preview else None)
+        self.count('images_total', (("state", state),))
+
+        if state == "complete":
+            log.info("  [IMAGE] SAVED %s", os.path.basename(path))
+        else:
+            log.warning("  [IMAGE] SAVED INCOMPLETE %s (%s/%s SEGMENTS)", os.path.basename(path), len(canvas.segments), canvas.total)
+
+    def save(self, path, img, fmt, rxtime=None, callback=None):
+        """
+        Encodes image and writes it to disk
+        :param fmt: PIL format name and save options
+        :param rxtime: Time last VCDU of the newest segment entered the receive queue
+        :param callback: Function to call once image is in place
+        """
+
+        buf = io.BytesIO()
+        img.save(buf, format=fmt[0], **fmt[1])
+        data = buf.getbuffer()
+
+        def saved():
+            if self.metrics != None and rxtime != None:
+                self.metrics.observe('image_latency_seconds', monotonic() - rxtime)
+            if callback != None:
+                callback()
+
+        # Hand image to background writer
+        if self.writer != None:
+            self.writer.write(path, data, saved)
+            return
+
+        # Write to temporary file so partial images are never visible
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        f = open(tmp, mode="wb")
+        f.write(data)
+        f.close()
+        os.replace(tmp, path)
+        saved()
+
+    def count(self, name, labels=()):
+        """
+        Increments image metric counter
+        """
+
+        if self.metrics != None:
+            self.metrics.inc(name, labels)
+
+    def wait(self):
+        """
+        Blocks until all queued segments have been assembled
+        """
+
+        self.queue.wait()
+
+    def close(self):
+        """
+        Stops assembler thread once queued segments have been assembled and incomplete images saved
+        """
+
+        self.queue.close()
+        self.thread.join()
+
+
+def get_segment_info(xrit):
+    """
+    Reads image geometry and segment position from IMG xRIT headers
+    :param xrit: Parsed xRIT file
+    :return: (image name, bits per pixel, columns, lines, segment number, total segments, first line), or None
+    """
+
+    # File name without segment number and extension (IMG_<mode>_<seq>_<band>_<date>_<time>_<segment>)
+    fnameSplit = xrit.FILE_NAME.split(".")[0].split("_")
+    if fnameSplit[0] != "IMG" or len(fnameSplit) < 7:
+        return None
+    name = "_".join(fnameSplit[:6])
+
+    ishOffset = xrit.find_header(1)
+    isiOffset = xrit.find_header(128)
+    if ishOffset == None or isiOffset == None:
+        return None
+
+    _, _, bpp, cols, lines, _ = CCSDS.IMAGE_STRUCTURE_HEADER.unpack(xrit.data[ishOffset : ishOffset + 9])
+    _, _, seg, total, line = CCSDS.IMAGE_SEGMENT_HEADER.unpack(xrit.data[isiOffset : isiOffset + 7])
+    if cols == 0 or lines == 0 or total == 0 or seg == 0 or line == 0:
+        return None
+
+    return name, bpp, cols, lines, seg, total, line - 1
+
+
+def decode_segment(data, bpp, cols, lines):
+    """
+    Decodes segment data field into 8-bit lines
+    :param data: Data field bytes
+    :param bpp: Bits per pixel from image structure header
+    :param cols: Number of columns
+    :param lines: Number of lines
+    :return: 2D uint8 array (may be short if data is truncated)
+    """
+
+    # JPEG compressed LRIT
+    if bytes(data[:2]) == b'\xFF\xD8':
+        img = Image.open(io.BytesIO(data))
+        if img.mode != "L":
+            img = img.convert("L")
+        return np.asarray(img)
+
+    if bpp == 8:
+        rows = min(lines, len(data) // cols)
+        return np.frombuffer(data, np.uint8, rows * cols).reshape(rows, cols)
+
+    if bpp == 16:
+        # 10-bit HRIT samples, drop 2 least significant bits
+        rows = min(lines, len(data) // (cols * 2))
+        z = np.frombuffer(data, np.uint16, rows * cols).reshape(rows, cols)
+        return np.right_shift(z, 2).astype(np.uint8)
+
+    raise ValueError("UNSUPPORTED PIXEL DEPTH ({} BITS)".format(bpp))
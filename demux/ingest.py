@@ -0,0 +1,178 @@
+"""
+ingest.py
+https://github.com/sam210723/COMS-1
+
+Network ingest for VCDU streams from OSP and goesrecv
+"""
+
+from logs import log
+import selectors
+import socket
+from time import monotonic
+
+
+class Ingest:
+    """
+    Reads VCDUs from a TCP stream.
+
+    Data is read in large chunks into a reusable buffer and reframed regardless of how the stream was
+    segmented, so VCDUs split across reads or merged into one read are handled correctly. Complete frames
+    from each read are handed to the demuxer as a single batch.
+    """
+
+    def __init__(self, sck, framing, push, qtimeout=None, framelen=892, bufsize=1024*1024):
+        """
+        Initialises stream reader
+        :param sck: Connected TCP socket
+        :param framing: Stream framing ("OSP" for raw VCDUs, "GOESRECV" for nanomsg messages)
+        :param push: Function taking a list of VCDUs and a queue timeout, returning the number queued
+        :param qtimeout: Seconds to wait for receive queue space before dropping VCDUs
+        :param framelen: VCDU length in bytes
+        :param bufsize: Receive buffer size in bytes
+        """
+
+        self.sck = sck                      # TCP socket
+        self.framing = framing              # Stream framing type
+        self.push = push                    # Demuxer batch push function
+        self.qtimeout = qtimeout            # Receive queue timeout
+        self.framelen = framelen            # VCDU length
+        self.buf = bytearray(bufsize)       # Receive buffer
+        self.view = memoryview(self.buf)    # Receive buffer view
+        self.end = 0                        # Length of unprocessed data at start of buffer
+        self.skip = 0                       # Bytes remaining of a discarded message
+        self.closed = False                 # Connection closed flag
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sck, selectors.EVENT_READ)
+
+        # Metrics
+        self.reads = 0                      # Socket reads
+        self.bytes = 0                      # Bytes received
+        self.frames = 0                     # VCDUs passed to demuxer
+        self.partial = 0                    # Reads ending part way through a frame
+        self.discarded = 0                  # Messages discarded due to unexpected length
+        self.dropped = 0                    # VCDUs dropped while receive queue was full
+        self.startTime = monotonic()        # Ingest start time
+
+    def run(self):
+        """
+        Reads from socket until the connection is closed
+        """
+
+        while not self.closed:
+            # Wake periodically so interrupts are handled on all platforms
+            if self.selector.select(1):
+                self.read()
+
+        self.selector.close()
+
+    def read(self):
+        """
+        Reads available data from socket and passes complete frames to the demuxer
+        """
+
+        try:
+            n = self.sck.recv_into(self.view[self.end:])
+        except (ConnectionError, socket.timeout) as e:
+            log.error("  CONNECTION ERROR: %s", e)
+            n = 0
+
+        if n == 0:
+            self.closed = True
+            return
+
+        self.reads += 1
+        self.bytes += n
+        self.end += n
+
+        if self.framing == "GOESRECV":
+            frames, pos = self.reframe_nanomsg()
+        else:
+            frames, pos = self.reframe_raw()
+
+        # Move partial frame to start of buffer
+        if pos < self.end:
+            self.partial += 1
+            self.buf[:self.end - pos] = self.view[pos:self.end]
+        self.end -= pos
+
+        if len(frames) > 0:
+            queued = self.push(frames, self.qtimeout)
+            self.frames += queued
+            self.dropped += len(frames) - queued
+
+    def reframe_raw(self):
+        """
+        Splits buffer into fixed length VCDUs
+        :return: List of VCDUs, number of bytes consumed
+        """
+
+        frames = []
+        pos = 0
+        while self.end - pos >= self.framelen:
+            frames.append(bytes(self.view[pos : pos + self.framelen]))
+            pos += self.framelen
+
+        return frames, pos
+
+    def reframe_nanomsg(self):
+        """
+        Splits buffer into nanomsg messages (64-bit big endian length followed by payload).
+        Messages that are not one VCDU long are discarded.
+        :return: List of VCDUs, number of bytes consumed
+        """
+
+        frames = []
+        pos = 0
+        while True:
+            # Skip remainder of discarded message
+            if self.skip > 0:
+                n = min(self.skip, self.end - pos)
+                pos += n
+                self.skip -= n
+                if self.skip > 0:
+                    break
+
+            if self.end - pos < 8:
+                break
+
+            length = int.from_bytes(self.buf[pos : pos + 8], byteorder='big')
+            if length != self.framelen:
+                self.discarded += 1
+                self.skip = length
+                pos += 8
+                continue
+
+            if self.end - pos < 8 + length:
+                break
+
+            frames.append(bytes(self.view[pos + 8 : pos + 8 + length]))
+            pos += 8 + length
+
+        return frames, pos
+
+    def stats(self):
+        """
+        Returns ingest statistics
+        """
+
+        stats = {}
+        stats['reads'] = self.reads
+        stats['bytes'] = self.bytes
+        stats['frames'] = self.frames
+        stats['partial'] = self.partial
+        stats['discarded'] = self.discarded
+        stats['dropped'] = self.dropped
+        stats['runtime'] = monotonic() - self.startTime
+
+        return stats
+
+    def print_stats(self):
+        """
+        Logs ingest statistics
+        """
+
+        stats = self.stats()
+        runtime = max(stats['runtime'], 1e-6)
+        log.info("INPUT:            {} VCDUs, {:.1f} MB in {} reads ({:.0f} VCDUs/s)".format(stats['frames'], stats['bytes'] / (1024 * 1024), stats['reads'], stats['frames'] / runtime))
+        log.info("INPUT FRAMING:    {} partial reads, {} discarded messages, {} dropped VCDUs".format(stats['partial'], stats['discarded'], stats['dropped']))
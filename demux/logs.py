@@ -0,0 +1,231 @@
+"""
+logs.py
+https://github.com/sam210723/COMS-1
+
+Buffered console logging and header tracing for the demultiplexer
+"""
+
+import atexit
+from collections import deque
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sys
+from threading import Condition, Lock, Thread
+from time import monotonic, time
+
+
+# Shared logger for demuxer modules
+log = logging.getLogger("xrit-rx")
+log.addHandler(logging.NullHandler())
+
+# Globals
+listener = None         # Background console writer
+ratelimit = None        # Console rate limit filter
+tracer = None           # Header trace writer (None when tracing is disabled)
+
+# Field names of traced headers
+traceFields = {}
+traceFields['VCDU'] = ("scid", "vcid", "counter", "replay")
+traceFields['M_PDU'] = ("vcid", "pointer")
+traceFields['CP_PDU'] = ("vcid", "apid", "seq", "counter", "length", "length_ok", "crc_ok")
+traceFields['TP_File'] = ("vcid", "counter", "length", "length_ok")
+traceFields['xRIT'] = ("vcid", "file_type", "file_name")
+
+
+class RateLimit(logging.Filter):
+    """
+    Limits how often each message can be logged.
+    Messages are grouped by their format string so repeated events with different values count together.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Maximum messages per second for each event
+        """
+
+        super().__init__()
+        self.rate = rate            # Messages per second per event
+        self.windows = {}           # [window start, count, suppressed] by event
+        self.lock = Lock()          # Lock for windows (filter runs on demuxer threads)
+
+    def filter(self, record):
+        now = monotonic()
+        key = record.msg
+
+        with self.lock:
+            w = self.windows.get(key)
+
+            if w == None or now - w[0] >= 1:
+                # Forget idle events so messages with unique text do not build up
+                if w == None and len(self.windows) >= 1024:
+                    self.windows = {k: v for k, v in self.windows.items() if now - v[0] < 1 or v[2] > 0}
+
+                suppressed = 0 if w == None else w[2]
+                w = [now, 0, 0]
+                self.windows[key] = w
+
+                # Report messages suppressed in previous window
+                if suppressed > 0:
+                    record.msg = "{}  ({} SIMILAR MESSAGES SUPPRESSED)".format(record.msg, suppressed)
+
+            w[1] += 1
+            if w[1] > self.rate:
+                w[2] += 1
+                return False
+
+        return True
+
+    def report(self):
+        """
+        Returns messages suppressed in the current window of each event
+        :return: List of (message, count)
+        """
+
+        with self.lock:
+            suppressed = [(k, w[2]) for k, w in self.windows.items() if w[2] > 0]
+            self.windows = {}
+
+        return suppressed
+
+
+class Tracer:
+    """
+    Writes parsed headers to a JSON lines file from a background thread.
+    Headers are dropped and counted rather than blocking the caller if the writer falls behind.
+    """
+
+    def __init__(self, path, maxlen=65536):
+        """
+        :param path: Trace file path
+        :param maxlen: Maximum number of headers waiting to be written
+        """
+
+        self.file = open(path, 'w')     # Trace file
+        self.maxlen = maxlen            # Queue length limit
+        self.queue = deque()            # Headers waiting to be written
+        self.cond = Condition()         # Queue condition
+        self.closed = False             # Tracer closed flag
+        self.dropped = 0                # Headers dropped while queue was full
+
+        self.thread = Thread(target=self.writer_core)
+        self.thread.name = "HEADER TRACE"
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, kind, values):
+        """
+        Queues parsed header to be written
+        :param kind: Header type (key of traceFields)
+        :param values: Tuple of header field values
+        """
+
+        if len(self.queue) >= self.maxlen:
+            self.dropped += 1
+            return
+
+        self.queue.append((time(), kind, values))
+
+        # Wake writer once a batch has built up
+        if len(self.queue) == 256:
+            with self.cond:
+                self.cond.notify()
+
+    def writer_core(self):
+        """
+        Formats and writes queued headers
+        """
+
+        while True:
+            with self.cond:
+                if len(self.queue) == 0 and not self.closed:
+                    self.cond.wait(0.5)
+                closed = self.closed
+
+            lines = []
+            while len(self.queue) > 0:
+                t, kind, values = self.queue.popleft()
+                entry = {"time": round(t, 6), "type": kind}
+                entry.update(zip(traceFields[kind], values))
+                lines.append(json.dumps(entry))
+
+            if len(lines) > 0:
+                self.file.write("\n".join(lines) + "\n")
+
+            if closed and len(self.queue) == 0:
+                break
+
+        self.file.close()
+
+    def close(self):
+        """
+        Writes remaining headers and closes trace file
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+        if self.dropped > 0:
+            log.warning("HEADER TRACE DROPPED %s HEADERS", self.dropped)
+
+
+def setup(verbose=False, rate=20, trace=None):
+    """
+    Sends log messages to the console through a background thread
+    :param verbose: Log debug messages (disables rate limiting)
+    :param rate: Maximum messages per second for each event (0 disables rate limiting)
+    :param trace: Header trace file path (None disables tracing)
+    """
+
+    global listener
+    global ratelimit
+    global tracer
+
+    # Console output keeps the plain print() format
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+
+    q = queue.SimpleQueue()
+    listener = QueueListener(q, handler)
+    listener.start()
+
+    # Rate limit before messages are formatted and queued
+    qhandler = QueueHandler(q)
+    if rate > 0 and not verbose:
+        ratelimit = RateLimit(rate)
+        qhandler.addFilter(ratelimit)
+    log.addHandler(qhandler)
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    log.propagate = False
+
+    if trace != None:
+        tracer = Tracer(trace)
+
+    # Flush queued messages on exit
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Writes queued messages and closes trace file
+    """
+
+    global listener
+    global ratelimit
+    global tracer
+
+    if tracer != None:
+        tracer.close()
+        tracer = None
+
+    if ratelimit != None:
+        for msg, count in ratelimit.report():
+            log.info("  (%s MORE \"%s\" MESSAGES SUPPRESSED)", count, msg.strip())
+        ratelimit = None
+
+    if listener != None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,266 @@
+"""
+metrics.py
+https://github.com/sam210723/COMS-1
+
+Counters and histograms for the demultiplexer, exposed in Prometheus text format
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logs import log
+from tables import VCID
+from threading import Event, Lock, Thread
+from time import monotonic
+
+
+# Metric definitions (type, help text, histogram buckets)
+definitions = {}
+definitions['vcdus_total'] = ("counter", "VCDUs received by virtual channel", None)
+definitions['vcdus_lost_total'] = ("counter", "VCDUs missing according to the VCDU counter", None)
+definitions['cppdu_crc_errors_total'] = ("counter", "CP_PDUs with a CRC error", None)
+definitions['cppdu_length_errors_total'] = ("counter", "CP_PDUs with a length mismatch", None)
+definitions['tpfile_length_errors_total'] = ("counter", "TP_Files skipped due to a length mismatch", None)
+definitions['files_total'] = ("counter", "xRIT files completed by virtual channel", None)
+definitions['stage_seconds'] = ("histogram", "Time spent in each channel handler stage", [1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1])
+definitions['file_latency_seconds'] = ("histogram", "Time from last VCDU of a file entering the receive queue to the file being saved", [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+definitions['image_segments_total'] = ("counter", "Image segments placed on an image canvas", None)
+definitions['images_total'] = ("counter", "Assembled images saved by state (complete or incomplete)", None)
+definitions['image_errors_total'] = ("counter", "Image segments that could not be decoded", None)
+definitions['image_latency_seconds'] = ("histogram", "Time from last VCDU of an image segment entering the receive queue to its preview or final image being saved", [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+definitions['receive_queue_depth'] = ("gauge", "VCDUs waiting in the receive queue", None)
+definitions['receive_queue_dropped'] = ("gauge", "VCDUs dropped while the receive queue was full", None)
+definitions['writer_queue_bytes'] = ("gauge", "File data waiting to be written to disk", None)
+prefix = "xrit_"
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket upper bounds
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets                      # Bucket upper bounds
+        self.counts = [0] * (len(buckets) + 1)      # Observations per bucket (last is +Inf)
+        self.sum = 0                                # Sum of observations
+        self.count = 0                              # Number of observations
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Thread-safe store of counters, histograms and gauges.
+    Labels are passed as tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = Lock()              # Lock for counters and histograms
+        self.counters = {}              # Counter values by (name, labels)
+        self.histograms = {}            # Histograms by (name, labels)
+        self.gauges = {}                # Gauge functions by name
+        self.stopEvent = Event()        # Console summary stop event
+        self.server = None              # HTTP server
+
+        # Totals at last console summary
+        self.lastTime = monotonic()
+        self.lastVCDUs = {}
+        self.lastLatency = (0, 0)
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increments counter
+        :param name: Metric name
+        :param labels: Tuple of (label, value) pairs
+        :param value: Amount to add
+        """
+
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """
+        Records value in histogram
+        :param name: Metric name
+        :param value: Observed value
+        :param labels: Tuple of (label, value) pairs
+        """
+
+        key = (name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h == None:
+                h = Histogram(definitions[name][2])
+                self.histograms[key] = h
+            h.observe(value)
+
+    def gauge(self, name, func):
+        """
+        Registers function returning the current value of a gauge
+        """
+
+        self.gauges[name] = func
+
+    def get(self, name):
+        """
+        Returns counter values by labels
+        """
+
+        with self.lock:
+            return {k[1]: v for k, v in self.counters.items() if k[0] == name}
+
+    def total(self, name):
+        """
+        Returns sum of counter over all labels
+        """
+
+        return sum(self.get(name).values())
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text format
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, h in self.histograms.items():
+                histograms[key] = (list(h.counts), h.sum, h.count)
+
+        lines = []
+        for name in definitions:
+            mtype, mhelp, buckets = definitions[name]
+            lines.append("# HELP {}{} {}".format(prefix, name, mhelp))
+            lines.append("# TYPE {}{} {}".format(prefix, name, mtype))
+
+            if mtype == "counter":
+                for key in sorted(k for k in counters if k[0] == name):
+                    lines.append("{}{}{} {}".format(prefix, name, format_labels(key[1]), counters[key]))
+
+            elif mtype == "histogram":
+                for key in sorted(k for k in histograms if k[0] == name):
+                    counts, hsum, hcount = histograms[key]
+                    cumulative = 0
+                    for i, le in enumerate(buckets + ["+Inf"]):
+                        cumulative += counts[i]
+                        lines.append("{}{}_bucket{} {}".format(prefix, name, format_labels(key[1] + (("le", le),)), cumulative))
+                    lines.append("{}{}_sum{} {}".format(prefix, name, format_labels(key[1]), hsum))
+                    lines.append("{}{}_count{} {}".format(prefix, name, format_labels(key[1]), hcount))
+
+            elif mtype == "gauge" and name in self.gauges:
+                lines.append("{}{} {}".format(prefix, name, self.gauges[name]()))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns one line summary of activity since the last summary
+        """
+
+        now = monotonic()
+        elapsed = max(now - self.lastTime, 1e-6)
+
+        # VCDU rate and fill ratio
+        vcdus = self.get('vcdus_total')
+        delta = {k: v - self.lastVCDUs.get(k, 0) for k, v in vcdus.items()}
+        count = sum(delta.values())
+        fill = delta.get((("vcid", VCID.FILL),), 0)
+        fillRatio = (fill / count) * 100 if count > 0 else 0
+
+        # File latency since last summary
+        lsum = 0
+        lcount = 0
+        with self.lock:
+            for key, h in self.histograms.items():
+                if key[0] == 'file_latency_seconds':
+                    lsum += h.sum
+                    lcount += h.count
+        fileCount = lcount - self.lastLatency[1]
+        latency = ((lsum - self.lastLatency[0]) / fileCount) * 1000 if fileCount > 0 else 0
+
+        self.lastTime = now
+        self.lastVCDUs = vcdus
+        self.lastLatency = (lsum, lcount)
+
+        line = "[METRICS] {:.0f} VCDU/s   FILL: {:.1f}%".format(count / elapsed, fillRatio)
+        if 'receive_queue_depth' in self.gauges:
+            line += "   QUEUE: {}".format(self.gauges['receive_queue_depth']())
+        line += "   LOST: {}   CRC ERR: {}   LEN ERR: {}".format(self.total('vcdus_lost_total'), self.total('cppdu_crc_errors_total'), self.total('cppdu_length_errors_total'))
+        line += "   FILES: {} ({:.1f} ms)".format(fileCount, latency)
+
+        return line
+
+    def start_console(self, interval):
+        """
+        Logs summary line periodically
+        :param interval: Seconds between summaries
+        """
+
+        def console():
+            while not self.stopEvent.wait(interval):
+                log.info("%s", self.summary())
+
+        self.summary()
+        console_thread = Thread(target=console)
+        console_thread.name = "METRICS CONSOLE"
+        console_thread.daemon = True
+        console_thread.start()
+
+    def start_server(self, port, host="127.0.0.1"):
+        """
+        Serves metrics over HTTP in Prometheus text format
+        :param port: TCP port
+        :param host: Address to listen on
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Keep console free of request logs
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.name = "METRICS SERVER"
+        server_thread.daemon = True
+        server_thread.start()
+
+    def stop(self):
+        """
+        Stops console summary and HTTP server
+        """
+
+        self.stopEvent.set()
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def format_labels(labels):
+    """
+    Formats label pairs as Prometheus label set
+    """
+
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join("{}=\"{}\"".format(k, v) for k, v in labels) + "}"
@@ -0,0 +1,124 @@
+"""
+tables.py
+https://github.com/sam210723/COMS-1
+
+Identifier enums and name lookup tables for CCSDS/xRIT classification
+"""
+
+from enum import IntEnum
+
+
+class SCID(IntEnum):
+    """
+    Spacecraft IDs
+    """
+
+    COMS1 = 195
+
+
+class VCID(IntEnum):
+    """
+    Reserved Virtual Channel IDs
+    """
+
+    FILL = 63
+
+
+class Seq(IntEnum):
+    """
+    CP_PDU sequence flags
+    """
+
+    CONTINUE = 0
+    FIRST = 1
+    LAST = 2
+    SINGLE = 3
+
+
+class FileType(IntEnum):
+    """
+    xRIT file types
+    """
+
+    IMAGE = 0
+    GTS = 1
+    TEXT = 2
+    KEY = 3
+    CMDPS = 128
+    NWP = 129
+    GOCI = 130
+    TYPHOON = 131
+
+
+# Default spacecraft names by SCID
+defaultSpacecraft = {}
+defaultSpacecraft[SCID.COMS1] = "COMS-1"
+
+# Default virtual channel names by VCID
+defaultChannels = {}
+defaultChannels[0] = "VIS"
+defaultChannels[1] = "SWIR"
+defaultChannels[2] = "WV"
+defaultChannels[3] = "IR1"
+defaultChannels[4] = "IR2"
+defaultChannels[5] = "ANT"
+defaultChannels[6] = "ENC"
+defaultChannels[7] = "CMDPS"
+defaultChannels[8] = "NWP"
+defaultChannels[9] = "GOCI"
+defaultChannels[10] = "BINARY"
+defaultChannels[11] = "TYPHOON"
+defaultChannels[VCID.FILL] = "FILL"
+
+# Sequence flag names indexed by flag value
+seqNames = tuple(s.name for s in Seq)
+
+# File type names
+fileTypeNames = {}
+fileTypeNames[FileType.IMAGE] = "Image Data"
+fileTypeNames[FileType.GTS] = "GTS Message"
+fileTypeNames[FileType.TEXT] = "Alphanumeric Text"
+fileTypeNames[FileType.KEY] = "Encryption Key Message"
+fileTypeNames[FileType.CMDPS] = "CMDPS Analysis Data"
+fileTypeNames[FileType.NWP] = "NWP Data"
+fileTypeNames[FileType.GOCI] = "GOCI Data"
+fileTypeNames[FileType.TYPHOON] = "Typhoon Info"
+
+# Name tables indexed by ID (None for unknown IDs), rebuilt by configure()
+spacecraft = ()
+channels = ()
+
+
+def build(names, size):
+    """
+    Builds tuple of names indexed by ID
+    :param names: Names by ID
+    :param size: Number of possible IDs
+    """
+
+    table = [None] * size
+    for i, name in names.items():
+        if not 0 <= int(i) < size:
+            raise ValueError("ID {} NOT IN RANGE 0 TO {}".format(i, size - 1))
+        table[int(i)] = name
+
+    return tuple(table)
+
+
+def configure(sc=None, vc=None):
+    """
+    Sets spacecraft and virtual channel names.
+    Only spacecraft in the spacecraft table are demultiplexed.
+    :param sc: Spacecraft names by SCID (None uses defaults)
+    :param vc: Virtual channel names by VCID (None uses defaults)
+    :raises ValueError: ID outside SCID or VCID range
+    """
+
+    global spacecraft
+    global channels
+
+    spacecraft = build(defaultSpacecraft if sc == None else sc, 256)
+    channels = build(defaultChannels if vc == None else vc, 64)
+
+
+configure()
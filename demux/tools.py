@@ -1,5 +1,10 @@
+import binascii
+from collections import deque
 import errno
 import os
+import struct
+from threading import Condition, Lock
+from time import monotonic
 
 def get_bits(data, start, length, count):
     """
@@ -34,6 +39,282 @@ def get_bits_int(data, start, length, count):
     return int(bits, 2)
 
 
+class Layout:
+    """
+    Precompiled bit field layout for fixed length headers.
+
+    Field offsets, shifts and masks are calculated once per header type instead of on every packet.
+    Byte aligned layouts are decoded with a single struct unpack.
+    """
+
+    # struct format characters for byte aligned field widths
+    formats = {8: "B", 16: "H", 32: "I", 64: "Q"}
+
+    def __init__(self, length, fields):
+        """
+        :param length: Header length in bytes
+        :param fields: List of (start, length) tuples for each field in bits
+        """
+
+        self.length = length
+        self.struct = None
+        self.fields = []
+
+        # Use struct if every field is byte aligned, contiguous and a standard width
+        fmt = ">"
+        pos = 0
+        for start, bits in fields:
+            if start != pos or start % 8 != 0 or bits not in self.formats:
+                fmt = None
+                break
+            fmt += self.formats[bits]
+            pos += bits
+
+        if fmt != None:
+            fmt += "x" * (length - (pos // 8))
+            self.struct = struct.Struct(fmt)
+        else:
+            # Shift and mask for each field within the header as a single integer
+            total = length * 8
+            for start, bits in fields:
+                shift = total - start - bits
+                mask = (1 << bits) - 1
+                self.fields.append((shift, mask))
+
+    def unpack(self, data):
+        """
+        Decode header fields from the start of data
+        :param data: Bytes-like object containing header
+        :return: Tuple of field values as integers
+        """
+
+        if self.struct != None:
+            return self.struct.unpack_from(data)
+
+        value = int.from_bytes(data[:self.length], byteorder='big')
+        return tuple([(value >> shift) & mask for shift, mask in self.fields])
+
+
+class Buffer:
+    """
+    Preallocated reassembly buffer.
+
+    Chunks are written into place through a memoryview rather than concatenated,
+    so building a payload is linear in its length.
+    """
+
+    maxPrealloc = 64 * 1024 * 1024      # Largest preallocation (lengths come from unverified headers)
+
+    def __init__(self, size, data=None):
+        """
+        :param size: Expected final length in bytes
+        :param data: Initial chunk of data
+        """
+
+        self.buf = bytearray(min(size, Buffer.maxPrealloc))
+        self.view = memoryview(self.buf)
+        self.length = 0
+
+        if data != None:
+            self.write(data)
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        """
+        Writes chunk of data to end of buffer
+        :param data: Bytes-like object to write
+        """
+
+        end = self.length + len(data)
+
+        # Grow buffer if more data arrives than expected
+        if end > len(self.buf):
+            self.view.release()
+            self.buf.extend(bytes(max(end, len(self.buf) * 2) - len(self.buf)))
+            self.view = memoryview(self.buf)
+
+        self.view[self.length : end] = data
+        self.length = end
+
+    def truncate(self, length):
+        """
+        Discards data after length bytes
+        :param length: New buffer length
+        """
+
+        self.length = min(self.length, length)
+
+    def getview(self, start=0, end=None):
+        """
+        Returns zero-copy view of written data
+        :param start: Start offset (negative values are relative to end of written data)
+        :param end: End offset (negative values are relative to end of written data)
+        """
+
+        if start < 0:
+            start = max(0, self.length + start)
+
+        if end == None:
+            end = self.length
+        elif end < 0:
+            end = max(0, self.length + end)
+
+        return self.view[start : end]
+
+    def detach(self):
+        """
+        Releases buffer contents to caller without copying.
+        The buffer cannot be written to afterwards.
+        :return: bytearray of written data
+        """
+
+        self.view.release()
+        if self.length < len(self.buf):
+            del self.buf[self.length:]
+
+        return self.buf
+
+
+class BoundedQueue:
+    """
+    Bounded FIFO queue for handing data between threads.
+
+    Consumers block until data is available instead of polling. Producers block while the queue is
+    at its high-water mark (backpressure), and items are dropped and counted if it stays full.
+    """
+
+    def __init__(self, maxlen):
+        """
+        :param maxlen: Maximum number of queued items (high-water mark)
+        """
+
+        self.maxlen = maxlen
+        self.items = deque()
+        self.lock = Lock()
+        self.notEmpty = Condition(self.lock)
+        self.notFull = Condition(self.lock)
+        self.idle = Condition(self.lock)
+        self.pending = 0            # Items pushed but not yet marked done
+        self.closed = False         # Queue closed flag
+        self.dropped = 0            # Items dropped while queue was full
+        self.peak = 0               # Peak queue depth
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, item, timeout=None):
+        """
+        Adds item to end of queue, blocking while the queue is full
+        :param item: Item to add
+        :param timeout: Seconds to wait for space before dropping item (None waits indefinitely)
+        :return: True if item was queued, False if it was dropped
+        """
+
+        with self.notFull:
+            if len(self.items) >= self.maxlen:
+                end = None if timeout == None else monotonic() + timeout
+
+                while len(self.items) >= self.maxlen and not self.closed:
+                    remaining = None if end == None else end - monotonic()
+                    if remaining != None and remaining <= 0:
+                        self.dropped += 1
+                        return False
+                    self.notFull.wait(remaining)
+
+            if self.closed:
+                return False
+
+            self.items.append(item)
+            self.pending += 1
+            self.peak = max(self.peak, len(self.items))
+            self.notEmpty.notify()
+
+        return True
+
+    def push_many(self, items, timeout=None):
+        """
+        Adds items to end of queue under a single lock, blocking while the queue is full
+        :param items: List of items to add
+        :param timeout: Seconds to wait for space before dropping remaining items (None waits indefinitely)
+        :return: Number of items queued
+        """
+
+        count = 0
+        with self.notFull:
+            end = None if timeout == None else monotonic() + timeout
+
+            for item in items:
+                while len(self.items) >= self.maxlen and not self.closed:
+                    remaining = None if end == None else end - monotonic()
+                    if remaining != None and remaining <= 0:
+                        self.dropped += len(items) - count
+                        return count
+                    self.notFull.wait(remaining)
+
+                if self.closed:
+                    return count
+
+                self.items.append(item)
+                self.pending += 1
+                count += 1
+                self.peak = max(self.peak, len(self.items))
+                self.notEmpty.notify()
+
+        return count
+
+    def pull(self, timeout=None):
+        """
+        Removes item from start of queue, blocking until one is available
+        :param timeout: Seconds to wait for an item (None waits indefinitely)
+        :return: Item, or None if the queue was closed or timed out
+        """
+
+        with self.notEmpty:
+            if not self.notEmpty.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+
+            if not self.items:
+                return None
+
+            item = self.items.popleft()
+            self.notFull.notify()
+
+        return item
+
+    def done(self):
+        """
+        Marks a pulled item as finished processing
+        """
+
+        with self.lock:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.idle.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until every queued item has been pulled and marked done
+        :param timeout: Seconds to wait (None waits indefinitely)
+        :return: True if queue is idle
+        """
+
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending <= 0 or self.closed, timeout)
+
+    def close(self):
+        """
+        Closes queue and wakes all waiting threads
+        """
+
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+            self.idle.notify_all()
+
+
 def CCITT_LUT():
     """
     Creates Lookup Table for CRC-16/CCITT-FALSE calculation
@@ -58,3 +339,50 @@ def CCITT_LUT():
         crcTable.append(crc)
 
     return crcTable
+
+
+class CRC16:
+    """
+    CRC-16/CCITT-FALSE engine with support for incremental updates
+    """
+
+    initial = 0xFFFF
+
+    def __init__(self, engine="hqx"):
+        """
+        :param engine: CRC implementation ("hqx" for binascii C implementation, "lut" for Python lookup table)
+        """
+
+        self.engine = engine
+
+        if engine == "hqx":
+            # binascii.crc_hqx is CRC-16/CCITT-FALSE when seeded with 0xFFFF
+            self.update = binascii.crc_hqx
+        elif engine == "lut":
+            self.lut = CCITT_LUT()
+            self.update = self.update_lut
+        else:
+            raise ValueError("Unknown CRC engine \"{}\"".format(engine))
+
+    def update_lut(self, data, crc):
+        """
+        Updates CRC with data using lookup table
+        :param data: Bytes to add to CRC
+        :param crc: Current CRC value
+        :return: Updated CRC value
+        """
+
+        lut = self.lut
+        for b in data:
+            crc = ((crc << 8) ^ lut[((crc >> 8) ^ b) & 0xFF]) & 0xFFFF
+
+        return crc
+
+    def calculate(self, data):
+        """
+        Calculates CRC of data in one pass
+        :param data: Bytes to calculate CRC of
+        :return: CRC value
+        """
+
+        return self.update(data, self.initial)
@@ -0,0 +1,225 @@
+"""
+writer.py
+https://github.com/sam210723/COMS-1
+
+Background file writer for demultiplexed xRIT files
+"""
+
+from collections import deque
+from logs import log
+import os
+from threading import Condition, Thread
+from time import monotonic
+
+
+class Writer:
+    """
+    Writes files to disk from a background thread.
+
+    Files are written to a temporary path and renamed into place so partially written files are never
+    visible. Memory used by queued files is bounded; callers block while the limit is reached.
+    """
+
+    def __init__(self, maxbytes=256*1024*1024, fsync=0):
+        """
+        Initialises writer and starts writer thread
+        :param maxbytes: Maximum size of queued file data in bytes
+        :param fsync: Number of files to write before flushing them to disk as a batch (0 disables fsync)
+        """
+
+        self.maxbytes = maxbytes        # Queued data limit
+        self.fsync = fsync              # fsync batch size
+        self.queue = deque()            # Queued files
+        self.cond = Condition()         # Queue condition
+        self.closed = False             # Writer closed flag
+        self.dirs = set()               # Output directories known to exist
+        self.batch = []                 # Files waiting for batch fsync
+
+        # Metrics
+        self.queuedBytes = 0            # Size of queued file data
+        self.peakBytes = 0              # Peak size of queued file data
+        self.peakFiles = 0              # Peak number of queued files
+        self.files = 0                  # Files written
+        self.bytes = 0                  # Bytes written
+        self.latencyTotal = 0           # Total time from queue to rename
+        self.latencyMax = 0             # Maximum time from queue to rename
+
+        # Start writer thread
+        writer_thread = Thread()
+        writer_thread.name = "FILE WRITER"
+        writer_thread.run = self.writer_core
+        writer_thread.start()
+
+    def write(self, path, data, callback=None):
+        """
+        Queues file to be written to disk.
+        Blocks while queued data is at the memory limit.
+        :param path: Output file path
+        :param data: File contents (bytes-like, not copied)
+        :param callback: Function to call once file is in place
+        """
+
+        size = len(data)
+
+        with self.cond:
+            # Wait for space (always accept at least one file)
+            while self.queuedBytes > 0 and self.queuedBytes + size > self.maxbytes and not self.closed:
+                self.cond.wait()
+
+            self.queue.append((path, data, callback, monotonic()))
+            self.queuedBytes += size
+            self.peakBytes = max(self.peakBytes, self.queuedBytes)
+            self.peakFiles = max(self.peakFiles, len(self.queue))
+            self.cond.notify_all()
+
+    def writer_core(self):
+        """
+        Writes queued files to disk
+        """
+
+        while True:
+            with self.cond:
+                while len(self.queue) == 0 and not self.closed:
+                    # Flush partial fsync batch while idle
+                    if len(self.batch) > 0:
+                        break
+                    self.cond.wait()
+
+                if len(self.queue) == 0:
+                    item = None
+                else:
+                    item = self.queue[0]
+
+            if item == None:
+                try:
+                    self.commit()
+                except OSError as e:
+                    log.error("  ERROR FLUSHING FILES TO DISK\n  %s", e)
+                    self.batch = []
+
+                with self.cond:
+                    self.cond.notify_all()
+
+                # Exit once queue has been drained
+                if self.closed:
+                    break
+                continue
+
+            path, data, callback, qtime = item
+            try:
+                self.write_file(path, data, callback, qtime)
+            except OSError as e:
+                log.error("  ERROR WRITING FILE \"%s\"\n  %s", path, e)
+
+            with self.cond:
+                self.queue.popleft()
+                self.queuedBytes -= len(data)
+                self.cond.notify_all()
+
+    def write_file(self, path, data, callback, qtime):
+        """
+        Writes file to temporary path and renames it into place
+        """
+
+        # Create output directory once
+        directory = os.path.dirname(path)
+        if directory not in self.dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.dirs.add(directory)
+
+        tmp = path + ".tmp"
+        f = open(tmp, mode="wb")
+        f.write(data)
+
+        if self.fsync > 0:
+            # Hold file open until batch is flushed
+            self.batch.append((f, tmp, path, callback, qtime, len(data)))
+            if len(self.batch) >= self.fsync:
+                self.commit()
+        else:
+            f.close()
+            os.replace(tmp, path)
+            self.written(callback, qtime, len(data))
+
+    def commit(self):
+        """
+        Flushes batch of files to disk and renames them into place
+        """
+
+        if len(self.batch) == 0:
+            return
+
+        directories = set()
+        for f, tmp, path, callback, qtime, size in self.batch:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.replace(tmp, path)
+            directories.add(os.path.dirname(path))
+
+        # Flush directory entries (not supported on Windows)
+        for d in directories:
+            try:
+                fd = os.open(d, os.O_RDONLY)
+                os.fsync(fd)
+                os.close(fd)
+            except OSError:
+                pass
+
+        for f, tmp, path, callback, qtime, size in self.batch:
+            self.written(callback, qtime, size)
+
+        self.batch = []
+
+    def written(self, callback, qtime, size):
+        """
+        Records metrics for a file that is in place on disk
+        """
+
+        latency = monotonic() - qtime
+        self.files += 1
+        self.bytes += size
+        self.latencyTotal += latency
+        self.latencyMax = max(self.latencyMax, latency)
+
+        if callback != None:
+            callback()
+
+    def wait(self):
+        """
+        Blocks until all queued files have been written
+        """
+
+        with self.cond:
+            while len(self.queue) > 0 or len(self.batch) > 0:
+                self.cond.wait()
+
+    def close(self):
+        """
+        Stops writer thread once queued files have been written
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        Returns write latency and queue depth metrics
+        """
+
+        stats = {}
+        stats['queue_files'] = len(self.queue)
+        stats['queue_bytes'] = self.queuedBytes
+        stats['peak_files'] = self.peakFiles
+        stats['peak_bytes'] = self.peakBytes
+        stats['files'] = self.files
+        stats['bytes'] = self.bytes
+
+        if self.files > 0:
+            stats['latency_mean'] = self.latencyTotal / self.files
+        else:
+            stats['latency_mean'] = 0
+        stats['latency_max'] = self.latencyMax
+
+        return stats
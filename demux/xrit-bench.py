@@ -0,0 +1,584 @@
+"""
+xrit-bench.py
+https://github.com/sam210723/COMS-1
+
+Benchmarks for the CCSDS demultiplexer
+"""
+
+from argparse import ArgumentParser
+import binascii
+from contextlib import redirect_stdout
+from datetime import datetime
+import glob
+import json
+import os
+from os import path
+import platform
+import struct
+import subprocess
+import sys
+
+# Shared key store module is in repository root
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from keystore import KeyStore
+
+import ccsds as CCSDS
+from demuxer import Channel, Demuxer
+from tables import VCID
+import tempfile
+from time import perf_counter
+from tools import CRC16, get_bits, get_bits_int
+import tracemalloc
+
+
+# Globals
+args = None             # Parsed CLI arguments
+buflen = 892            # VCDU length
+mpdulen = 884           # M_PDU packet zone length
+cppdulen = 8192         # CP_PDU payload length (including CRC)
+hritRate = 3000000 / (1024 * 8)     # HRIT VCDUs per second (3 Mbps, 1024 byte CADUs)
+results = {}            # Benchmark results for JSON output
+
+# Reassembled file sizes
+fileSizes = {}
+fileSizes['LRIT FD'] = 2200 * 220
+fileSizes['HRIT FD IR'] = 2750 * 275 * 2
+fileSizes['HRIT FD VIS'] = 11000 * 1100 * 2
+
+
+def init():
+    global args
+
+    args = parse_args()
+
+    # Default to bundled sample captures
+    files = args.FILE
+    if files == []:
+        root = path.join(path.dirname(path.abspath(__file__)), "..", "samples")
+        files = sorted(glob.glob(path.join(root, "vcdu*.bin")))
+
+    if len(files) == 0:
+        print("NO VCDU FILES FOUND\nExiting...")
+        exit(1)
+
+    if args.headers:
+        for f in files:
+            print("{}:".format(path.basename(f)))
+            bench_headers(load_vcdus(f))
+            print()
+
+    if args.reassembly:
+        bench_reassembly()
+        print()
+
+    if args.stages:
+        vcdus = []
+        for f in files:
+            vcdus += load_vcdus(f)
+
+        # Repeat captures to synthesise a stream at HRIT rate
+        if args.hrit > 0:
+            vcdus = synth_stream(vcdus, int(args.hrit * hritRate))
+
+        bench_stages(vcdus)
+        print()
+
+    # Save results for comparison with other commits
+    if args.json != None:
+        save_results(files)
+
+    if args.compare != None:
+        compare_results(args.compare)
+
+
+def load_vcdus(fpath):
+    """
+    Loads VCDUs from packet file
+    """
+
+    f = open(fpath, 'rb')
+    data = f.read()
+    f.close()
+
+    return [data[i : i + buflen] for i in range(0, len(data) - buflen + 1, buflen)]
+
+
+def bench_headers(vcdus):
+    """
+    Compares per-header decode time of bit string parsing and precompiled layouts
+    """
+
+    # Collect header samples at their offsets in the VCDU stream
+    headers = {}
+    headers['VCDU'] = [v[:6] for v in vcdus]
+    headers['M_PDU'] = [v[6:8] for v in vcdus]
+
+    packets = []
+    for v in vcdus:
+        mpdu = CCSDS.M_PDU(v[6:])
+        if mpdu.HEADER and mpdu.POINTER + 16 <= len(mpdu.PACKET):
+            packets.append(mpdu.PACKET[mpdu.POINTER:])
+
+    if len(packets) == 0:
+        print("  NO CP_PDU HEADERS IN FILE")
+        return
+
+    headers['CP_PDU'] = [p[:6] for p in packets]
+    headers['TP_File'] = [p[6:16] for p in packets]
+    headers['xRIT'] = [p[:16] for p in packets]
+
+    print("  {:<10}{:>8}{:>14}{:>14}{:>10}".format("HEADER", "COUNT", "BEFORE (ns)", "AFTER (ns)", "SPEEDUP"))
+    for name in headers:
+        before = time_decode(legacy[name], headers[name])
+        after = time_decode(layouts[name].unpack, headers[name])
+
+        # Check both decoders agree
+        for h in headers[name]:
+            if tuple(legacy[name](h)) != tuple(layouts[name].unpack(h)):
+                print("  {} DECODE MISMATCH".format(name))
+                break
+
+        print("  {:<10}{:>8}{:>14.0f}{:>14.0f}{:>9.1f}x".format(name, len(headers[name]), before, after, before / after))
+
+
+def time_decode(decoder, headers):
+    """
+    Returns mean decode time per header in nanoseconds
+    """
+
+    runs = max(1, args.n // len(headers))
+    start = perf_counter()
+    for i in range(runs):
+        for h in headers:
+            decoder(h)
+    end = perf_counter()
+
+    return ((end - start) / (runs * len(headers))) * 1e9
+
+
+def bench_reassembly():
+    """
+    Compares time and peak memory of CP_PDU/TP_File reassembly using bytes concatenation and preallocated buffers
+    """
+
+    print("Reassembly:")
+    print("  {:<14}{:>12}{:>12}{:>12}{:>14}{:>14}".format("FILE", "SIZE (MB)", "BEFORE (s)", "AFTER (s)", "BEFORE (MB)", "AFTER (MB)"))
+
+    for name in fileSizes:
+        size = fileSizes[name]
+        cppdus = build_cppdus(size)
+
+        before, beforeMem, _ = measure(reassemble_bytes, cppdus)
+        after, afterMem, _ = measure(reassemble_buffer, cppdus)
+
+        mb = 1024 * 1024
+        print("  {:<14}{:>12.1f}{:>12.3f}{:>12.3f}{:>14.1f}{:>14.1f}".format(name, size / mb, before, after, beforeMem / mb, afterMem / mb))
+
+
+def measure(func, data):
+    """
+    Returns best run time, peak traced memory and traced memory still allocated after the function returns
+    """
+
+    # Time without tracing overhead
+    times = []
+    for i in range(3):
+        start = perf_counter()
+        func(data)
+        times.append(perf_counter() - start)
+
+    tracemalloc.start()
+    func(data)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak, current
+
+
+def build_cppdus(size):
+    """
+    Builds synthetic CP_PDUs carrying a TP_File of the given data length.
+    Each CP_PDU is returned as a list of M_PDU sized chunks.
+    """
+
+    crc = CRC16()
+    tpfile = struct.pack(">HQ", 1, size * 8) + bytes(size)
+
+    cppdus = []
+    offset = 0
+    while offset < len(tpfile):
+        data = tpfile[offset : offset + cppdulen - 2]
+        offset += len(data)
+
+        if len(cppdus) == 0:
+            seq = 1     # FIRST
+        elif offset >= len(tpfile):
+            seq = 2     # LAST
+        else:
+            seq = 0     # CONTINUE
+
+        header = struct.pack(">HHH", 0, seq << 14, len(data) + 1)
+        packet = header + data + crc.calculate(data).to_bytes(2, byteorder='big')
+        cppdus.append([packet[i : i + mpdulen] for i in range(0, len(packet), mpdulen)])
+
+    return cppdus
+
+
+def reassemble_bytes(cppdus):
+    """
+    Reassembles TP_File by concatenating immutable bytes
+    """
+
+    tpfile = None
+    for chunks in cppdus:
+        payload = chunks[0][6:]
+        for c in chunks[1:]:
+            payload += c
+
+        binascii.crc_hqx(payload[:-2], 0xFFFF)
+
+        if tpfile == None:
+            tpfile = payload[:-2][10:]
+        else:
+            tpfile += payload[:-2]
+
+    return tpfile
+
+
+def reassemble_buffer(cppdus):
+    """
+    Reassembles TP_File using CCSDS classes and preallocated buffers
+    """
+
+    crc = CRC16()
+    tpfile = None
+    for chunks in cppdus:
+        cppdu = CCSDS.CP_PDU(chunks[0], crc)
+        for c in chunks[1:-1]:
+            cppdu.append(c)
+        cppdu.finish(chunks[-1] if len(chunks) > 1 else b'')
+
+        if tpfile == None:
+            tpfile = CCSDS.TP_File(cppdu.get_data())
+        else:
+            tpfile.append(cppdu.get_data())
+
+    return tpfile.get_data()
+
+
+def synth_stream(vcdus, count):
+    """
+    Builds a continuous VCDU stream of the given length by repeating captured VCDUs.
+    VCDU counters are rewritten so the stream has no continuity gaps.
+    """
+
+    stream = []
+    for i in range(count):
+        v = bytearray(vcdus[i % len(vcdus)])
+        v[2:5] = (i % 16777216).to_bytes(3, byteorder='big')
+        stream.append(bytes(v))
+
+    return stream
+
+
+class CaptureChannel(Channel):
+    """
+    Channel handler that records completed CP_PDUs and TP_Files instead of saving files
+    """
+
+    def __init__(self, vcid, crc):
+        super().__init__(vcid, False, crc, None, None)
+        self.cppdus = []        # Completed CP_PDUs with valid CRC (header, payload including CRC)
+        self.tpfiles = []       # Completed TP_File payloads
+
+    def handle_CPPDU(self, cppdu, rxtime=None):
+        # Skip CP_PDUs corrupted by gaps or joins in the stream
+        if cppdu.CRC():
+            self.cppdus.append((bytes(cppdu.data[:6]), bytes(cppdu.PAYLOAD.getview())))
+        super().handle_CPPDU(cppdu, rxtime)
+
+    def finish_file(self, data, rxtime=None):
+        self.tpfiles.append(bytes(data))
+
+
+def capture(vcdus):
+    """
+    Runs VCDUs through capturing channel handlers to collect the input of each later stage
+    """
+
+    crc = CRC16()
+    channels = {}
+    stage = {}
+    stage['mpdus'] = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for v in vcdus:
+            vcdu = CCSDS.VCDU(v)
+            if vcdu.VCID == VCID.FILL:
+                continue
+            stage['mpdus'].append(vcdu.MPDU)
+
+            if vcdu.VCID not in channels:
+                channels[vcdu.VCID] = CaptureChannel(vcdu.VCID, crc)
+            channels[vcdu.VCID].data_in(vcdu)
+
+    stage['cppdus'] = []
+    stage['tpfiles'] = []
+    for c in channels.values():
+        stage['cppdus'] += c.cppdus
+        stage['tpfiles'] += c.tpfiles
+
+    # Split CP_PDUs back into M_PDU sized chunks
+    stage['chunks'] = []
+    for header, payload in stage['cppdus']:
+        packet = header + payload
+        stage['chunks'].append([packet[i : i + mpdulen] for i in range(0, len(packet), mpdulen)])
+
+    return stage
+
+
+def bench_keys(tpfiles):
+    """
+    Returns key store with keys for every key index in the captured files.
+    Uses the key file given on the command line, otherwise a dummy key so decryption is exercised.
+    """
+
+    if args.keys != None:
+        return KeyStore(args.keys)
+
+    # Find key indexes used by captured files
+    keystore = KeyStore()
+    keys = {}
+    for data in tpfiles:
+        headerLen = int.from_bytes(data[4:8], byteorder='big')
+        index = keystore.find_index(data, headerLen, data[3])
+        if index != None and index != 0:
+            keys[index] = b'\x01' * 8
+    keystore.set_keys(keys)
+
+    return keystore
+
+
+def bench_stages(vcdus):
+    """
+    Measures throughput and memory of each demuxer stage in isolation and end to end
+    """
+
+    print("Stages ({} VCDUs, {:.1f} MB, {:.1f}s of HRIT):".format(len(vcdus), len(vcdus) * buflen / (1024 * 1024), len(vcdus) / hritRate))
+
+    stage = capture(vcdus)
+    keystore = bench_keys(stage['tpfiles'])
+    crc = CRC16()
+    outDir = tempfile.TemporaryDirectory()
+
+    def vcdu_parse(vcdus):
+        for v in vcdus:
+            CCSDS.VCDU(v)
+        return len(vcdus), len(vcdus) * buflen
+
+    def mpdu_parse(mpdus):
+        for m in mpdus:
+            CCSDS.M_PDU(m)
+        return len(mpdus), sum(len(m) for m in mpdus)
+
+    def cppdu_crc(chunks):
+        size = 0
+        for c in chunks:
+            cppdu = CCSDS.CP_PDU(c[0], crc)
+            for m in c[1:-1]:
+                cppdu.append(m)
+            cppdu.finish(c[-1] if len(c) > 1 else b'')
+            size += len(cppdu.PAYLOAD)
+        return len(chunks), size
+
+    def tpfile_assembly(cppdus):
+        count = 0
+        size = 0
+        tpfile = None
+        for header, payload in cppdus:
+            seq = header[2] >> 6
+            data = memoryview(payload)[:-2]
+            if seq == 1:
+                tpfile = CCSDS.TP_File(data)
+            elif tpfile != None and seq == 0:
+                tpfile.append(data)
+            elif tpfile != None and seq == 2:
+                tpfile.finish(data)
+                size += len(tpfile.get_data())
+                count += 1
+                tpfile = None
+        return count, size
+
+    def spdu_decrypt(tpfiles):
+        size = 0
+        for data in tpfiles:
+            # Copy as decryption is in place
+            CCSDS.S_PDU(bytearray(data), keystore)
+            size += len(data)
+        return len(tpfiles), size
+
+    def xrit_save(tpfiles):
+        size = 0
+        for data in tpfiles:
+            CCSDS.xRIT(data).save(outDir.name)
+            size += len(data)
+        return len(tpfiles), size
+
+    def end_to_end(vcdus):
+        demux = Demuxer("HRIT", False, None, outDir.name, keystore, len(vcdus) + 1, args.workers)
+        for v in vcdus:
+            demux.process(v)
+        demux.wait()
+        demux.stop()
+        return len(vcdus), len(vcdus) * buflen
+
+    tests = []
+    tests.append(("VCDU", vcdu_parse, vcdus))
+    tests.append(("M_PDU", mpdu_parse, stage['mpdus']))
+    tests.append(("CP_PDU CRC", cppdu_crc, stage['chunks']))
+    tests.append(("TP_File", tpfile_assembly, stage['cppdus']))
+    tests.append(("S_PDU", spdu_decrypt, stage['tpfiles']))
+    tests.append(("xRIT save", xrit_save, stage['tpfiles']))
+    tests.append(("End to end", end_to_end, vcdus))
+
+    mb = 1024 * 1024
+    results['stages'] = {}
+    print("  {:<12}{:>8}{:>10}{:>12}{:>10}{:>12}{:>12}".format("STAGE", "ITEMS", "TIME (s)", "ITEMS/s", "MB/s", "PEAK (MB)", "HELD (MB)"))
+    devnull = open(os.devnull, 'w')
+    for name, func, data in tests:
+        # Hide console output of demuxer classes
+        with redirect_stdout(devnull):
+            count, size = func(data)
+            elapsed, peak, held = measure(func, data)
+        elapsed = max(elapsed, 1e-9)
+
+        r = {}
+        r['items'] = count
+        r['bytes'] = size
+        r['seconds'] = elapsed
+        r['items_per_s'] = count / elapsed
+        r['mb_per_s'] = size / mb / elapsed
+        r['peak_bytes'] = peak
+        r['held_bytes'] = held
+        results['stages'][name] = r
+
+        print("  {:<12}{:>8}{:>10.3f}{:>12.0f}{:>10.1f}{:>12.1f}{:>12.1f}".format(name, count, elapsed, r['items_per_s'], r['mb_per_s'], peak / mb, held / mb))
+
+    devnull.close()
+
+    e2e = results['stages']['End to end']['items_per_s']
+    results['hrit_realtime'] = e2e / hritRate
+    print("  End to end is {:.1f}x HRIT real time ({:.0f} VCDUs/s)".format(results['hrit_realtime'], hritRate))
+
+    outDir.cleanup()
+
+
+def save_results(files):
+    """
+    Saves benchmark results as JSON
+    """
+
+    # Commit being benchmarked
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=path.dirname(path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    results['commit'] = commit
+    results['time'] = datetime.now().isoformat(timespec='seconds')
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['files'] = [path.basename(f) for f in files]
+    results['hrit_seconds'] = args.hrit
+    results['workers'] = args.workers
+
+    f = open(args.json, 'w')
+    json.dump(results, f, indent=2)
+    f.close()
+    print("Saved results to \"{}\"".format(args.json))
+
+
+def compare_results(fpath):
+    """
+    Prints change in stage throughput against previously saved results
+    """
+
+    f = open(fpath)
+    old = json.load(f)
+    f.close()
+
+    if 'stages' not in results or 'stages' not in old:
+        print("NO STAGE RESULTS TO COMPARE")
+        return
+
+    print("Compared with {} ({}):".format(old.get('commit'), old.get('time')))
+    print("  {:<12}{:>14}{:>14}{:>10}".format("STAGE", "BEFORE (MB/s)", "AFTER (MB/s)", "CHANGE"))
+    for name in results['stages']:
+        if name not in old['stages']:
+            continue
+
+        before = old['stages'][name]['mb_per_s']
+        after = results['stages'][name]['mb_per_s']
+        change = ((after / before) - 1) * 100 if before > 0 else 0
+        print("  {:<12}{:>14.1f}{:>14.1f}{:>+9.1f}%".format(name, before, after, change))
+
+
+# Bit string decoders (before precompiled layouts)
+legacy = {}
+legacy['VCDU'] = lambda h: (
+    get_bits_int(h, 0, 2, 48), get_bits_int(h, 2, 8, 48), get_bits_int(h, 10, 6, 48),
+    get_bits_int(h, 16, 24, 48), get_bits_int(h, 40, 1, 48), get_bits_int(h, 41, 7, 48)
+)
+legacy['M_PDU'] = lambda h: (get_bits_int(h, 5, 11, 16),)
+legacy['CP_PDU'] = lambda h: (
+    int(get_bits(h, 0, 3, 48), 2), int(get_bits(h, 3, 1, 48), 2), int(get_bits(h, 4, 1, 48), 2),
+    get_bits_int(h, 5, 11, 48), get_bits_int(h, 16, 2, 48), get_bits_int(h, 18, 14, 48), get_bits_int(h, 32, 16, 48)
+)
+legacy['TP_File'] = lambda h: (get_bits_int(h, 0, 16, 80), get_bits_int(h, 16, 64, 80))
+legacy['xRIT'] = lambda h: (
+    get_bits_int(h, 0, 8, 128), get_bits_int(h, 8, 16, 128), get_bits_int(h, 24, 8, 128),
+    get_bits_int(h, 32, 32, 128), get_bits_int(h, 64, 64, 128)
+)
+
+# Precompiled layouts
+layouts = {}
+layouts['VCDU'] = CCSDS.VCDU_HEADER
+layouts['M_PDU'] = CCSDS.M_PDU_HEADER
+layouts['CP_PDU'] = CCSDS.CP_PDU_HEADER
+layouts['TP_File'] = CCSDS.TP_FILE_HEADER
+layouts['xRIT'] = CCSDS.PRIMARY_HEADER
+
+
+def parse_args():
+    """
+    Parses command line arguments
+    """
+
+    argp = ArgumentParser()
+    argp.description = "Benchmarks for the CCSDS demultiplexer"
+    argp.add_argument("FILE", action="store", nargs="*", help="VCDU packet files (default: samples/vcdu*.bin)", default=[])
+    argp.add_argument("-n", action="store", type=int, help="Decodes per header type", default=200000)
+    argp.add_argument("--headers", action="store_true", help="Only run header decode benchmark", default=False)
+    argp.add_argument("--reassembly", action="store_true", help="Only run reassembly benchmark", default=False)
+    argp.add_argument("--stages", action="store_true", help="Only run demuxer stage benchmark", default=False)
+    argp.add_argument("--hrit", action="store", type=float, help="Synthesise a stream of this many seconds at HRIT rate from the input files", default=0)
+    argp.add_argument("--keys", action="store", help="Decryption key file (default: dummy keys)", default=None)
+    argp.add_argument("--workers", action="store", type=int, help="Channel worker threads for end to end benchmark", default=0)
+    argp.add_argument("--json", action="store", help="Save results to JSON file", default=None)
+    argp.add_argument("--compare", action="store", help="Compare results with a previously saved JSON file", default=None)
+
+    args = argp.parse_args()
+
+    # Run all benchmarks if none are selected
+    if not (args.headers or args.reassembly or args.stages):
+        args.headers = True
+        args.reassembly = True
+        args.stages = True
+
+    return args
+
+
+try:
+    init()
+except KeyboardInterrupt:
+    print("Exiting...")
+    exit()
@@ -7,10 +7,23 @@ Frontend for CCSDS demultiplexer and image generator
 
 from argparse import ArgumentParser
 from configparser import ConfigParser
-from demuxer import Demuxer
+import mmap
 from os import mkdir, path
 import socket
+import sys
+
+# Shared key store module is in repository root
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from keystore import KeyStore
+
+from demuxer import Demuxer
+from ingest import Ingest
+import logs
+from logs import log
+from metrics import Metrics
+import tables
 from time import time
+from writer import Writer
 
 
 # Globals
@@ -20,11 +33,18 @@ stime = None            # Processing start time
 source = None           # Input source type
 downlink = None         # Downlink type (LRIT/HRIT)
 output = None           # Data output path
-packetf = None          # Packet file object
 keypath = None          # Decryption key file path
-keys = {}               # Decryption keys
+keys = None             # Decryption key store
 sck = None              # TCP socket object
+ingest = None           # Network stream reader
 buflen = 892            # Input buffer length (1 VCDU)
+recvbuf = 1024 * 1024   # Network receive buffer size (bytes)
+qlen = None             # Demuxer receive queue length (VCDUs)
+workers = 0             # Number of demuxer channel worker threads
+writer = None           # Background file writer
+metrics = None          # Demuxer metrics
+assembler = None        # Live image assembler
+qtimeout = 1            # Seconds to wait for receive queue space before dropping VCDUs (network sources)
 demux = None            # Demuxer class object
 ver = 0.1               # XRIT-RX xrit-rx version
 
@@ -40,12 +60,19 @@ def init():
     global stime
     global demux
     global keys
+    global writer
+    global ingest
+    global metrics
+    global assembler
 
     # Handle arguments and config file
     args = parse_args()
     config = parse_config(args.config)
     print_config()
 
+    # Configure spacecraft and channel names
+    config_tables()
+
     # Configure directories and input source
     dirs()
     config_input()
@@ -53,16 +80,41 @@ def init():
     # Load decryption keys
     load_keys()
 
+    # Create background file writer
+    if config.getboolean('rx', 'async', fallback=True):
+        wbuf = config.getint('rx', 'writebuf', fallback=256) * 1024 * 1024
+        fsync = config.getint('rx', 'fsync', fallback=0)
+        writer = Writer(wbuf, fsync)
+
+    # Send console output through background logging thread
+    logs.setup(args.v, config.getint('rx', 'lograte', fallback=20), args.trace)
+
+    # Create metrics store
+    metrics = Metrics()
+
+    # Create live image assembler
+    assembler = config_images()
+
     # Create demuxer instance
-    demux = Demuxer(downlink, args.v, args.dump, path.abspath(output), keys)
+    demux = Demuxer(downlink, args.v, args.dump, path.abspath(output), keys, qlen, workers, writer, metrics, assembler)
 
     # Check demuxer thread is ready
     if not demux.coreReady:
         print("DEMUXER CORE THREAD FAILED TO START\nExiting...")
         exit()
 
+    # Expose metrics
+    config_metrics()
+
+    # Reload keys when key file changes
+    config_keys()
+
     print("──────────────────────────────────────────────────────────────────────────────────\n")
 
+    # Create network stream reader
+    if source == "OSP" or source == "GOESRECV":
+        ingest = Ingest(sck, source, demux.push_many, qtimeout, buflen, recvbuf)
+
     # Get processing start time
     stime = time()
 
@@ -76,45 +128,75 @@ def loop():
     """
     global demux
     global source
-    global sck
     global buflen
+    global ingest
 
     while True:
-        if source == "OSP":
-            data = sck.recv(buflen)
-            demux.push(data)
-        
-        elif source == "GOESRECV":
-            data = sck.recv(buflen + 8)
-
-            if len(data) == buflen + 8:
-                demux.push(data[8:])
+        if source == "OSP" or source == "GOESRECV":
+            # Read from socket until connection is closed
+            ingest.run()
+
+            log.info("\nCONNECTION CLOSED")
+            demux.wait()
+            ingest.print_stats()
+            demux.print_stats()
+            log.info("Exiting...")
+
+            # Stop core thread
+            demux.stop()
+            exit()
 
         elif source == "FILE":
-            global packetf
-            global stime
-
-            if not packetf.closed:
-                # Read VCDU from file
-                data = packetf.read(buflen)
-
-                # No more data to read from file
-                if data == b'':
-                    print("INPUT FILE LOADED")
-                    packetf.close()
-                    continue
-                
-                # Push VCDU to demuxer
-                demux.push(data)
-            else:
-                # Demuxer has all VCDUs from file, wait for processing
-                if demux.complete():
-                    runTime = round(time() - stime, 3)
-                    print("\nFINISHED PROCESSING FILE ({}s)\nExiting...".format(runTime))
-                    
-                    # Stop core thread
-                    demux.stop()
-                    exit()
+            replay()
+
+
+def replay():
+    """
+    Replays VCDU file through the demuxer on the main thread.
+    VCDUs are passed as slices of the memory-mapped file without copying or queueing.
+    """
+
+    global stime
+
+    f = open(args.file, mode='rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can not be mapped
+        mm = b''
+    finally:
+        # Mapping stays valid after file is closed
+        f.close()
+
+    # Pass each whole VCDU to demuxer
+    view = memoryview(mm)
+    count = len(view) // buflen
+    for offset in range(0, count * buflen, buflen):
+        demux.process(view[offset : offset + buflen])
+    log.info("INPUT FILE LOADED")
+
+    # Wait for channel workers and file writer
+    demux.wait()
+
+    # Unmap file once every VCDU has been processed
+    view.release()
+    if isinstance(mm, mmap.mmap):
+        try:
+            mm.close()
+        except BufferError:
+            # Slices still held by channel handlers, mapping is closed once they are released
+            pass
+
+    runTime = max(time() - stime, 1e-6)
+    mb = (count * buflen) / (1024 * 1024)
+    log.info("\nFINISHED PROCESSING FILE ({}s)".format(round(runTime, 3)))
+    log.info("REPLAY:           {} VCDUs, {:.1f} MB ({:.0f} VCDUs/s, {:.2f} MB/s)".format(count, mb, count / runTime, mb / runTime))
+    demux.print_stats()
+    log.info("Exiting...")
+
+    # Stop core thread
+    demux.stop()
+    exit()
 
 
 def config_input():
@@ -127,6 +209,7 @@ def config_input():
 
     if source == "OSP":
         sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recvbuf)
 
         ip = config.get('osp', 'ip')
         port = int(config.get('osp', 'vchan'))
@@ -137,6 +220,7 @@ def config_input():
 
     elif source == "GOESRECV":
         sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recvbuf)
 
         ip = config.get('goesrecv', 'ip')
         port = int(config.get('goesrecv', 'vchan'))
@@ -147,14 +231,11 @@ def config_input():
         nanomsg_init()
 
     elif source == "FILE":
-        global packetf
-
         # Check VCDU file exists
         if not path.exists(args.file):
             print("INPUT FILE DOES NOT EXIST\nExiting...")
             exit()
-        
-        packetf = open(args.file, 'rb')
+
         print("Opened file: \"{}\"".format(args.file))
 
     else:
@@ -163,6 +244,72 @@ def config_input():
         exit()
 
 
+def config_tables():
+    """
+    Loads spacecraft and virtual channel names from config file
+    """
+
+    sc = None
+    vc = None
+
+    try:
+        if config.has_section('spacecraft'):
+            sc = {int(k): v for k, v in config.items('spacecraft')}
+        if config.has_section('channels'):
+            vc = {int(k): v for k, v in config.items('channels')}
+
+        tables.configure(sc, vc)
+    except ValueError as e:
+        print("INVALID SPACECRAFT OR CHANNEL ID IN CONFIG FILE ({})\nExiting...".format(e))
+        exit()
+
+
+def config_metrics():
+    """
+    Starts metrics HTTP endpoint and console summary
+    """
+
+    port = config.getint('metrics', 'port', fallback=0)
+    interval = config.getint('metrics', 'interval', fallback=0)
+
+    if port > 0:
+        try:
+            metrics.start_server(port)
+            print("METRICS:          http://127.0.0.1:{}/metrics".format(port))
+        except OSError as e:
+            print("UNABLE TO START METRICS SERVER ON PORT {} ({})".format(port, e))
+
+    if interval > 0:
+        metrics.start_console(interval)
+
+
+def config_images():
+    """
+    Creates live image assembler if enabled in config file
+    """
+
+    if not config.getboolean('images', 'enabled', fallback=False):
+        return None
+
+    # Image assembly is optional, the demuxer does not need these packages
+    try:
+        from images import Assembler, formats
+    except ImportError as e:
+        print("IMAGE ASSEMBLY DISABLED (REQUIRES NUMPY AND PILLOW: {})".format(e))
+        return None
+
+    fmt = config.get('images', 'format', fallback="png").lower()
+    if fmt not in formats:
+        print("UNKNOWN IMAGE FORMAT \"{}\" (SUPPORTED: {})\nExiting...".format(fmt, ", ".join(formats)))
+        exit()
+
+    preview = config.getboolean('images', 'preview', fallback=True)
+    timeout = config.getint('images', 'timeout', fallback=900)
+    print("IMAGES:           {}{}".format(fmt.upper(), " (WITH PREVIEWS)" if preview else ""))
+
+    return Assembler(path.abspath(output), fmt, preview, timeout, writer, metrics)
+
+
 def connect_socket(addr):
     """
     Connects TCP socket to address and handle exceptions
@@ -217,41 +364,46 @@ def dirs():
 
 def load_keys():
     """
-    Loads key file and parses keys
+    Loads key file into key store
     """
 
-    global keypath
     global keys
 
-    # Check key file exists
-    if not path.exists(keypath):
-        print("KEY FILE NOT FOUND (will output encrypted files)")
+    # No key file configured, encrypted files are output as received
+    if keypath == "":
+        keys = KeyStore()
+        print("NO KEY FILE CONFIGURED (will output encrypted files)")
         return
 
-    # Load key file
-    keyf = open(keypath, mode='rb')
-    fbytes = keyf.read()
+    # Missing key file is not an error (keys are loaded if it appears later and reloading is enabled)
+    try:
+        keys = KeyStore(keypath, required=False)
+    except (OSError, ValueError) as e:
+        print("ERROR LOADING KEY FILE: {}\nExiting...".format(e))
+        exit()
 
-    # Parse key count
-    count = int.from_bytes(fbytes[:2], byteorder='big')
+    if not path.exists(keypath):
+        print("KEY FILE NOT FOUND (will output encrypted files)")
+    else:
+        print("Decryption keys loaded ({} keys)".format(len(keys)))
 
-    # Parse keys
-    for i in range(count):
-        offset = (i * 10) + 2
-        index = fbytes[offset : offset + 2]
-        key = fbytes[offset + 2 : offset + 10]
 
-        '''
-        # Print keys
-        i = hex(int.from_bytes(index, byteorder='big')).upper()[2:]
-        k = hex(int.from_bytes(key, byteorder='big')).upper()[2:]
-        print("{}: {}".format(i, k))
-        '''
+def config_keys():
+    """
+    Reloads key file when it changes on disk
+    """
+
+    interval = config.getint('rx', 'keyreload', fallback=5)
+    if interval <= 0 or keys.path == None:
+        return
 
-        # Add key to dictionary
-        keys[index] = key
+    def reloaded(count):
+        if isinstance(count, Exception):
+            log.error("ERROR RELOADING KEY FILE: %s", count)
+        else:
+            log.info("KEY FILE RELOADED (%s KEYS)", count)
 
-    print("Decryption keys loaded")
+    keys.watch(interval, reloaded)
 
 
 def parse_args():
@@ -265,6 +417,7 @@ def parse_args():
     argp.add_argument("--file", action="store", help="Path to VCDU packet file", default=None)
     argp.add_argument("-v", action="store_true", help="Enable verbose console output (only useful for debugging)", default=False)
     argp.add_argument("--dump", action="store", help="Dump VCDUs (except fill) to file (only useful for debugging)", default=None)
+    argp.add_argument("--trace", action="store", help="Record every parsed header to a JSON lines file (only useful for debugging)", default=None)
 
     return argp.parse_args()
 
@@ -278,6 +431,8 @@ def parse_config(path):
     global downlink
     global output
     global keypath
+    global qlen
+    global workers
 
     cfgp = ConfigParser()
     cfgp.read(path)
@@ -289,7 +444,9 @@ def parse_config(path):
     
     downlink = cfgp.get('rx', 'mode').upper()
     output = cfgp.get('rx', 'output')
-    keypath = cfgp.get('rx', 'keys')
+    keypath = cfgp.get('rx', 'keys', fallback="")
+    qlen = cfgp.getint('rx', 'queue', fallback=8192)
+    workers = cfgp.getint('rx', 'workers', fallback=0)
 
     return cfgp
 
@@ -325,7 +482,7 @@ def print_config():
     absp = path.abspath(output)
     absp = absp[0].upper() + absp[1:]  # Fix lowercase drive letter
     print("OUTPUT PATH:      {}".format(absp))
-    print("KEY FILE:         {}".format(keypath))
+    print("KEY FILE:         {}".format(keypath if keypath != "" else "NONE"))
     
     print("VERSION:          {}\n".format(ver))
 
@@ -333,6 +490,13 @@ def print_config():
 try:
     init()
 except KeyboardInterrupt:
-    demux.stop()
+    if ingest != None:
+        ingest.print_stats()
+    if demux != None:
+        demux.print_stats()
+        demux.stop()
+
+    # Write queued messages before exiting
+    logs.stop()
     print("Exiting...")
     exit()
@@ -6,7 +6,7 @@ Extracts image data from HRIT IMG file.
 """
 
 import argparse
-from coms import COMS as comsClass
+from coms import COMS as comsClass, HeaderIndex
 import glob
 from PIL import Image
 import numpy as np
@@ -16,99 +16,185 @@ from subprocess import call
 argparser = argparse.ArgumentParser(description="Extracts Meteorological Imager data from HRIT Image (IMG) files.")
 argparser.add_argument("INPUT", action="store", help="Input HRIT file/folder path")
 argparser.add_argument('OUTPUT', action="store", help="Output BIN file path")
-argparser.add_argument('-i', action="store_true", help="Generate BMP from BIN file")
+argparser.add_argument('-i', action="store_true", help="Generate BMP from HRIT segments")
 argparser.add_argument('-o', action="store_true", help="Add info text to generated BMP (assumes -i)")
 argparser.add_argument('-m', action="store_true", help="Add map overlay to generated BMP (assumes -i)")
 argparser.add_argument('-f', action="store", help="Overlay text fill colour", default="white")
+argparser.add_argument('-g', action="store", type=float, help="Gamma applied to generated BMP", default=1.0)
+argparser.add_argument('-c', action="store", type=float, help="Contrast applied to generated BMP", default=1.0)
+argparser.add_argument('-b', action="store_true", help="Also write BIN file when generating BMP")
+argparser.add_argument('-x', action="store_true", help="Do not use header index when scanning folders")
 args = argparser.parse_args()
 
 segments = []  # List of IMG files
+starts = {}  # (segment number, first line, end line) of each segment from segmentation header
+index = None  # Header index of input folder
 totalWidth = 0
 totalHeight = 0
 
+
+def make_lut(gamma=1.0, contrast=1.0):
+    """
+    Builds 1024 entry lookup table mapping 10-bit DN to 8-bit pixel values
+    :param gamma: Gamma curve exponent (1.0 for linear)
+    :param contrast: Contrast scale around mid-grey (1.0 for unchanged)
+    :return: LUT as uint8 array, or None when no curve is applied
+    """
+
+    if gamma == 1.0 and contrast == 1.0:
+        return None
+
+    dn = np.arange(1024, dtype=np.float64) / 1023
+    dn = np.clip((dn - 0.5) * contrast + 0.5, 0, 1)
+    dn = dn ** (1 / gamma)
+
+    return np.rint(dn * 255).astype(np.uint8)
+
+
+def convert_rows(z, out, lut=None):
+    """
+    Converts rows of 16-bit DN into 8-bit pixel rows
+    :param z: 16-bit DN array
+    :param out: 8-bit output array of the same shape
+    :param lut: 10-bit to 8-bit lookup table (None for linear 2-bit shift)
+    """
+
+    if lut is None:
+        # Drop 2 least significant bits
+        np.right_shift(z, 2, out=out, casting='unsafe')
+    else:
+        np.take(lut, z, out=out, mode='clip')
+
+
+def map_segment(path, offset, width, lines):
+    """
+    Memory-maps image data field of HRIT segment
+    :param path: Path to HRIT file
+    :param offset: Data field offset in bytes
+    :param width: Image width in pixels
+    :param lines: Number of lines in segment
+    :return: 16-bit DN array (may be short if file is truncated)
+    """
+
+    rows = min(lines, (os.path.getsize(path) - offset) // (width * 2))
+    if rows <= 0:
+        return None
+
+    return np.memmap(path, dtype=np.uint16, mode='r', offset=offset, shape=(rows, width))
+
+
 if os.path.isdir(args.INPUT):  # If input is a directory
     multipleSegments = True
     print("Detecting IMG segments...")
 
+    # Open header index stored alongside segments
+    if not args.x:
+        index = HeaderIndex(os.path.join(args.INPUT, ".hrit-index"))
+
     # Loop through files with .hrit extension in input folder
     for file in glob.glob(args.INPUT + "/*.hrit"):
-        COMS = comsClass(file)
-        COMS.parsePrimaryHeader()
-        COMS.parseImageStructureHeader()
+        COMS = comsClass(file, True, index)
+        COMS.parseHeaders()
+        COMS.close()
 
-        if COMS.primaryHeader['file_type'] == 0:  # Check HRIT file has IMG file type
+        if COMS.primaryHeader['valid'] and COMS.primaryHeader['file_type'] == 0:  # Check HRIT file has IMG file type
             segments.append(file)  # Add to list of valid IMG files
             totalHeight += COMS.imageStructureHeader['num_lines']
             totalWidth = COMS.imageStructureHeader['num_cols']
 
+            start = COMS.imageSegmentationInformationHeader['line_num_of_segment'] - 1
+            if COMS.imageSegmentationInformationHeader['valid'] and start >= 0:
+                starts[file] = (COMS.imageSegmentationInformationHeader['segment_num'], start, start + COMS.imageStructureHeader['num_lines'])
+
     if segments.__len__() <= 0:
         print("No valid IMG files found")
         exit(1)
 
+    # Place every segment at its line number when all segments have one, otherwise stack them in order
+    if len(starts) == len(segments):
+        segments.sort(key=lambda f: starts[f])
+        totalHeight = max(end for _, _, end in starts.values())
+    else:
+        segments.sort()
+        starts = {}
+
     print("Found {0} segments: ".format(segments.__len__()))
     for segment in segments:  # List detected segments
         print(" - {0}".format(segment))
 
 elif os.path.isfile(args.INPUT):  # If input is a single file
     multipleSegments = False
-    COMS = comsClass(args.INPUT)
-    COMS.parsePrimaryHeader()
-    COMS.parseImageStructureHeader()
+    COMS = comsClass(args.INPUT, True)
+    COMS.parseHeaders()
+    COMS.close()
 
-    if COMS.primaryHeader['file_type'] == 0:  # Check HRIT file has IMG file type
+    if COMS.primaryHeader['valid'] and COMS.primaryHeader['file_type'] == 0:  # Check HRIT file has IMG file type
         segments.append(args.INPUT)  # Add to list of valid IMG files
         totalHeight += COMS.imageStructureHeader['num_lines']
         totalWidth = COMS.imageStructureHeader['num_cols']
 
 print()
-# Delete output BIN file if it exists
-if os.path.isfile(args.OUTPUT):
-    os.remove(args.OUTPUT)
-    print("Deleted existing BIN file: {0}".format(args.OUTPUT))
+makeImage = args.i or args.o or args.m
+writeBin = args.b or not makeImage
+binFile = None
+img = None
+row = 0
+
+if writeBin:
+    # Delete output BIN file if it exists
+    if os.path.isfile(args.OUTPUT):
+        os.remove(args.OUTPUT)
+        print("Deleted existing BIN file: {0}".format(args.OUTPUT))
+    binFile = open(args.OUTPUT, "wb")
+
+if makeImage:
+    # Preallocate 8-bit output image
+    img = np.zeros((totalHeight, totalWidth), dtype=np.uint8)
+    lut = make_lut(args.g, args.c)
 
 # Loop through each segment
 for hritFile in segments:
     # Create COMS class instance and load HRIT file
-    COMS = comsClass(hritFile)
-
-    # Primary Header (type 0, required)
-    COMS.parsePrimaryHeader()
-
-    # START OPTIONAL HEADERS
-    printOptHeaders = False
-    COMS.parseImageStructureHeader(printOptHeaders)
+    if writeBin:
+        COMS = comsClass(hritFile)
+    else:
+        # Image data is memory-mapped, only headers are needed
+        COMS = comsClass(hritFile, True, index)
 
-    COMS.parseImageNavigationHeader(printOptHeaders)
+    # Parse all headers
+    COMS.parseHeaders()
 
-    COMS.parseImageDataFunctionHeader(printOptHeaders)
-
-    COMS.parseAnnotationTextHeader(printOptHeaders)
-
-    COMS.parseTimestampHeader(printOptHeaders)
-
-    COMS.parseKeyHeader(printOptHeaders)
+    # BEGIN DATA DUMPING
+    if writeBin:
+        binFile.write(COMS.readbytes(0, COMS.primaryHeader['data_field_len']))  # Dump image bytes to binary BIN file
 
-    COMS.parseImageSegmentationInformationHeader(printOptHeaders)
+    if makeImage:
+        lines = COMS.imageStructureHeader['num_lines']
 
-    COMS.parseImageCompensationInformationHeader(printOptHeaders)
+        # Place segment at its first line number (missing segments are left blank)
+        if hritFile in starts:
+            row = starts[hritFile][1]
 
-    COMS.parseImageObservationTimeHeader(printOptHeaders)
+        # Convert segment rows straight into output image
+        z = map_segment(hritFile, COMS.primaryHeader['total_header_len'], totalWidth, min(lines, totalHeight - row))
+        if z is not None:
+            convert_rows(z, img[row:row + len(z)], lut)
+            row += len(z)
+            del z
 
-    COMS.parseImageQualityInformationHeader(printOptHeaders)
+    COMS.close()
 
-    # BEGIN DATA DUMPING
-    binFile = open(args.OUTPUT, "ab")
-    binFile.write(COMS.readbytes(0, COMS.primaryHeader['data_field_len']))  # Dump image bytes to binary BIN file
+if index != None:
+    index.close()
 
-print("{1}Image data dumped to \"{0}\"{2}".format(args.OUTPUT, COMS.colours['OKGREEN'], COMS.colours['ENDC']))
+if writeBin:
+    binFile.close()
+    print("{1}Image data dumped to \"{0}\"{2}".format(args.OUTPUT, COMS.colours['OKGREEN'], COMS.colours['ENDC']))
 
-if args.i or args.o or args.m:
+if makeImage:
     # See GitHub Issue 1 for details
     bmpName = args.OUTPUT[:args.OUTPUT.index('.')] + ".bmp"
-    binFile = open(args.OUTPUT, 'rb')
-    z = np.fromfile(binFile, dtype=np.uint16, count=totalWidth * totalHeight)
-    z = z / 4
-    img = Image.frombuffer("L", [totalWidth, totalHeight], z.astype('uint8'), 'raw', 'L', 0, 1)
+    img = Image.frombuffer("L", [totalWidth, totalHeight], img, 'raw', 'L', 0, 1)
     img.save(bmpName)
     print("{0}\nBMP image generated\n{1}".format(COMS.colours['OKGREEN'], COMS.colours['ENDC']))
 
@@ -0,0 +1,243 @@
+"""
+keystore.py
+https://github.com/sam210723/COMS-1
+
+Decryption key store shared by the demultiplexer and the decryption tools.
+"""
+
+from Crypto.Cipher import DES
+import os
+from threading import Event, Lock, Thread
+
+
+class KeyStore:
+    """
+    DES keys and precomputed cipher objects by integer key index.
+
+    The key file is parsed once and can be reloaded while in use. Each reload builds a new table which
+    replaces the old one in a single assignment, so lookups on other threads never see a partial table.
+    """
+
+    def __init__(self, path=None, required=True):
+        """
+        Initialises key store and loads key file
+        :param path: Decrypted key file path (None for keys set with set_keys())
+        :param required: Raise if key file does not exist (otherwise start with no keys until it appears)
+        :raises OSError: Key file can not be read
+        :raises ValueError: Key file is malformed
+        """
+
+        self.path = path            # Key file path
+        self.table = {}             # (key, cipher) by key index
+        self.hints = {}             # Key header offsets by (file type, total header length)
+        self.stamp = None           # (size, mtime, inode) of last key file loaded
+        self.lock = Lock()          # Reload lock
+        self.stopEvent = Event()    # Watcher stop event
+
+        if path != None:
+            try:
+                self.load()
+            except FileNotFoundError:
+                if required:
+                    raise
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, index):
+        return index in self.table
+
+    def load(self):
+        """
+        Parses key file and replaces current keys
+        :return: Number of keys loaded
+        """
+
+        with self.lock:
+            stat = os.stat(self.path)
+            self.stamp = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+            f = open(self.path, mode='rb')
+            fbytes = f.read()
+            f.close()
+
+            self.set_keys(parse_keys(fbytes))
+
+        return len(self.table)
+
+    def set_keys(self, keys):
+        """
+        Replaces current keys
+        :param keys: Dictionary of 8 byte keys by integer key index
+        """
+
+        # ECB cipher objects hold no chaining state and can be shared
+        table = {}
+        for index, key in keys.items():
+            table[index] = (key, DES.new(key, DES.MODE_ECB))
+
+        self.table = table
+
+    def reload(self):
+        """
+        Loads key file again if it has changed on disk
+        :return: Number of keys loaded, or None if key file has not changed
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Keep current keys while key file is being replaced
+            return None
+
+        if (stat.st_size, stat.st_mtime_ns, stat.st_ino) == self.stamp:
+            return None
+
+        return self.load()
+
+    def watch(self, interval, callback=None):
+        """
+        Checks key file for changes periodically on a background thread
+        :param interval: Seconds between checks
+        :param callback: Function called with the number of keys after a reload, or with the exception if it failed
+        """
+
+        def watcher():
+            while not self.stopEvent.wait(interval):
+                try:
+                    count = self.reload()
+                except (OSError, ValueError) as e:
+                    count = e
+                if count != None and callback != None:
+                    callback(count)
+
+        watch_thread = Thread(target=watcher)
+        watch_thread.name = "KEY FILE WATCHER"
+        watch_thread.daemon = True
+        watch_thread.start()
+
+    def stop(self):
+        """
+        Stops key file watcher
+        """
+
+        self.stopEvent.set()
+
+    def get(self, index):
+        """
+        Returns key and cipher object for key index
+        :param index: Integer key index
+        :return: (key, DES cipher), or None if key index is unknown
+        """
+
+        return self.table.get(index)
+
+    def find_index(self, data, headerLen, fileType=None):
+        """
+        Finds Key header (type 7) and returns key index.
+        Files of the same type and header length share a header layout, so the offset found for one file
+        is checked first for the next before walking the headers.
+        :param data: xRIT file (or header field)
+        :param headerLen: Total xRIT header length
+        :param fileType: xRIT file type (None disables the offset cache)
+        :return: Integer key index, or None if file has no Key header
+        """
+
+        layout = (fileType, headerLen)
+        offset = self.hints.get(layout)
+
+        if offset == None or offset + 7 > headerLen or data[offset] != 7:
+            offset = find_key_header(data, headerLen)
+            if offset == None:
+                return None
+            if fileType != None:
+                self.hints[layout] = offset
+
+        length = (data[offset + 1] << 8) | data[offset + 2]
+        return int.from_bytes(data[offset + 5 : offset + length], byteorder='big')
+
+
+def find_key_header(data, headerLen):
+    """
+    Walks xRIT headers to find Key header (type 7).
+    Headers are in ascending type order, so the walk stops at the first header type after 7.
+    :param data: xRIT file (or header field)
+    :param headerLen: Total xRIT header length
+    :return: Offset of Key header, or None if file has no Key header
+    """
+
+    offset = 0
+    while offset + 3 <= headerLen:
+        htype = data[offset]
+        if htype == 7:
+            return offset
+        if htype > 7:
+            return None
+
+        length = (data[offset + 1] << 8) | data[offset + 2]
+        if length == 0:
+            return None
+        offset += length
+
+    return None
+
+
+def decrypt(cipher, buf, offset=0):
+    """
+    Decrypts data in place. The last block is padded with null bytes for decryption.
+    :param cipher: DES cipher object
+    :param buf: bytearray containing encrypted data from offset to end
+    :param offset: Start of encrypted data
+    """
+
+    # Fill last 8 byte DES block
+    length = len(buf)
+    pad = -(length - offset) % 8
+    if pad != 0:
+        buf.extend(bytes(pad))
+
+    view = memoryview(buf)[offset:]
+    cipher.decrypt(view, output=view)
+    view.release()
+
+    # Remove padding
+    if pad != 0:
+        del buf[length:]
+
+
+def parse_keys(fbytes):
+    """
+    Parses decrypted key file (2 byte key count, then 2 byte index and 8 byte key for each key)
+    :param fbytes: Key file contents
+    :return: Dictionary of keys by integer key index
+    """
+
+    if len(fbytes) < 2:
+        raise ValueError("KEY FILE TOO SHORT")
+
+    count = int.from_bytes(fbytes[:2], byteorder='big')
+    if len(fbytes) < 2 + (count * 10):
+        raise ValueError("KEY FILE TRUNCATED ({} KEYS, {} BYTES)".format(count, len(fbytes)))
+
+    keys = {}
+    for i in range(count):
+        offset = (i * 10) + 2
+        index = int.from_bytes(fbytes[offset : offset + 2], byteorder='big')
+        keys[index] = bytes(fbytes[offset + 2 : offset + 10])
+
+    return keys
+
+
+def write_keys(path, keys):
+    """
+    Writes decrypted key file
+    :param path: Output file path
+    :param keys: List of (2 byte index, 8 byte key) tuples
+    """
+
+    f = open(path, mode="wb")
+    f.write(len(keys).to_bytes(2, byteorder='big'))
+    for index, key in keys:
+        f.write(index)
+        f.write(key)
+    f.close()
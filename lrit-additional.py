@@ -40,4 +40,6 @@ dumpFileName = COMS.path[:-5] + "_DATA.{0}".format(dumpExtension)
 dumpFile = open(dumpFileName, 'wb')
 dumpFile.write(data)
 dumpFile.close()
+del data
+COMS.close()
 print("\nAdditional Data dumped to \"{0}\"".format(dumpFileName))
@@ -6,15 +6,23 @@ Extracts image data from LRIT IMG file.
 """
 
 import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
 import glob
 import io
 import os
 from PIL import Image, ImageFile
+import struct
 import sys
+from time import time
+from xritfile import XRITFile
+import zlib
 
 argparser = argparse.ArgumentParser(description="Extracts image data from LRIT IMG file.")
 argparser.add_argument("INPUT", action="store", help="LRIT file (or folder) to process")
 argparser.add_argument("-s", action="store_true", help="Processes incomplete images as individual segments")
+argparser.add_argument("-j", action="store", type=int, help="Number of images to process in parallel", default=1)
+argparser.add_argument("-t", action="store", type=int, help="Number of threads decoding segments of each image", default=1)
+argparser.add_argument("-f", action="store", choices=["jpg", "png", "tif"], help="Output image format (png and tif are lossless and written segment by segment)", default="jpg")
 args = argparser.parse_args()
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -81,7 +89,7 @@ def init():
                     print("    IMAGE GENERATION WILL BE SKIPPED")
             
             # Check image has not already been generated
-            if os.path.isfile(args.INPUT + "\\" + name + ".jpg"):
+            if os.path.isfile(args.INPUT + "\\" + name + "." + args.f):
                 print("    IMAGE ALREADY GENERATED...SKIPPING")
                 
                 # Remove image group from list
@@ -91,136 +99,311 @@ def init():
         print("-----------------------------------------\n")
 
         # Load and combine segments
-        for img in groups.keys():
-            # Get group details
-            name, mode, segment = parse_fname(groups[img][0])
+        startTime = time()
+        imageCount = 0
+        segmentCount = 0
+        failed = 0
+        if args.j > 1 and not args.s:
+            imageCount, segmentCount, failed = process_batch(groups)
+        else:
+            for img in groups.keys():
+                # Get group details
+                name, mode, segment = parse_fname(groups[img][0])
 
-            if args.s:
-                for seg in groups[img]:
-                    process_single_segment(seg)
-                    print()
-            else:
-                process_group(name, mode, groups[img])
-                print("\n")
+                if args.s:
+                    for seg in groups[img]:
+                        process_single_segment(seg)
+                        print()
+                else:
+                    process_group(name, mode, groups[img], args.t, False, args.f)
+                    print("\n")
+                imageCount += 1
+                segmentCount += len(groups[img])
+
+        # Print throughput summary
+        elapsed = max(time() - startTime, 1e-6)
+        print("Processed {} images ({} segments) in {:.2f}s".format(imageCount, segmentCount, elapsed))
+        print("  {:.2f} images/s, {:.2f} segments/s".format(imageCount / elapsed, segmentCount / elapsed))
+        if failed > 0:
+            print("  {} images failed".format(failed))
     else:
         # Load and process single file
         process_single_segment(args.INPUT)
 
 
-def process_group(name, mode, files):
+def process_batch(groups):
     """
-    Load data field of each segment and combine into one JPEG
+    Processes image groups in parallel across a process pool
+    :return: Number of images saved, number of segments in saved images, number of images that failed
     """
 
-    print("Processing {}...".format(name))
-    print("  Loading segments", end='')
+    print("Processing {} images with {} processes...".format(len(groups), args.j))
 
-    segmentDataFields = []
+    imageCount = 0
+    segmentCount = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.j) as pool:
+        jobs = {}
+        for img in groups.keys():
+            name, mode, segment = parse_fname(groups[img][0])
+            jobs[pool.submit(process_group, name, mode, groups[img], args.t, True, args.f)] = img
+
+        # Report images as they complete
+        for job in as_completed(jobs):
+            img = jobs[job]
+            try:
+                outFName = job.result()
+                imageCount += 1
+                segmentCount += len(groups[img])
+                print("  Saved image: \"{}\"".format(outFName))
+            except Exception as e:
+                failed += 1
+                print("  FAILED TO PROCESS {}: {}".format(img, e))
+    print()
 
-    # Load each segment from disk
-    for seg in files:
-        # Load file
-        headerField, dataField = load_lrit(seg)
+    return imageCount, segmentCount, failed
 
-        # Append data field to data field list
-        segmentDataFields.append(dataField)
-        print(".", end='')
-        sys.stdout.flush()
-    print()
 
-    # Create new image
-    finalResH, finalResV = get_image_resolution(mode)
-    outImage = Image.new("RGB", (finalResH, finalResV))
+def process_group(name, mode, files, threads=1, quiet=False, fmt="jpg"):
+    """
+    Load data field of each segment and combine into one image
+    :param threads: Number of threads decoding segments
+    :param quiet: Suppress progress output (for batch processing)
+    :param fmt: Output format (jpg, png or tif)
+    :return: Output image path
+    """
 
-    # Process segments into images
-    print("  Joining segments", end='')
+    if not quiet:
+        print("Processing {}...".format(name))
+        print("  Loading segments", end='')
 
-    segmentCount = get_total_segments(mode)
-    segmentVRes = int(finalResV / segmentCount)
-    for i, seg in enumerate(segmentDataFields):
-        # Create image object
-        buf = io.BytesIO(seg)
-        img = Image.open(buf)
-        
-        # Calculate segment offset
-        if mode == "ENH":
-            if i == 0 or i == 1 or i == 2:
-                vOffset = 309 * i
-            else:
-                # Last ENH segment
-                vOffset = (309 * 2) + 308
+    segmentFiles = []
+    segmentDataFields = []
+
+    # Image geometry
+    finalResH, finalResV = get_image_resolution(mode)
+    offsets = get_segment_offsets(mode)
+    outFName = args.INPUT + "\\" + name + "." + fmt
+
+    # Write to temporary file so a failed image is never mistaken for a generated one
+    tmpFName = outFName + ".tmp"
+
+    pool = None
+    try:
+        # Map each segment from disk
+        for seg in files:
+            # Load file
+            xrit = load_lrit(seg)
+
+            # Append data field to data field list
+            segmentFiles.append(xrit)
+            segmentDataFields.append(xrit.data)
+            if not quiet:
+                print(".", end='')
+                sys.stdout.flush()
+        if not quiet:
+            print()
+            print("  Joining segments", end='')
+
+        # Decode segments (JPEG decoding releases the GIL)
+        if threads > 1:
+            pool = ThreadPoolExecutor(max_workers=threads)
+            segmentImages = pool.map(decode_segment, segmentDataFields)
         else:
-            vOffset = segmentVRes * i
+            segmentImages = (decode_segment(seg) for seg in segmentDataFields)
 
-        # Append image to output image
-        outImage.paste(img, (0, vOffset))
+        if fmt == "jpg":
+            # Paste segments into single channel image
+            outImage = Image.new("L", (finalResH, finalResV))
+            for i, img in enumerate(segmentImages):
+                outImage.paste(img, (0, offsets[i]))
+                progress(quiet)
 
+            outImage.save(tmpFName, format='JPEG', quality=100)
+        else:
+            # Write each segment into output file as soon as it is decoded
+            strips = (segment_strip(img, i, offsets, finalResH, finalResV, quiet) for i, img in enumerate(segmentImages))
+            if fmt == "png":
+                write_png(tmpFName, finalResH, finalResV, strips)
+            else:
+                write_tiff(tmpFName, finalResH, finalResV, strips)
+
+        os.replace(tmpFName, outFName)
+    except BaseException:
+        # Remove partial image
+        try:
+            os.remove(tmpFName)
+        except OSError:
+            pass
+        raise
+    finally:
+        if pool != None:
+            pool.shutdown()
+
+        # Segment files are no longer needed once decoded
+        segmentImages = None
+        segmentDataFields = None
+        for xrit in segmentFiles:
+            xrit.close()
+
+    if not quiet:
+        print()
+        print("  Saved image: \"{}\"".format(outFName))
+
+    return outFName
+
+
+def progress(quiet):
+    """
+    Prints progress marker for a joined segment
+    """
+
+    if not quiet:
         print(".", end='')
         sys.stdout.flush()
-    print()
-
-    # Save output image to disk
-    outFName = args.INPUT + "\\" + name + ".jpg"
-    outImage.save(outFName, format='JPEG', subsampling=0, quality=100)
-    print("  Saved image: \"{}\"".format(outFName))
 
 
-def process_single_segment(fpath):
+def segment_strip(img, i, offsets, width, height, quiet):
     """
-    Processes a single LRIT segment into an image
+    Returns lines of the output image covered by a segment as bytes
+    :param img: Decoded segment
+    :param i: Segment index
+    :param offsets: First line of each segment
     """
 
-    name, mode, segment = parse_fname(fpath)
-    print("Processing {}...".format(fpath))
+    # Lines until next segment (later segments overwrite any overlap)
+    if i + 1 < len(offsets):
+        lines = offsets[i + 1] - offsets[i]
+    else:
+        lines = height - offsets[i]
 
-    # Load file
-    headerField, dataField = load_lrit(fpath)
+    if img.mode != "L":
+        img = img.convert("L")
 
-    # Create image and save to disk
-    buf = io.BytesIO(dataField)
-    img = Image.open(buf)
-    outFName = fpath + ".jpg"
-    img.save(outFName)
-    print("Saved image: \"{}\"".format(outFName))
+    # Pad or crop segments that do not match the image geometry
+    if img.size != (width, lines):
+        strip = Image.new("L", (width, lines))
+        strip.paste(img, (0, 0))
+        img = strip
 
+    progress(quiet)
+    return img.tobytes()
 
-def load_lrit(fpath):
+
+def write_png(path, width, height, strips):
     """
-    Load LRIT file and return data field
+    Writes 8-bit greyscale PNG from strips of lines without holding the whole image in memory
+    :param strips: Iterable of bytes, each containing whole lines
     """
 
-    # Read file bytes from disk
-    file = open(fpath, mode="rb")
-    fileBytes = file.read()
-    headerLen, dataLen = parse_primary(fileBytes)
+    def chunk(f, ctype, data):
+        f.write(struct.pack(">I", len(data)))
+        f.write(ctype)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(ctype))))
+
+    f = open(path, mode="wb")
+    try:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+
+        z = zlib.compressobj(6)
+        for strip in strips:
+            # Prefix each line with filter type 0 (none)
+            lines = len(strip) // width
+            raw = bytearray((width + 1) * lines)
+            for l in range(lines):
+                start = l * (width + 1) + 1
+                raw[start : start + width] = strip[l * width : (l + 1) * width]
+
+            data = z.compress(raw)
+            if len(data) > 0:
+                chunk(f, b'IDAT', data)
+
+        chunk(f, b'IDAT', z.flush())
+        chunk(f, b'IEND', b'')
+    finally:
+        f.close()
+
+
+def write_tiff(path, width, height, strips):
+    """
+    Writes uncompressed 8-bit greyscale TIFF from strips of lines without holding the whole image in memory
+    :param strips: Iterable of bytes, each containing whole lines
+    """
 
-    # Split file bytes into fields
-    headerField = fileBytes[:headerLen]
-    dataField = fileBytes[headerLen : headerLen + dataLen]
+    f = open(path, mode="wb")
+    try:
+        # Header with IFD after image data
+        ifdOffset = 8 + (width * height)
+        ifdOffset += ifdOffset % 2
+        f.write(b'II*\x00' + struct.pack("<I", ifdOffset))
+
+        for strip in strips:
+            f.write(strip)
+        if f.tell() % 2:
+            f.write(b'\x00')
+
+        # Image File Directory (tag, type, count, value)
+        tags = []
+        tags.append((256, 4, 1, width))             # ImageWidth
+        tags.append((257, 4, 1, height))            # ImageLength
+        tags.append((258, 3, 1, 8))                 # BitsPerSample
+        tags.append((259, 3, 1, 1))                 # Compression (none)
+        tags.append((262, 3, 1, 1))                 # PhotometricInterpretation (black is zero)
+        tags.append((273, 4, 1, 8))                 # StripOffsets
+        tags.append((277, 3, 1, 1))                 # SamplesPerPixel
+        tags.append((278, 4, 1, height))            # RowsPerStrip
+        tags.append((279, 4, 1, width * height))    # StripByteCounts
+
+        f.write(struct.pack("<H", len(tags)))
+        for tag, ttype, count, value in tags:
+            if ttype == 3:
+                f.write(struct.pack("<HHIHH", tag, ttype, count, value, 0))
+            else:
+                f.write(struct.pack("<HHII", tag, ttype, count, value))
+        f.write(struct.pack("<I", 0))
+    finally:
+        f.close()
 
-    return headerField, dataField
 
+def decode_segment(data):
+    """
+    Decodes JPEG data field of a segment
+    """
 
-def parse_primary(data):
+    buf = io.BytesIO(data)
+    img = Image.open(buf)
+    img.load()
+
+    return img
+
+
+def process_single_segment(fpath):
     """
-    Parses LRIT primary header to get field lengths
+    Processes a single LRIT segment into an image
     """
 
-    #print("Parsing primary LRIT header...")
+    name, mode, segment = parse_fname(fpath)
+    print("Processing {}...".format(fpath))
 
-    primaryHeader = data[:16]
+    # Load file
+    with load_lrit(fpath) as xrit:
+        img = decode_segment(xrit.data)
+
+    # Save image to disk
+    outFName = fpath + ".jpg"
+    img.save(outFName)
+    print("Saved image: \"{}\"".format(outFName))
 
-    # Header fields
-    HEADER_TYPE = get_bits_int(primaryHeader, 0, 8, 128)               # File Counter (always 0x00)
-    HEADER_LEN = get_bits_int(primaryHeader, 8, 16, 128)               # Header Length (always 0x10)
-    FILE_TYPE = get_bits_int(primaryHeader, 24, 8, 128)                # File Type
-    TOTAL_HEADER_LEN = get_bits_int(primaryHeader, 32, 32, 128)        # Total LRIT Header Length
-    DATA_LEN = get_bits_int(primaryHeader, 64, 64, 128)                # Data Field Length
 
-    #print("    Header Length: {} bytes".format(TOTAL_HEADER_LEN))
-    #print("    Data Length: {} bits ({} bytes)".format(DATA_LEN, DATA_LEN/8))
+def load_lrit(fpath):
+    """
+    Map LRIT file from disk.
+    Header and data fields are available as views (file is closed by caller).
+    """
 
-    return TOTAL_HEADER_LEN, DATA_LEN
+    return XRITFile(fpath)
 
 
 def parse_fname(fpath):
@@ -256,6 +439,22 @@ def get_total_segments(mode):
     return totalSegments
 
 
+def get_segment_offsets(mode):
+    """
+    Returns the first line of each segment in the given observation mode
+    """
+
+    totalSegments = get_total_segments(mode)
+    finalResH, finalResV = get_image_resolution(mode)
+
+    if mode == "ENH":
+        # Last ENH segment starts one line early
+        return [0, 309, 309 * 2, (309 * 2) + 308]
+
+    segmentVRes = int(finalResV / totalSegments)
+    return [segmentVRes * i for i in range(totalSegments)]
+
+
 def get_image_resolution(mode):
     """
     Returns the horizontal and vertical resolution of the given observation mode
@@ -277,40 +476,9 @@ def get_image_resolution(mode):
     return outH, outV
 
 
-def get_bits(data, start, length, count):
-    """
-    Get bits from bytes
-
-    :param data: Bytes to get bits from
-    :param start: Start offset in bits
-    :param length: Number of bits to get
-    :param count: Total number of bits in bytes (accounts for leading zeros)
-    """
-
-    dataInt = int.from_bytes(data, byteorder='big')
-    dataBin = format(dataInt, '0' + str(count) + 'b')
-    end = start + length
-    bits = dataBin[start : end]
-
-    return bits
-
-def get_bits_int(data, start, length, count):
-    """
-    Get bits from bytes as integer
-
-    :param data: Bytes to get bits from
-    :param start: Start offset in bits
-    :param length: Number of bits to get
-    :param count: Total number of bits in bytes (accounts for leading zeros)
-    """
-
-    bits = get_bits(data, start, length, count)
-
-    return int(bits, 2)
-
-
-try:
-    init()
-except KeyboardInterrupt:
-    print("Exiting...")
-    exit(0)
+if __name__ == "__main__":
+    try:
+        init()
+    except KeyboardInterrupt:
+        print("Exiting...")
+        exit(0)
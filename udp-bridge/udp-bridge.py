@@ -6,11 +6,18 @@ Uni-directional UDP to TCP bridge.
 """
 
 import argparse
+from collections import deque
+import selectors
 import socket
+from threading import Condition, Thread
+from time import monotonic, sleep
 
 argparser = argparse.ArgumentParser(description="Uni-directional UDP to TCP bridge.")
 argparser.add_argument("UDP", action="store", help="UDP port")
 argparser.add_argument("TCP", action="store", help="TCP port")
+argparser.add_argument("-r", action="store", type=int, help="UDP receive buffer size in MB", default=4)
+argparser.add_argument("-q", action="store", type=int, help="Maximum data held while TCP is stalled in MB", default=16)
+argparser.add_argument("-s", action="store", type=int, help="Seconds between statistics (0 disables)", default=10)
 args = argparser.parse_args()
 
 UDP_IP = "127.0.0.1"
@@ -18,14 +25,87 @@ UDP_PORT = int(args.UDP)
 TCP_IP = "127.0.0.1"
 TCP_PORT = int(args.TCP)
 
+maxDatagram = 65535     # Largest possible UDP datagram
+maxBatch = 512          # Datagrams read per wakeup and written per TCP send
+
 udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+ring = None             # Datagrams waiting to be sent over TCP
+
+
+class Ring:
+    """
+    Bounded FIFO of datagrams between the UDP receiver and TCP sender.
+    The receiver never blocks: datagrams are dropped and counted while the ring is full.
+    """
+
+    def __init__(self, maxbytes):
+        """
+        :param maxbytes: Maximum size of held datagrams in bytes
+        """
+
+        self.maxbytes = maxbytes        # Held data limit
+        self.items = deque()            # Held datagrams
+        self.bytes = 0                  # Size of held datagrams
+        self.cond = Condition()         # Ring condition
+
+        # Metrics
+        self.datagrams = 0              # Datagrams received
+        self.received = 0               # Bytes received
+        self.sent = 0                   # Bytes sent over TCP
+        self.sends = 0                  # TCP send calls
+        self.dropped = 0                # Datagrams dropped while ring was full
+        self.droppedBytes = 0           # Bytes dropped while ring was full
+        self.peak = 0                   # Peak size of held datagrams
+        self.reconnects = 0             # TCP reconnections
+
+    def push_many(self, datagrams):
+        """
+        Adds batch of datagrams, dropping those that do not fit
+        """
+
+        with self.cond:
+            for d in datagrams:
+                self.datagrams += 1
+                self.received += len(d)
+
+                if self.bytes + len(d) > self.maxbytes:
+                    self.dropped += 1
+                    self.droppedBytes += len(d)
+                    continue
+
+                self.items.append(d)
+                self.bytes += len(d)
+
+            self.peak = max(self.peak, self.bytes)
+            self.cond.notify()
+
+    def pull_many(self, limit):
+        """
+        Removes up to limit datagrams, blocking until at least one is available
+        """
+
+        with self.cond:
+            while len(self.items) == 0:
+                self.cond.wait()
+
+            batch = []
+            while len(self.items) > 0 and len(batch) < limit:
+                d = self.items.popleft()
+                self.bytes -= len(d)
+                batch.append(d)
+
+        return batch
 
 
 def init():
+    global ring
+
     print("UDP -> TCP Bridge")
     print("{}:{} -> {}:{}\n".format(UDP_IP, UDP_PORT, TCP_IP, TCP_PORT))
 
+    ring = Ring(args.q * 1024 * 1024)
+
     startUDP()
     startTCP()
 
@@ -39,6 +119,9 @@ def startUDP():
 
     print("Starting UDP...")
 
+    # Large kernel buffer absorbs bursts while the receiver is not scheduled
+    udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.r * 1024 * 1024)
+
     try:
         udpSocket.bind((UDP_IP, UDP_PORT))
     except socket.error as e:
@@ -46,31 +129,44 @@ def startUDP():
             print("PORT {} ALREADY IN USE".format(UDP_PORT))
         else:
             print(e)
-        
+
         print("Exiting...\n")
         exit()
-    
-    print("UDP OK\n")
+
+    udpSocket.setblocking(False)
+    print("UDP OK ({} KB receive buffer)\n".format(udpSocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 1024))
 
 
-def startTCP():
+def startTCP(retry=False):
     """
     Connect TCP socket to OSP decoder symbol port
+    :param retry: Keep trying until connected instead of exiting
     """
 
+    global tcpSocket
+
     print("Starting TCP...")
 
-    try:
-        tcpSocket.connect((TCP_IP, TCP_PORT))
-    except socket.error as e:
-        if e.errno == 10061:
-            print("TCP CONNECTION REFUSED".format())
-        else:
-            print(e)
-        
-        print("Exiting...\n")
-        exit()
+    while True:
+        try:
+            tcpSocket.connect((TCP_IP, TCP_PORT))
+            break
+        except socket.error as e:
+            if e.errno == 10061 or isinstance(e, ConnectionRefusedError):
+                print("TCP CONNECTION REFUSED".format())
+            else:
+                print(e)
+
+            if not retry:
+                print("Exiting...\n")
+                exit()
+
+            # New socket for next attempt
+            tcpSocket.close()
+            tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sleep(1)
 
+    tcpSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     print("TCP OK\n")
 
 
@@ -78,29 +174,134 @@ def bridge():
     """
     Forward incoming UDP data to TCP socket
     """
-    
-    global udpSocket
-    global tcpSocket
 
     print("PORTS BRIDGED\n")
 
+    # Start TCP sender
+    sender_thread = Thread(target=sender)
+    sender_thread.name = "TCP SENDER"
+    sender_thread.daemon = True
+    sender_thread.start()
+
+    # Start statistics output
+    if args.s > 0:
+        stats_thread = Thread(target=stats)
+        stats_thread.name = "STATISTICS"
+        stats_thread.daemon = True
+        stats_thread.start()
+
+    receiver()
+
+
+def receiver():
+    """
+    Drains all waiting UDP datagrams on each wakeup and hands them to the sender as one batch
+    """
+
+    selector = selectors.DefaultSelector()
+    selector.register(udpSocket, selectors.EVENT_READ)
+
+    while True:
+        # Wake periodically so interrupts are handled on all platforms
+        if not selector.select(1):
+            continue
+
+        batch = []
+        while len(batch) < maxBatch:
+            try:
+                batch.append(udpSocket.recv(maxDatagram))
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError:
+                # ICMP port unreachable from a previous send (Windows), nothing was received
+                continue
+
+        if len(batch) > 0:
+            ring.push_many(batch)
+
+
+def sender():
+    """
+    Writes queued datagrams to TCP socket, coalescing everything waiting into one write
+    """
+
+    global tcpSocket
+
     while True:
-        data, addr = udpSocket.recvfrom(1024)
+        batch = ring.pull_many(maxBatch)
 
         try:
-            tcpSocket.send(data)
+            send_all(tcpSocket, batch)
         except socket.error as e:
-            if e.errno == 10054:
+            if e.errno == 10054 or isinstance(e, ConnectionError):
                 print("TCP SOCKET CLOSED BY REMOTE")
-                
-                print("Restarting TCP connection...")
-                tcpSocket.close()
-                tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                startTCP()
             else:
                 print(e)
-                print("Exiting...\n")
-                exit()   
+
+            # Data in the failed write is lost, datagrams arriving meanwhile are held in the ring
+            print("Restarting TCP connection...")
+            tcpSocket.close()
+            tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            startTCP(True)
+            ring.reconnects += 1
+            continue
+
+        with ring.cond:
+            ring.sent += sum(len(d) for d in batch)
+            ring.sends += 1
+
+
+def send_all(sck, chunks):
+    """
+    Writes every chunk to socket, retrying partial writes
+    """
+
+    # Gather write without joining chunks (not available on Windows)
+    if hasattr(sck, "sendmsg"):
+        views = [memoryview(c) for c in chunks]
+        while len(views) > 0:
+            sent = sck.sendmsg(views)
+
+            # Skip chunks written completely, keep remainder of a partial chunk
+            while len(views) > 0 and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent > 0:
+                views[0] = views[0][sent:]
+    else:
+        sck.sendall(b''.join(chunks))
+
+
+def stats():
+    """
+    Prints throughput and drop counts periodically
+    """
+
+    last = (monotonic(), 0, 0, 0, 0)
+
+    while True:
+        sleep(args.s)
+
+        with ring.cond:
+            now = (monotonic(), ring.datagrams, ring.received, ring.sent, ring.dropped)
+            held = ring.bytes
+            peak = ring.peak
+            reconnects = ring.reconnects
+            ring.peak = ring.bytes
+
+        elapsed = max(now[0] - last[0], 1e-6)
+        dgrams = (now[1] - last[1]) / elapsed
+        rx = (now[2] - last[2]) / elapsed / 1024
+        tx = (now[3] - last[3]) / elapsed / 1024
+        dropped = now[4] - last[4]
+        last = now
+
+        print("RX: {:.0f} datagrams/s ({:.1f} KB/s)   TX: {:.1f} KB/s   HELD: {} KB (PEAK: {} KB)   DROPPED: {} ({} total)   RECONNECTS: {}".format(dgrams, rx, tx, held // 1024, peak // 1024, dropped, now[4], reconnects))
 
 
-init()
+try:
+    init()
+except KeyboardInterrupt:
+    if ring != None:
+        print("\nReceived {} datagrams ({} bytes), sent {} bytes in {} writes, dropped {} datagrams ({} bytes)".format(ring.datagrams, ring.received, ring.sent, ring.sends, ring.dropped, ring.droppedBytes))
+    print("Exiting...")
@@ -12,31 +12,8 @@ argparser = argparse.ArgumentParser(description="Parses xRIT file and displays h
 argparser.add_argument("PATH", action="store", help="Input xRIT file")
 args = argparser.parse_args()
 
-# Create COMS class instance and load xRIT file
-COMS = comsClass(args.PATH)
+# Create COMS class instance and load xRIT headers
+COMS = comsClass(args.PATH, True)
 
-# Primary Header (type 0, required)
-COMS.parsePrimaryHeader(True)
-
-# START OPTIONAL HEADERS
-COMS.parseImageStructureHeader(True)
-
-COMS.parseImageNavigationHeader(True)
-
-COMS.parseImageDataFunctionHeader(True)
-
-COMS.parseAnnotationTextHeader(True)
-
-COMS.parseTimestampHeader(True)
-
-COMS.parseAncillaryTextHeader(True)
-
-COMS.parseKeyHeader(True)
-
-COMS.parseImageSegmentationInformationHeader(True)
-
-COMS.parseImageCompensationInformationHeader(True)
-
-COMS.parseImageObservationTimeHeader(True)
-
-COMS.parseImageQualityInformationHeader(True)
+# Parse and print all headers
+COMS.parseHeaders(True)
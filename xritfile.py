@@ -0,0 +1,95 @@
+"""
+xritfile.py
+https://github.com/sam210723/COMS-1
+
+Memory-mapped access to xRIT files shared by the command line tools.
+"""
+
+import mmap
+import os
+
+
+class XRITFile:
+    """
+    Memory-mapped xRIT file.
+    Header and data fields are zero-copy memoryviews into the mapped file.
+    """
+
+    def __init__(self, path):
+        """
+        Opens and maps xRIT file
+        :param path: Path to xRIT file
+        """
+
+        self.path = path                # xRIT file path
+        self.mmap = None                # File mapping
+        self.view = memoryview(b'')     # View of whole file
+
+        f = open(path, mode="rb")
+        try:
+            # Empty files can not be mapped
+            if os.fstat(f.fileno()).st_size > 0:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+        finally:
+            # Mapping stays valid after file is closed
+            f.close()
+
+        # Field lengths from primary header
+        if len(self.view) >= 16:
+            self.header_len = int.from_bytes(self.view[4:8], byteorder='big')
+            self.data_len = int.from_bytes(self.view[8:16], byteorder='big')
+        else:
+            self.header_len = 0
+            self.data_len = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.view)
+
+    @property
+    def header(self):
+        """
+        Header field (all xRIT headers)
+        """
+
+        return self.view[:self.header_len]
+
+    @property
+    def data(self):
+        """
+        Data field (length in primary header is in bits)
+        """
+
+        return self.view[self.header_len : self.header_len + ((self.data_len + 7) // 8)]
+
+    def read(self, offset, length):
+        """
+        Returns view of bytes in file
+        :param offset: Start offset in bytes
+        :param length: Number of bytes
+        """
+
+        return self.view[offset : offset + length]
+
+    def close(self):
+        """
+        Releases view and unmaps file.
+        Views handed out by this object must not be used after closing.
+        """
+
+        try:
+            self.view.release()
+            if self.mmap != None:
+                self.mmap.close()
+        except BufferError:
+            # Views are still held by caller, mapping is closed once they are released
+            pass
+
+        self.view = memoryview(b'')
+        self.mmap = None